@@ -0,0 +1,383 @@
+# Module for applying a directory of backup definitions to the server
+# Every YAML or JSON file in the directory defines one backup job, matched to
+# the jobs on the server by name. The live configurations are fetched with a
+# single list request and compared field by field with the definitions;
+# only fields a definition sets are compared, so values the server fills in
+# such as ID's and database paths don't count as changes. Jobs that differ
+# are updated, missing jobs created and, if asked to, jobs without a
+# definition deleted. The plan is printed before anything is changed, and
+# the changes run in parallel over one connection pool.
+# The same loading is used to create many backups from a directory at once.
+import client
+import common
+import index
+import json
+import models
+import os
+import snapshot
+import sys
+import yaml
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# The YAML loader written in C is many times faster when libyaml is present
+try:
+    SafeLoader = yaml.CSafeLoader
+except AttributeError:
+    SafeLoader = yaml.SafeLoader
+
+# Extensions of the definition files
+EXTENSIONS = [".yml", ".yaml", ".json"]
+
+# Directories with at least this many files are parsed in a process pool
+PARSE_PROCESS_THRESHOLD = 50
+
+# Fields in a definition that never match the server they are applied to
+IGNORED_FIELDS = {
+    "Backup": ["ID", "DBPath"],
+    "Schedule": ["ID", "Tags"]
+}
+IGNORED_ITEMS = ["CreatedByVersion", "DisplayNames"]
+
+
+# Raised for definition files that can't be used
+class DefinitionError(ValueError):
+    pass
+
+
+# Load a backup configuration from a YAML or JSON file
+def load_definition(path):
+    try:
+        with open(path, 'r') as file_handle:
+            return parse_definition(path, file_handle)
+    except (IOError, OSError) as exc:
+        raise DefinitionError(path + ": " + str(exc))
+
+
+# Parse a backup configuration, the format is taken from the extension
+# content is an open file or a string
+def parse_definition(path, content):
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == ".json" and hasattr(content, "read"):
+            definition = json.load(content)
+        elif extension == ".json":
+            definition = json.loads(content)
+        else:
+            definition = yaml.load(content, Loader=SafeLoader)
+    except (ValueError, yaml.YAMLError):
+        raise DefinitionError(path + ": failed to load file as " +
+                              extension[1:].upper())
+    validate_definition(path, definition)
+    return definition
+
+
+# Check that a definition describes a backup job
+def validate_definition(path, definition):
+    if not isinstance(definition, dict) or \
+            not isinstance(definition.get("Backup", None), dict):
+        raise DefinitionError(path + ": a Backup section is required")
+    name = definition["Backup"].get("Name", None)
+    if not name:
+        raise DefinitionError(path + ": the backup needs a Name")
+
+
+# Check that a definition has what the server needs to create a backup
+def validate_new(path, definition):
+    backup = definition["Backup"]
+    if not backup.get("TargetURL", None):
+        raise DefinitionError(path + ": the backup needs a TargetURL")
+    if not isinstance(backup.get("Sources", None), list) or \
+            len(backup["Sources"]) == 0:
+        raise DefinitionError(path + ": the backup needs a list of Sources")
+
+
+# Load a definition, returning the error instead of raising it
+# Runs in the workers of the process pool
+def try_load_definition(path):
+    try:
+        return load_definition(path), None
+    except DefinitionError as exc:
+        return None, str(exc)
+
+
+# Load many definition files, in a process pool when there are many
+def load_files(paths):
+    if len(paths) < PARSE_PROCESS_THRESHOLD:
+        return [try_load_definition(path) for path in paths]
+    try:
+        with ProcessPoolExecutor() as executor:
+            return list(executor.map(try_load_definition, paths,
+                                     chunksize=8))
+    except (OSError, NotImplementedError, BrokenProcessPool):
+        # Platforms without working process pools
+        return [try_load_definition(path) for path in paths]
+
+
+# Definition files in a directory, sorted by name
+def list_definitions(directory):
+    try:
+        names = sorted(os.listdir(directory))
+    except (IOError, OSError) as exc:
+        raise DefinitionError(directory + ": " + str(exc))
+    return [os.path.join(directory, name) for name in names
+            if os.path.splitext(name)[1].lower() in EXTENSIONS]
+
+
+# Load all definitions of a directory keyed by backup name
+def load_definitions(directory):
+    try:
+        paths = list_definitions(directory)
+    except DefinitionError as exc:
+        return {}, [str(exc)]
+    loaded = load_files(paths)
+    return collect_definitions((path, definition, error) for path,
+                               (definition, error) in zip(paths, loaded))
+
+
+# Key loaded definitions by backup name, reporting clashing names
+# loaded holds the path, definition and error of every file
+def collect_definitions(loaded):
+    definitions = {}
+    errors = []
+    for path, definition, error in loaded:
+        if error is not None:
+            errors.append(error)
+            continue
+        name = definition["Backup"]["Name"]
+        if name in definitions:
+            errors.append(path + ": backup " + name + " is also defined in " +
+                          definitions[name][0])
+            continue
+        definitions[name] = (path, definition)
+    return definitions, errors
+
+
+# Definition without the volatile and server specific fields
+def normalize(definition):
+    normalized = snapshot.normalize(definition)
+    for key in IGNORED_ITEMS:
+        normalized.pop(key, None)
+    for key, fields in IGNORED_FIELDS.items():
+        if isinstance(normalized.get(key, None), dict):
+            for field in fields:
+                normalized[key].pop(field, None)
+    return normalized
+
+
+# Paths of the fields set in desired that differ in live
+def diff(desired, live, path=""):
+    changes = []
+    for key in sorted(desired):
+        field = path + "." + key if path else key
+        if isinstance(desired[key], dict) and \
+                isinstance(live.get(key, None), dict):
+            changes.extend(diff(desired[key], live[key], field))
+        elif desired[key] != live.get(key, None):
+            changes.append(field)
+    return changes
+
+
+# Live configuration with the fields of desired replacing its own
+def merge(live, desired):
+    merged = dict(live)
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(live.get(key, None), dict):
+            merged[key] = merge(live[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+# A change to a single backup job
+class Change(object):
+    __slots__ = ("action", "name", "backup_id", "config", "fields")
+
+    def __init__(self, action, name, backup_id=None, config=None,
+                 fields=None):
+        self.action = action
+        self.name = name
+        self.backup_id = backup_id
+        self.config = config
+        self.fields = fields or []
+
+
+# Compare the definitions with the live jobs and list the changes
+def plan(definitions, live_items, delete=False):
+    live = {}
+    duplicates = set()
+    for item in live_items:
+        backup = models.Backup(item)
+        if backup.name in live:
+            duplicates.add(backup.name)
+        live[backup.name] = (backup.id, backup.config())
+
+    changes = []
+    errors = []
+    for name in sorted(definitions):
+        path, definition = definitions[name]
+        if name in duplicates:
+            errors.append(path + ": several backups on the server are " +
+                          "named " + name)
+            continue
+        desired = normalize(definition)
+        if name not in live:
+            try:
+                validate_new(path, definition)
+            except DefinitionError as exc:
+                errors.append(str(exc))
+                continue
+            changes.append(Change("create", name, config=definition))
+            continue
+        backup_id, live_config = live[name]
+        fields = diff(desired, live_config)
+        if len(fields) > 0:
+            changes.append(Change("update", name, backup_id,
+                                  merge(live_config, desired), fields))
+
+    if delete:
+        for name in sorted(live):
+            if name not in definitions:
+                changes.append(Change("delete", name, live[name][0]))
+    return changes, errors
+
+
+# Print a plan, one line per change
+def display_plan(changes):
+    symbols = {"create": "+", "update": "~", "delete": "-"}
+    for change in changes:
+        message = symbols[change.action] + " " + change.name
+        if change.backup_id is not None:
+            message += " (ID:" + str(change.backup_id) + ")"
+        if len(change.fields) > 0:
+            message += ": " + ", ".join(change.fields)
+        common.log_output(message, True)
+    if len(changes) == 0:
+        common.log_output("No changes", True)
+
+
+# Carry out a single change, returning the error if it failed
+def execute(duplicati, change):
+    try:
+        if change.action == "create":
+            duplicati.create_backup(change.config)
+        elif change.action == "update":
+            duplicati.update_backup(change.backup_id, change.config)
+        elif change.action == "delete":
+            duplicati.delete_backup(change.backup_id)
+    except client.DuplicatiError as error:
+        return error
+    return None
+
+
+# Apply the definitions in a directory to the server
+def run(data, directory, dry_run=False, delete=False, jobs=4):
+    definitions, errors = load_definitions(directory)
+    for error in errors:
+        common.log_output(error, True)
+    if len(errors) > 0:
+        sys.exit(2)
+
+    common.verify_token(data)
+    jobs = max(1, jobs)
+    duplicati = client.pooled_client(data, jobs, persist=True,
+                                     relogin=False)
+    common.log_output("Fetching backups list from API...", False)
+    try:
+        live_items = duplicati.list_resource("backups", True)
+        changes, errors = plan(definitions, live_items, delete)
+    except client.DuplicatiError as error:
+        common.log_output(error.message, True, error.status_code)
+        sys.exit(2)
+    for error in errors:
+        common.log_output(error, True)
+    if len(errors) > 0:
+        sys.exit(2)
+
+    display_plan(changes)
+    if dry_run or len(changes) == 0:
+        return changes
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda change: execute(duplicati, change),
+                                    changes))
+    index.invalidate(data)
+
+    failed = 0
+    for change, error in zip(changes, results):
+        if error is None:
+            continue
+        failed += 1
+        message = "Failed to " + change.action + " " + change.name + ": "
+        common.log_output(message + error.message, True, error.status_code)
+    message = "Applied " + str(len(changes) - failed) + " of "
+    message += str(len(changes)) + " changes"
+    common.log_output(message, True, 200 if failed == 0 else None)
+    if failed > 0:
+        sys.exit(2)
+    return changes
+
+
+# Create a backup from every definition in a directory
+def create(data, directory, import_meta=None, jobs=4):
+    definitions, errors = load_definitions(directory)
+    create_all(data, definitions, errors, directory, import_meta, jobs)
+
+
+# Create a backup from every loaded definition
+# All definitions are validated before the first backup is created, and
+# failures of single backups are reported together at the end. source names
+# where the definitions came from.
+def create_all(data, definitions, errors, source, import_meta=None, jobs=4):
+    errors = list(errors)
+    for name in sorted(definitions):
+        path, definition = definitions[name]
+        try:
+            validate_new(path, definition)
+        except DefinitionError as exc:
+            errors.append(str(exc))
+    for error in errors:
+        common.log_output(error, True)
+    if len(errors) > 0:
+        sys.exit(2)
+    if len(definitions) == 0:
+        common.log_output("No backup configurations found in " + source,
+                          True)
+        sys.exit(2)
+
+    common.verify_token(data)
+    jobs = max(1, jobs)
+    duplicati = client.pooled_client(data, jobs, persist=True,
+                                     relogin=False)
+    changes = [Change("create", name, config=definitions[name][1])
+               for name in sorted(definitions)]
+
+    def create_backup(change):
+        try:
+            duplicati.create_backup(change.config, import_meta)
+        except client.DuplicatiError as error:
+            return error
+        return None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(create_backup, changes))
+    index.invalidate(data)
+
+    failed = []
+    for change, error in zip(changes, results):
+        if error is None:
+            continue
+        # Connection errors end the run like for a single file
+        if error.status_code in client.CONNECTION_ERRORS:
+            common.log_output(error.message, True, error.status_code)
+            sys.exit(2)
+        failed.append(definitions[change.name][0] + ": " + error.message)
+    for message in failed:
+        common.log_output(message, True)
+    message = "Created " + str(len(changes) - len(failed)) + " of "
+    message += str(len(changes)) + " backups"
+    common.log_output(message, True, 200 if len(failed) == 0 else None)
+    if len(failed) > 0:
+        sys.exit(2)
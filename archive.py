@@ -0,0 +1,259 @@
+# Module for exporting a whole server into a single archive and back
+# The archive is written in one pass while the backups are read from the
+# server: every backup configuration becomes one member as soon as it
+# arrives, so only a single configuration is held in memory at a time. The
+# server settings follow, and a manifest listing the members comes last.
+# Tar archives can be compressed with gzip or, if the zstandard package is
+# installed, zstd; zip archives are deflated. The format is taken from the
+# file name.
+# Layout of the archive:
+#   backups/<name>_<id>.yml    one configuration per backup, or .json
+#   serversettings.yml         server settings without the internal ones
+#   manifest.json              server, version, time and members
+import apply
+import client
+import common
+import datetime
+import io
+import json
+import models
+import os
+import re
+import settings
+import sys
+import tarfile
+import time
+import yaml
+import zipfile
+
+from requests_wrapper import requests_wrapper as requests
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Errors of damaged archives
+READ_ERRORS = (IOError, OSError, EOFError, tarfile.TarError,
+               zipfile.BadZipfile, UnicodeDecodeError)
+if zstandard is not None:
+    READ_ERRORS += (zstandard.ZstdError,)
+
+# Archive formats by file name ending
+FORMATS = [
+    (".tar.gz", "tar", "gz"),
+    (".tgz", "tar", "gz"),
+    (".tar.zst", "tar", "zst"),
+    (".tzst", "tar", "zst"),
+    (".tar", "tar", None),
+    (".zip", "zip", None)
+]
+
+MANIFEST = "manifest.json"
+BACKUP_DIRECTORY = "backups/"
+
+# Characters replaced in member names
+UNSAFE_CHARACTERS = re.compile(r"[^\w.-]+")
+
+
+# Format and compression of an archive from its file name
+def archive_format(path):
+    lowered = path.lower()
+    for ending, kind, compression in FORMATS:
+        if lowered.endswith(ending):
+            return kind, compression
+    message = "Unknown archive type " + path + ", use "
+    message += ", ".join(ending for ending, kind, compression in FORMATS)
+    common.log_output(message, True)
+    sys.exit(2)
+
+
+# Whether a file name is that of an archive
+def is_archive(path):
+    lowered = path.lower()
+    return any(lowered.endswith(ending) for ending, kind, compression
+               in FORMATS)
+
+
+# Check that the compression of an archive can be handled
+def require_compression(compression):
+    if compression == "zst" and zstandard is None:
+        message = "zstd archives need the zstandard package, "
+        message += "pip install zstandard"
+        common.log_output(message, True)
+        sys.exit(2)
+
+
+# Writes members to a tar or zip archive one at a time
+class ArchiveWriter(object):
+    def __init__(self, path):
+        self.kind, self.compression = archive_format(path)
+        require_compression(self.compression)
+        self.file_handle = open(path, 'wb')
+        self.compressor = None
+        if self.kind == "zip":
+            self.archive = zipfile.ZipFile(self.file_handle, 'w',
+                                           zipfile.ZIP_DEFLATED)
+        elif self.compression == "zst":
+            self.compressor = zstandard.ZstdCompressor().stream_writer(
+                self.file_handle)
+            self.archive = tarfile.open(fileobj=self.compressor, mode='w|')
+        else:
+            mode = 'w|gz' if self.compression == "gz" else 'w|'
+            self.archive = tarfile.open(fileobj=self.file_handle, mode=mode)
+
+    # Add a member with the given text
+    def add(self, name, text):
+        content = text.encode("utf-8")
+        if self.kind == "zip":
+            self.archive.writestr(name, content)
+            return
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = int(time.time())
+        info.mode = 0o600
+        self.archive.addfile(info, io.BytesIO(content))
+
+    def close(self):
+        self.archive.close()
+        if self.compressor is not None:
+            self.compressor.close()
+        if not self.file_handle.closed:
+            self.file_handle.close()
+
+
+# Iterate over the members of an archive as names and text, in order
+def read_members(path):
+    kind, compression = archive_format(path)
+    require_compression(compression)
+    with open(path, 'rb') as file_handle:
+        if kind == "zip":
+            with zipfile.ZipFile(file_handle) as archive:
+                for name in archive.namelist():
+                    if not name.endswith("/"):
+                        yield name, archive.read(name).decode("utf-8")
+            return
+        if compression == "zst":
+            reader = zstandard.ZstdDecompressor().stream_reader(file_handle)
+            archive = tarfile.open(fileobj=reader, mode='r|')
+        else:
+            archive = tarfile.open(fileobj=file_handle, mode='r|*')
+        with archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                content = archive.extractfile(member).read()
+                yield member.name, content.decode("utf-8")
+
+
+# Serialize a document as YAML or JSON
+def dump(document, output=None):
+    if output in ["JSON", "json"]:
+        return json.dumps(document, indent=4, default=str)
+    return yaml.safe_dump(document, default_flow_style=False)
+
+
+# File extension of the members
+def extension(output=None):
+    return ".json" if output in ["JSON", "json"] else ".yml"
+
+
+# Member name of a backup configuration
+def backup_member(backup, output=None):
+    name = UNSAFE_CHARACTERS.sub("_", backup.name) or "backup"
+    return BACKUP_DIRECTORY + name + "_" + str(backup.id) + extension(output)
+
+
+# The backups to export, streamed from the list or fetched one by one
+def iterate_backups(duplicati, backup_ids, all_ids):
+    if all_ids:
+        for item in duplicati.list_resource("backups", True):
+            yield models.Backup(item)
+        return
+    for backup_id in backup_ids:
+        yield duplicati.get_backup(backup_id)
+
+
+# Export backups and server settings into an archive
+def export(data, path, backup_ids=None, all_ids=False, output=None):
+    common.verify_token(data)
+    duplicati = client.DuplicatiClient(data, http=requests, persist=True,
+                                       relogin=False)
+    if os.path.isfile(path):
+        agree = input('File already exists, overwrite? [Y/n]:')
+        if agree not in ["Y", "y", "yes", "YES", ""]:
+            return
+
+    directory = os.path.dirname(path)
+    if directory != '' and not os.path.exists(directory):
+        common.log_output("Created directory \"" + directory + "\"", True)
+        os.makedirs(directory)
+
+    writer = ArchiveWriter(path)
+    members = []
+    try:
+        server_version = duplicati.system_info().get("ServerVersion", None)
+        for backup in iterate_backups(duplicati, backup_ids or [], all_ids):
+            config = backup.config()
+            config["CreatedByVersion"] = server_version
+            member = backup_member(backup, output)
+            writer.add(member, dump(config, output))
+            members.append({"ID": backup.id, "Name": backup.name,
+                            "File": member})
+            common.log_output("Exported " + backup.name, False)
+
+        server_settings = settings.visible(duplicati.server_settings())
+        settings_member = "serversettings" + extension(output)
+        writer.add(settings_member, dump(server_settings, output))
+    except client.DuplicatiError as error:
+        writer.close()
+        os.remove(path)
+        common.log_output(error.message, True, error.status_code)
+        sys.exit(2)
+
+    manifest = {
+        "Server": common.create_baseurl(data),
+        "ServerVersion": server_version,
+        "Created": datetime.datetime.utcnow().isoformat() + "Z",
+        "Backups": members,
+        "ServerSettings": settings_member
+    }
+    writer.add(MANIFEST, json.dumps(manifest, indent=2, default=str))
+    writer.close()
+    message = "Created " + path + " with " + str(len(members)) + " backups"
+    common.log_output(message, True, 200)
+
+
+# Load the backup configurations of an archive keyed by backup name
+def load_definitions(path):
+    loaded = []
+    try:
+        for name, text in read_members(path):
+            if not name.startswith(BACKUP_DIRECTORY):
+                continue
+            member = path + ":" + name
+            try:
+                definition = apply.parse_definition(member, text)
+                loaded.append((member, definition, None))
+            except apply.DefinitionError as exc:
+                loaded.append((member, None, str(exc)))
+    except READ_ERRORS as exc:
+        return {}, [path + ": " + str(exc)]
+    return apply.collect_definitions(loaded)
+
+
+# Server settings stored in an archive, None if there are none
+def read_settings(path):
+    try:
+        for name, text in read_members(path):
+            if name in ["serversettings.yml", "serversettings.json"]:
+                return yaml.safe_load(text)
+    except READ_ERRORS as exc:
+        raise ValueError(path + ": " + str(exc))
+    return None
+
+
+# Create the backups stored in an archive
+def create(data, path, import_meta=None, jobs=4):
+    definitions, errors = load_definitions(path)
+    apply.create_all(data, definitions, errors, path, import_meta, jobs)
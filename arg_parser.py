@@ -2,9 +2,19 @@ import argparse as ap
 
 # Initialize argument parser and standard optional arguments
 parser = ap.ArgumentParser()
+message = "record spans of the command and its requests and print a summary"
+parser.add_argument('--trace', action='store_true', help=message)
+message = "trace file, defaults to traces/ in the config directory"
+parser.add_argument('--trace-file', metavar='', help=message)
+message = "profile the command's CPU time or memory and write a report"
+parser.add_argument('--profile', choices=["cpu", "mem"], help=message)
+message = "profile file name without extension, defaults to profiles/ in "
+message += "the config directory"
+parser.add_argument('--profile-file', metavar='', help=message)
 
 # Create subparsers
-subparsers = parser.add_subparsers(title='commands', metavar="", help="")
+subparsers = parser.add_subparsers(title='commands', metavar="", help="",
+                                   dest="method")
 
 # Subparser for the List method
 message = "list all resources of a given type"
@@ -26,8 +36,8 @@ get_parser = subparsers.add_parser('get', help=message)
 message = "the type of resource"
 choices = ["backup", "notification"]
 get_parser.add_argument('type', choices=choices, help=message)
-message = "one or more ID's to look up"
-get_parser.add_argument('id', nargs='+', type=int, help=message)
+message = "one or more ID's, ID ranges, names, or tag:name selectors"
+get_parser.add_argument('id', nargs='+', help=message)
 
 # Subparser for the Describe method
 message = "display detailed information on a specific resource"
@@ -38,14 +48,15 @@ choices = [
     "notification"
 ]
 describe_parser.add_argument('type', choices=choices, help=message)
-message = "the ID of the resource to look up"
-describe_parser.add_argument('id', nargs='+', type=int, help=message)
+message = "one or more ID's, ID ranges, names, or tag:name selectors"
+describe_parser.add_argument('id', nargs='+', help=message)
 
 # Subparser for the set method
 message = "set values on resources"
 set_parser = subparsers.add_parser('set', help=message)
 message = "control password protection of the server"
-set_subparser = set_parser.add_subparsers(title='set', metavar="", help="")
+set_subparser = set_parser.add_subparsers(title='set', metavar="", help="",
+                                          dest="resource")
 message = "set or disable the server password"
 set_pwd_parser = set_subparser.add_parser('password', help=message)
 message = "disable the server password"
@@ -59,8 +70,8 @@ set_pwd_parser.add_argument('--script', action='store_false', help=message)
 # Subparser for the Run method
 message = "run a backup job"
 run_parser = subparsers.add_parser('run', help=message)
-message = "the ID of the backup job to run"
-run_parser.add_argument('id', type=int, help=message)
+message = "the ID's, names, or tag:name selectors of the backups to run"
+run_parser.add_argument('id', nargs='+', help=message)
 
 # Subparser for the Abort method
 message = "abort a task"
@@ -78,13 +89,20 @@ create_parser.add_argument('import-file', nargs='?', help=message)
 message = "import the metadata when creating a backup"
 create_parser.add_argument('--import-metadata', help=message,
                            action='store_true')
+message = "create a backup from every YAML or JSON file in a directory"
+create_parser.add_argument('--from-dir', metavar='', help=message)
+message = "create the backups stored in an archive made by export --archive"
+create_parser.add_argument('--from-archive', metavar='', help=message)
+message = "number of backups created at the same time, defaults to 4"
+create_parser.add_argument('--jobs', type=int, metavar='', default=4,
+                           help=message)
 
 # Subparser for the Update method
 message = "update a resource on the server from a YAMl or JSON file"
 update_parser = subparsers.add_parser('update', help=message)
 message = "the type of resource"
 update_parser.add_argument('type', choices=["backup"], help=message)
-message = "the ID of the resource to update"
+message = "the ID or name of the resource to update"
 update_parser.add_argument('id', help=message)
 message = "file containing a job configuration in YAML or JSON format"
 update_parser.add_argument('import-file', nargs='?', help=message)
@@ -98,8 +116,8 @@ delete_parser = subparsers.add_parser('delete', help=message)
 choices = ["backup", "notification", "database"]
 message = "the type of resource"
 delete_parser.add_argument('type', choices=choices, help=message)
-message = "the ID of the resource to delete"
-delete_parser.add_argument('id', type=int, help=message)
+message = "the ID's, names, or tag:name selectors of the resources to delete"
+delete_parser.add_argument('id', nargs='+', help=message)
 # message = "delete the local database"
 # delete_parser.add_argument('--delete-db',
 #                            action='store_true', help=message)
@@ -124,8 +142,8 @@ export_parser = subparsers.add_parser('export', help=message)
 choices = ["backup", "serversettings"]
 message = "the type of resource"
 export_parser.add_argument('type', choices=choices, help=message)
-message = "the ID of the resource to export"
-export_parser.add_argument('id', action='store', nargs='?', type=int, help=message)
+message = "the ID's, names, or tag:name selectors of the resources to export"
+export_parser.add_argument('id', action='store', nargs='*', help=message)
 message = "export all backups"
 export_parser.add_argument('--all', action='store_true', help=message)
 message = "timestamp the exported file"
@@ -141,24 +159,74 @@ export_parser.add_argument('--output', help=message,
                            choices=choices, metavar='')
 message = "Path to output the file at"
 export_parser.add_argument('--output-path', metavar='', help=message)
+message = "write the backups and server settings to one .tar, .tar.gz, "
+message += ".tar.zst or .zip archive"
+export_parser.add_argument('--archive', metavar='', help=message)
+
+# Subparser for the Apply method
+message = "make the backups on the server match a directory of definitions"
+apply_parser = subparsers.add_parser('apply', help=message)
+message = "directory with one YAML or JSON backup configuration per file"
+apply_parser.add_argument('directory', help=message)
+message = "print the changes without making them"
+apply_parser.add_argument('--dry-run', action='store_true', help=message)
+message = "delete backups that have no definition"
+apply_parser.add_argument('--delete', action='store_true', help=message)
+message = "number of changes made at the same time, defaults to 4"
+apply_parser.add_argument('--jobs', type=int, metavar='', default=4,
+                          help=message)
+
+# Subparser for the Drift method
+message = "compare the backups and settings of all servers in the inventory"
+drift_parser = subparsers.add_parser('drift', help=message)
+message = "inventory file, defaults to inventory.yml in the config directory"
+drift_parser.add_argument('--inventory', metavar='', help=message)
+message = "fetch every server even if it didn't change since the last scan"
+drift_parser.add_argument('--refresh', action='store_true', help=message)
+
+# Subparser for the Snapshot method
+message = "store changed backup configurations in a local snapshot store"
+snapshot_parser = subparsers.add_parser('snapshot', help=message)
+message = "list the snapshots of the server"
+snapshot_parser.add_argument('--list', action='store_true', help=message)
+message = "show what changed since a snapshot, a name or time prefix"
+snapshot_parser.add_argument('--since', metavar='', help=message)
+message = "snapshot store, defaults to snapshots/ in the config directory"
+snapshot_parser.add_argument('--store', metavar='', help=message)
+
+# Subparser for the Settings method
+message = "change the server settings of one or many servers"
+settings_parser = subparsers.add_parser('settings', help=message)
+settings_subparser = settings_parser.add_subparsers(title='settings',
+                                                    metavar="", help="",
+                                                    dest="action")
+message = "change the settings that differ from a file on every server"
+settings_apply_parser = settings_subparser.add_parser('apply', help=message)
+message = "YAML or JSON file of settings, or an archive made by export"
+settings_apply_parser.add_argument('file', help=message)
+message = "inventory file, defaults to inventory.yml in the config directory"
+settings_apply_parser.add_argument('--inventory', metavar='', help=message)
+message = "show the settings that would change without changing them"
+settings_apply_parser.add_argument('--dry-run', action='store_true',
+                                   help=message)
 
 # Subparser for the Repair method
 message = "repair a database"
 repair_parser = subparsers.add_parser('repair', help=message)
-message = "backup database to repair"
-repair_parser.add_argument('id', help=message)
+message = "backup databases to repair"
+repair_parser.add_argument('id', nargs='+', help=message)
 
 # Subparser for the Verify method
 message = "verify remote backup data"
 repair_parser = subparsers.add_parser('verify', help=message)
-message = "backup to verify"
-repair_parser.add_argument('id', help=message)
+message = "backups to verify"
+repair_parser.add_argument('id', nargs='+', help=message)
 
 # Subparser for the Compact method
 message = "compact remote backup data"
 repair_parser = subparsers.add_parser('compact', help=message)
-message = "backup to compact"
-repair_parser.add_argument('id', help=message)
+message = "backups to compact"
+repair_parser.add_argument('id', nargs='+', help=message)
 
 
 # Subparser for the Dismiss method
@@ -181,8 +249,8 @@ choices = [
 message = "backup, stored, profiling, information, warning, or error"
 logs_parser.add_argument('type', metavar='type',
                          choices=choices, help=message)
-message = "backup id"
-logs_parser.add_argument('--id', type=int, metavar='', help=message)
+message = "backup id or name"
+logs_parser.add_argument('--id', metavar='', help=message)
 message = "view backend logs for the backup job"
 logs_parser.add_argument('--remote', action='store_true', help=message)
 message = "periodically pool for new logs until interrupted"
@@ -230,8 +298,127 @@ config_parser.add_argument('--overwrite', action='store_true',
                            help=message)
 
 # Subparser for the Daemon mode
-# message = "run as a service"
-# subparsers.add_parser('daemon', help=message)
+message = "run as a service executing tasks from a task server"
+daemon_parser = subparsers.add_parser('daemon', help=message)
+message = "url of the task server, api/ is appended if missing"
+daemon_parser.add_argument('url', help=message)
+message = "seconds between polls of the task server, defaults to 10"
+daemon_parser.add_argument('--interval', type=float, metavar='', default=10,
+                           help=message)
+message = "number of tasks executed at the same time, defaults to 4"
+daemon_parser.add_argument('--jobs', type=int, metavar='', default=4,
+                           help=message)
+message = "task journal file, defaults to the config directory"
+daemon_parser.add_argument('--journal', metavar='', help=message)
+message = "policy file limiting the tasks accepted, defaults to "
+message += "daemon-policy.yml in the config directory"
+daemon_parser.add_argument('--policy', metavar='', help=message)
+
+# Subparser for the Prometheus exporter
+message = "serve metrics of the backups in the Prometheus text format"
+exporter_parser = subparsers.add_parser('exporter', help=message)
+message = "address to serve the metrics on, defaults to 127.0.0.1:9874"
+exporter_parser.add_argument('--listen', metavar='', default="127.0.0.1:9874",
+                             help=message)
+message = "seconds between polls of the servers, defaults to 30"
+exporter_parser.add_argument('--interval', type=float, metavar='', default=30,
+                             help=message)
+message = "inventory file, defaults to inventory.yml in the config directory"
+exporter_parser.add_argument('--inventory', metavar='', help=message)
+
+# Subparser for the latency probe
+message = "measure the latency of the server API over rolling windows"
+probe_parser = subparsers.add_parser('probe', help=message)
+choices = ["systeminfo", "progressstate", "backups", "log"]
+message = "endpoint to probe, repeat for several, defaults to all"
+probe_parser.add_argument('--endpoint', action='append', choices=choices,
+                          metavar='', help=message)
+message = "requests per second to every endpoint, defaults to 1"
+probe_parser.add_argument('--rate', type=float, metavar='', default=1,
+                          help=message)
+message = "seconds between reports, defaults to 10"
+probe_parser.add_argument('--interval', type=float, metavar='', default=10,
+                          help=message)
+message = "seconds of requests every report covers, defaults to 60"
+probe_parser.add_argument('--window', type=float, metavar='', default=60,
+                          help=message)
+message = "seconds to probe for, defaults to until interrupted"
+probe_parser.add_argument('--duration', type=float, metavar='', help=message)
+message = "file the NDJSON reports are appended to, - for stdout"
+probe_parser.add_argument('--output', metavar='', help=message)
+message = "99th percentile in milliseconds a report must stay below"
+probe_parser.add_argument('--slo-p99', type=float, metavar='', help=message)
+message = "share of failed requests a report must stay below, e.g. 0.01"
+probe_parser.add_argument('--slo-errors', type=float, metavar='',
+                          help=message)
+message = "inventory file, defaults to inventory.yml in the config directory"
+probe_parser.add_argument('--inventory', metavar='', help=message)
+
+# Subparser for the event stream
+message = "stream backup state changes as NDJSON events and to webhooks"
+events_parser = subparsers.add_parser('events', help=message)
+message = "seconds between polls of the servers, defaults to 5"
+events_parser.add_argument('--interval', type=float, metavar='', default=5,
+                           help=message)
+message = "URL the events are posted to in batches, repeat for several"
+events_parser.add_argument('--webhook', action='append', metavar='',
+                           help=message)
+choices = ["started", "phase-changed", "completed", "failed",
+           "notification-raised"]
+message = "event to emit, repeat for several, defaults to all"
+events_parser.add_argument('--event', action='append', choices=choices,
+                           metavar='', help=message)
+message = "seconds to watch for, defaults to until interrupted"
+events_parser.add_argument('--duration', type=float, metavar='',
+                           help=message)
+message = "inventory file, defaults to inventory.yml in the config directory"
+events_parser.add_argument('--inventory', metavar='', help=message)
+
+# Subparser for the live progress view
+message = "show the progress of running and queued backups live"
+top_parser = subparsers.add_parser('top', help=message)
+message = "seconds between polls of the servers, defaults to 2"
+top_parser.add_argument('--interval', type=float, metavar='', default=2,
+                        help=message)
+message = "print the progress once as a table and exit"
+top_parser.add_argument('--once', action='store_true', help=message)
+message = "inventory file, defaults to inventory.yml in the config directory"
+top_parser.add_argument('--inventory', metavar='', help=message)
+
+# Subparser for the interactive shell
+message = "start an interactive shell keeping the session open"
+subparsers.add_parser('shell', help=message)
+
+# Subparser for running many commands from a file
+message = "run commands from a file, in parallel, over one session"
+batch_parser = subparsers.add_parser('batch', help=message)
+message = "file with one command per line, or - to read from stdin"
+batch_parser.add_argument('file', help=message)
+message = "number of commands running at the same time, defaults to 4"
+batch_parser.add_argument('--jobs', type=int, metavar='', default=4,
+                          help=message)
+
+# Subparser for generating shell completion scripts
+message = "print a completion script for bash, zsh, or fish"
+completion_parser = subparsers.add_parser('completion', help=message)
+choices = ["bash", "zsh", "fish"]
+message = "the shell to generate the completion script for"
+completion_parser.add_argument('shell', choices=choices, help=message)
+message = "name of the command to complete, defaults to duc"
+completion_parser.add_argument('--prog', metavar='', default='duc',
+                               help=message)
+
+# Hidden subparser serving dynamic completions from the local cache
+complete_parser = subparsers.add_parser('complete')
+choices = [
+    "backups",
+    "backup-ids",
+    "backup-names",
+    "notifications",
+    "log-types"
+]
+complete_parser.add_argument('kind', nargs='?', choices=choices)
+complete_parser.add_argument('--refresh', action='store_true')
 
 # Subparser for toggling verbose mode
 message = "change between normal and verbose mode"
@@ -0,0 +1,196 @@
+# Module for the asyncio client
+# AsyncDuplicatiClient lets one event loop drive many Duplicati servers. It
+# is not asynchronous I/O: every call runs the blocking DuplicatiClient on a
+# thread, and the coroutines only wait for it. All servers share one thread
+# pool of at most MAX_THREADS threads, so watching hundreds of servers costs
+# no more threads than watching a few dozen, while every server keeps its
+# own connection pool and a semaphore of host_limit requests in flight.
+# Calls beyond the free threads wait in the queue of the pool.
+# Cancelling a task stops waiting for the call at once, but a thread can't
+# be interrupted: the request ends within the request timeout of
+# requests_wrapper and keeps its thread and its slot of the server until
+# then.
+# usage:
+# async with AsyncDuplicatiClient(data, password="secret") as server:
+#     backups = await server.list_backups()
+#     await server.run(backups[0].id)
+import asyncio
+import client
+import datetime
+import functools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Requests in flight per server unless configured otherwise
+HOST_LIMIT = 4
+
+# Threads shared by the blocking calls of all clients
+MAX_THREADS = 32
+
+# The shared thread pool, created on first use
+shared_pool = None
+shared_pool_lock = threading.Lock()
+
+
+# Thread pool shared by all clients that aren't given one
+def shared_executor():
+    global shared_pool
+    with shared_pool_lock:
+        if shared_pool is None:
+            shared_pool = ThreadPoolExecutor(max_workers=MAX_THREADS)
+        return shared_pool
+
+
+# Asyncio client for a single Duplicati server
+# data is the configuration as stored by the CLI, see client.DuplicatiClient
+class AsyncDuplicatiClient(object):
+    def __init__(self, data, password=None, host_limit=HOST_LIMIT,
+                 executor=None, cache_ttl=0):
+        # Size the connection pool to the number of requests in flight
+        # Logging in is left to this class so it happens once per server
+        self.client = client.pooled_client(data, host_limit, cache_ttl,
+                                           password=password, relogin=False)
+        # The shared threads, unless the caller passes an executor
+        self.executor = executor or shared_executor()
+        self.host_limit = host_limit
+        # Created on first use, older Pythons bind them to the current loop
+        self.semaphore = None
+        self.login_lock = None
+
+    # Create a client from the CLI config file, reusing its login
+    @classmethod
+    def from_config(cls, path=None, **kwargs):
+        duplicati = client.DuplicatiClient.from_config(path)
+        return cls(duplicati.data, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.close()
+
+    @property
+    def data(self):
+        return self.client.data
+
+    # Close the pooled connections, the threads are shared and stay
+    def close(self):
+        self.client.http.session.close()
+
+    # Run a blocking call on the thread pool
+    async def run_blocking(self, function, *args):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(function, *args)
+        return await loop.run_in_executor(self.executor, call)
+
+    # Create the semaphore and lock inside the running loop
+    def setup(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.host_limit)
+            self.login_lock = asyncio.Lock()
+
+    # Call a method of the blocking client within the limit of the server
+    async def call(self, name, *args):
+        self.setup()
+        await self.semaphore.acquire()
+        try:
+            await self.ensure_login()
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+        loop = asyncio.get_running_loop()
+        call = functools.partial(getattr(self.client, name), *args)
+        future = loop.run_in_executor(self.executor, call)
+        # A cancelled caller leaves the thread running, which keeps the
+        # thread and the slot of the server until the request ends
+        future.add_done_callback(lambda _: self.semaphore.release())
+        return await asyncio.shield(future)
+
+    # Whether the current token can still be used
+    def logged_in(self):
+        expires = self.data.get("token_expires", None)
+        if self.data.get("token", None) is None or expires is None:
+            return False
+        return datetime.datetime.now() < expires
+
+    # Log in once when the token expired, concurrent calls wait for it
+    async def ensure_login(self):
+        if self.logged_in() or self.client.password is None:
+            return
+        async with self.login_lock:
+            if not self.logged_in():
+                await self.run_blocking(self.client.login)
+
+    # Log in, e.g. with a password that wasn't given to the constructor
+    async def login(self, password=None):
+        self.setup()
+        async with self.login_lock:
+            await self.run_blocking(self.client.login, password)
+
+    async def list_backups(self):
+        return await self.call("list_backups")
+
+    async def get_backup(self, backup_id):
+        return await self.call("get_backup", backup_id)
+
+    # Several backups, fetched concurrently within the limit of the server
+    async def get_backups(self, backup_ids):
+        progress = await self.progress_state()
+        calls = [self.call("get_backup", backup_id, progress)
+                 for backup_id in backup_ids]
+        return list(await asyncio.gather(*calls))
+
+    async def progress_state(self):
+        return await self.call("progress_state")
+
+    async def logs(self, log_type, backup_id=None, remote=False,
+                   page_size=5):
+        return await self.call("logs", log_type, backup_id, remote,
+                               page_size)
+
+    async def run(self, backup_id):
+        return await self.call("run", backup_id)
+
+    async def abort(self, task_id):
+        return await self.call("abort", task_id)
+
+    async def list_notifications(self):
+        return await self.call("list_notifications")
+
+    async def get_notifications(self, notification_ids):
+        return await self.call("get_notifications", notification_ids)
+
+    async def dismiss(self, notification_id):
+        return await self.call("dismiss", notification_id)
+
+    # Dismiss all notifications, returning the number dismissed
+    async def dismiss_all(self):
+        notifications = await self.list_notifications()
+        calls = [self.dismiss(notification.id)
+                 for notification in notifications]
+        await asyncio.gather(*calls)
+        return len(notifications)
+
+    async def export(self, backup_id):
+        return await self.call("export", backup_id)
+
+    async def list_resource(self, resource):
+        return await self.call("list_resource", resource)
+
+    async def server_settings(self):
+        return await self.call("server_settings")
+
+    async def server_state(self):
+        return await self.call("server_state")
+
+    async def update_server_settings(self, changes):
+        return await self.call("update_server_settings", changes)
+
+    # Yield the progress state every interval seconds until cancelled
+    # None is yielded while the server is idle
+    async def watch(self, interval=5):
+        while True:
+            yield await self.progress_state()
+            await asyncio.sleep(interval)
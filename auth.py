@@ -9,6 +9,7 @@ import json
 import random
 import re
 import sys
+import tracing
 
 from os.path import expanduser
 from requests_wrapper import requests_wrapper as requests
@@ -18,6 +19,7 @@ ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ+/"
 
 
 # Login by authenticating against the Duplicati API and extracting a token
+@tracing.traced("login")
 def login(data, input_url=None, password=None, verify=True,
           interactive=True, basic_user=None, basic_pass=None):
     if input_url is None:
@@ -60,101 +62,36 @@ def login(data, input_url=None, password=None, verify=True,
     # Make the login attempt
     baseurl = common.create_baseurl(data, "")
     common.log_output("Connecting to " + baseurl + "...", False)
-    r = requests.get(baseurl, allow_redirects=True, verify=verify)
-    common.check_response(data, r.status_code)
+    token = None
+    headers = None
+    try:
+        try:
+            token = handshake(data, password, verify)
+        except BasicAuthRequired:
+            common.log_output('Basic authentication required...', False)
+            basic_auth = prompt_basic_auth(password, interactive, basic_user,
+                                           basic_pass)
+            headers = {"Authorization": basic_auth}
+            data['authorization'] = basic_auth
+        except PasswordRequired:
+            password = prompt_password(None, interactive)
+
+        # Try again with the credentials the server asked for
+        if token is None:
+            try:
+                token = handshake(data, password, verify, headers)
+            except PasswordRequired:
+                password = prompt_password(None, interactive)
+                token = handshake(data, password, verify, headers)
+    except LoginError as error:
+        common.check_response(data, error.status_code)
+        common.log_output(error.message, True, error.status_code)
+        sys.exit(2)
 
     # Detect if we were redirected to https
-    if "https://" in r.url and protocol != "https":
-        data["server"]["protocol"] = "https"
+    if data["server"]["protocol"] != protocol:
         common.log_output("Redirected from http to https", True)
 
-    # Detect if we're prompted for basic authentication
-    auth_method = r.headers.get('WWW-Authenticate', False)
-    if (auth_method):
-        common.log_output('Basic authentication required...', False)
-        if basic_user is None and interactive:
-            basic_user = input('Basic username: ')
-        elif basic_user is None and not interactive:
-            message = 'You must provide a basic auth username, --basic-user'
-            common.log_output(message, True)
-            sys.exit(2)
-
-        if basic_pass is None and interactive:
-            basic_pass = getpass.getpass('Basic password:')
-        elif basic_pass is None and password is not None:
-            basic_pass = password
-        elif basic_pass and password:
-            pass
-        else:
-            common.log_output("A password is required required", True)
-            sys.exit(2)
-
-        # Create the basic auth secret
-        secret = base64.b64encode((basic_user+":"+basic_pass).encode('ascii'))
-        # Create the authorization string
-        basic_auth = "Basic " + secret.decode('utf-8')
-        headers = {"Authorization": basic_auth}
-        r = requests.get(baseurl, verify=verify, headers=headers,
-                         allow_redirects=True)
-        common.check_response(data, r.status_code)
-        if r.status_code == 200:
-            common.log_output('Passed basic auth', False)
-            # Update basic auth secret in config file
-            data['authorization'] = basic_auth
-
-    # Detect if we were prompted to login
-    login_redirect = "/login.html" in r.url
-
-    if r.status_code == 200 and not login_redirect:
-        common.log_output("OK", False, r.status_code)
-        token = compatibility.unquote(r.cookies["xsrf-token"])
-    elif r.status_code == 200 and login_redirect:
-        password = prompt_password(password, interactive)
-
-        common.log_output("Getting nonce and salt...", False)
-        baseurl = common.create_baseurl(data, "/login.cgi")
-        headers = common.create_headers(data)
-        payload = {'get-nonce': 1}
-        r = requests.post(baseurl, headers=headers, data=payload,
-                          verify=verify)
-        if r.status_code != 200:
-            common.log_output("Error getting salt from server", True,
-                              r.status_code)
-            sys.exit(2)
-
-        salt = r.json()["Salt"]
-        data["nonce"] = compatibility.unquote(r.json()["Nonce"])
-        token = compatibility.unquote(r.cookies["xsrf-token"])
-        common.log_output("Hashing password...", False)
-        salt_password = password.encode() + base64.b64decode(salt)
-        saltedpwd = hashlib.sha256(salt_password).digest()
-        nonce_password = base64.b64decode(data["nonce"]) + saltedpwd
-        noncedpwd = hashlib.sha256(nonce_password).digest()
-
-        common.log_output("Authenticating... ", False)
-        payload = {
-            "password": base64.b64encode(noncedpwd).decode('utf-8')
-        }
-        cookies = {
-            "xsrf-token": token,
-            "session-nonce": data.get("nonce", "")
-        }
-        r = requests.post(baseurl, headers=headers, data=payload,
-                          cookies=cookies, verify=verify)
-        common.check_response(data, r.status_code)
-        if r.status_code == 200:
-            common.log_output("Connected", False, r.status_code)
-            data["session-auth"] = compatibility.unquote(
-                                        r.cookies["session-auth"])
-        else:
-            message = "Error authenticating against the server"
-            common.log_output(message, True, r.status_code)
-            sys.exit(2)
-    else:
-        message = "Error connecting to server"
-        common.log_output(message, True, r.status_code)
-        sys.exit(2)
-
     # Update the config file with provided values
     data["token"] = token
     expiration = datetime.datetime.now() + datetime.timedelta(0, 600)
@@ -165,6 +102,95 @@ def login(data, input_url=None, password=None, verify=True,
     return data
 
 
+# Raised by handshake when logging in failed
+class LoginError(Exception):
+    def __init__(self, message, status_code=None):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status_code = status_code
+
+
+# Raised by handshake when the server asks for basic authentication
+class BasicAuthRequired(LoginError):
+    pass
+
+
+# Raised by handshake when the server asks for a password and none was given
+class PasswordRequired(LoginError):
+    pass
+
+
+# Log in to the server in data without prompting and return the token
+# headers carry the basic authentication, and http is requests_wrapper or a
+# requests_wrapper.session_wrapper. Password logins store the nonce and
+# session-auth in data, and a redirect to https updates the protocol.
+def handshake(data, password=None, verify=True, headers=None, http=None):
+    if http is None:
+        http = requests
+    baseurl = common.create_baseurl(data, "")
+    r = http.get(baseurl, headers=headers, allow_redirects=True,
+                 verify=verify)
+
+    authorized = headers is not None and "Authorization" in headers
+    if getattr(r, "headers", {}).get('WWW-Authenticate', False) and \
+            not authorized:
+        raise BasicAuthRequired("Basic authentication required",
+                                r.status_code)
+    if r.status_code != 200:
+        raise LoginError("Error connecting to server", r.status_code)
+
+    # Detect if we were redirected to https
+    if "https://" in r.url:
+        data["server"]["protocol"] = "https"
+
+    # Servers without a password hand out a token right away
+    if "/login.html" not in r.url:
+        common.log_output("OK", False, r.status_code)
+        return compatibility.unquote(r.cookies["xsrf-token"])
+    if password is None:
+        raise PasswordRequired("A password is required", r.status_code)
+
+    common.log_output("Getting nonce and salt...", False)
+    baseurl = common.create_baseurl(data, "/login.cgi")
+    r = http.post(baseurl, headers=headers, data={'get-nonce': 1},
+                  verify=verify)
+    if r.status_code != 200:
+        raise LoginError("Error getting salt from server", r.status_code)
+
+    salt = r.json()["Salt"]
+    nonce = compatibility.unquote(r.json()["Nonce"])
+    token = compatibility.unquote(r.cookies["xsrf-token"])
+    common.log_output("Hashing password...", False)
+    payload = {
+        "password": hash_password(password, salt, nonce)
+    }
+    cookies = {
+        "xsrf-token": token,
+        "session-nonce": nonce
+    }
+
+    common.log_output("Authenticating... ", False)
+    r = http.post(baseurl, headers=headers, data=payload, cookies=cookies,
+                  verify=verify)
+    if r.status_code != 200:
+        message = "Error authenticating against the server"
+        raise LoginError(message, r.status_code)
+
+    common.log_output("Connected", False, r.status_code)
+    data["nonce"] = nonce
+    data["session-auth"] = compatibility.unquote(r.cookies["session-auth"])
+    return token
+
+
+# Hash a password with the salt and nonce of the login handshake
+def hash_password(password, salt, nonce):
+    salt_password = password.encode() + base64.b64decode(salt)
+    saltedpwd = hashlib.sha256(salt_password).digest()
+    nonce_password = base64.b64decode(nonce) + saltedpwd
+    noncedpwd = hashlib.sha256(nonce_password).digest()
+    return base64.b64encode(noncedpwd).decode('utf-8')
+
+
 # Logout by deleting the token from memory and disk
 def logout(data):
     common.log_output("Logging out...", True)
@@ -229,6 +255,32 @@ def determine_ssl_validation(data, certfile=None, insecure=False):
     return data["server"]["verify"]
 
 
+# Get the basic authentication header, prompting for missing credentials
+def prompt_basic_auth(password, interactive, basic_user=None,
+                      basic_pass=None):
+    if basic_user is None and interactive:
+        basic_user = input('Basic username: ')
+    elif basic_user is None and not interactive:
+        message = 'You must provide a basic auth username, --basic-user'
+        common.log_output(message, True)
+        sys.exit(2)
+
+    if basic_pass is None and interactive:
+        basic_pass = getpass.getpass('Basic password:')
+    elif basic_pass is None and password is not None:
+        basic_pass = password
+    elif basic_pass and password:
+        pass
+    else:
+        common.log_output("A password is required required", True)
+        sys.exit(2)
+
+    # Create the basic auth secret
+    secret = base64.b64encode((basic_user+":"+basic_pass).encode('ascii'))
+    # Create the authorization string
+    return "Basic " + secret.decode('utf-8')
+
+
 # Get password by prompting user if no password was given in-line
 def prompt_password(password, interactive):
     if password is None and interactive:
@@ -0,0 +1,188 @@
+# Module for running many commands in a single process
+# Commands are read from a file or stdin, either in the CLI syntax or as
+# NDJSON objects, and run over one pooled session. Commands run in parallel
+# unless the file orders them with a "---" line or "wait": true, and every
+# command produces one JSON result record with its status and timing.
+import arg_parser
+import common
+import contextlib
+import io
+import json
+import requests
+import requests_wrapper
+import shlex
+import sys
+import timeit
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Line separating groups of commands that must run one after the other
+BARRIER = "---"
+
+# Commands that cannot be run from a batch
+UNSUPPORTED_COMMANDS = ["shell", "batch", "daemon", "exporter", "probe",
+                        "top", "events"]
+
+
+# A single command read from the batch file
+class Command(object):
+    __slots__ = ("number", "id", "text", "words", "args", "error", "wait")
+
+    def __init__(self, number, text, words, command_id=None):
+        self.number = number
+        self.id = command_id
+        self.text = text
+        self.words = words
+        self.args = None
+        self.error = None
+        self.wait = False
+
+
+# Run a batch file and print one result record per command
+def run(data, run_command, source, jobs=4):
+    if source == "-":
+        groups = read_commands(sys.stdin)
+    else:
+        try:
+            with open(source, 'r') as file_handle:
+                groups = read_commands(file_handle)
+        except (IOError, OSError) as exc:
+            common.log_output(exc, True)
+            sys.exit(2)
+
+    jobs = max(1, jobs)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs,
+                                            pool_maxsize=jobs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    requests_wrapper.use_session(session)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for group in groups:
+            futures = []
+            for command in group:
+                futures.append(executor.submit(execute, data, command,
+                                               run_command))
+            # Records are printed in the order of the file
+            for future in futures:
+                record = future.result()
+                if record["status"] != "ok":
+                    failed += 1
+                sys.stdout.write(json.dumps(record, default=str) + "\n")
+                sys.stdout.flush()
+
+    if failed > 0:
+        sys.exit(2)
+    return data
+
+
+# Read commands and split them into groups that run in sequence
+def read_commands(lines):
+    groups = [[]]
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        if line == BARRIER:
+            groups.append([])
+            continue
+
+        command = parse_line(number, line)
+        # A waiting command runs alone, after everything before it
+        if command.wait:
+            groups.append([command])
+            groups.append([])
+        else:
+            groups[-1].append(command)
+
+    return [group for group in groups if len(group) > 0]
+
+
+# Parse a line in the CLI syntax or an NDJSON object
+# NDJSON objects contain either "command" with a CLI string or "args" with a
+# list of arguments, and optionally an "id" and "wait"
+def parse_line(number, line):
+    command_id = None
+    wait = False
+    try:
+        if line.startswith("{"):
+            item = json.loads(line)
+            command_id = item.get("id", None)
+            wait = item.get("wait", False)
+            if "args" in item:
+                words = [str(word) for word in item["args"]]
+                text = " ".join(words)
+            else:
+                text = item.get("command", "")
+                words = shlex.split(text)
+        else:
+            text = line
+            words = shlex.split(line)
+    except (ValueError, AttributeError, TypeError) as exc:
+        command = Command(number, line, [])
+        command.error = "Invalid command: " + str(exc)
+        return command
+
+    # Allow lines copied from scripts calling duc
+    if len(words) > 0 and words[0] in ["duc", "duplicati_client"]:
+        words = words[1:]
+
+    command = Command(number, text, words, command_id)
+    command.wait = bool(wait)
+    if len(words) == 0:
+        command.error = "Empty command"
+        return command
+
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(stderr):
+            command.args = vars(arg_parser.parser.parse_args(words))
+    except SystemExit:
+        command.error = stderr.getvalue().strip().split("\n")[-1]
+        return command
+
+    if command.args.get("method", None) in UNSUPPORTED_COMMANDS:
+        command.error = "Command not supported in batches"
+    return command
+
+
+# Execute a command and create its result record
+def execute(data, command, run_command):
+    record = {
+        "line": command.number,
+        "command": command.text,
+    }
+    if command.id is not None:
+        record["id"] = command.id
+
+    if command.error is not None:
+        record.update({"status": "error", "code": 2, "http_status": None,
+                       "duration": 0.0, "output": command.error})
+        return record
+
+    method = command.args.get("method", None)
+    code = 0
+    start = timeit.default_timer()
+    common.start_capture()
+    try:
+        run_command(data, method, dict(command.args))
+    except SystemExit as exc:
+        code = exc.code if isinstance(exc.code, int) else 2
+    except Exception as exc:
+        common.log_output(repr(exc), True)
+        code = 2
+    finally:
+        output, http_status = common.stop_capture()
+    duration = timeit.default_timer() - start
+
+    ok = code == 0 and (http_status is None or http_status < 400)
+    record.update({
+        "status": "ok" if ok else "error",
+        "code": code,
+        "http_status": http_status,
+        "duration": round(duration, 6),
+        "output": output
+    })
+    return record
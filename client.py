@@ -0,0 +1,442 @@
+# Module for the embeddable Python client
+# DuplicatiClient talks to the Duplicati API for other Python programs. Its
+# methods return models or plain dictionaries and raise DuplicatiError
+# instead of printing messages and exiting, which is left to the CLI.
+# usage:
+# from client import DuplicatiClient
+# client = DuplicatiClient.from_config()
+# for backup in client.list_backups():
+#     print(backup.name)
+import auth
+import common
+import compatibility
+import config
+import datetime
+import json
+import models
+import requests
+import requests_wrapper
+import streaming
+import tracing
+import yaml
+
+# Seconds the server keeps a session alive after the last request
+TOKEN_LIFETIME = 600
+
+
+# Base class for errors raised by the client
+class DuplicatiError(Exception):
+    def __init__(self, message, status_code=None):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status_code = status_code
+
+
+# Raised when not logged in or the server refused the session
+class AuthenticationError(DuplicatiError):
+    pass
+
+
+# Raised when a resource doesn't exist on the server
+class NotFoundError(DuplicatiError):
+    pass
+
+
+# Errors for the status codes requests_wrapper uses for failed connections
+CONNECTION_ERRORS = {
+    400: "The server refused the request, you may need to login again",
+    408: "The request timed out. Is the server running?",
+    495: "Provided certificate is invalid or does not match the server "
+         "certificate",
+    503: "Server is not responding. Is it running?",
+    526: "Server certificate could not be validated. You can specify a "
+         "certificate with --certfile or explicitly ignore this error with "
+         "--insecure",
+}
+
+
+# Decode the JSON body of a response
+def decode(r):
+    with tracing.span("decode json"):
+        return r.json()
+
+
+# Client for a single Duplicati server
+# data is the configuration as stored by the CLI, http is either a
+# requests_wrapper.session_wrapper or the requests_wrapper class itself.
+# With persist set, token renewals are written to the config file, and with
+# relogin set an expired token is replaced by logging in again.
+class DuplicatiClient(object):
+    def __init__(self, data, http=None, persist=False, password=None,
+                 relogin=True, cache_ttl=5):
+        self.data = data
+        if http is None:
+            http = requests_wrapper.session_wrapper(cache_ttl=cache_ttl)
+        self.http = http
+        self.persist = persist
+        self.password = password
+        self.relogin = relogin
+
+    # Create a client from the CLI config file, reusing its login
+    @classmethod
+    def from_config(cls, path=None, **kwargs):
+        if path is None:
+            path = compatibility.get_config_location()
+        try:
+            with open(path, 'r') as file_handle:
+                data = yaml.safe_load(file_handle)
+        except (IOError, OSError, yaml.YAMLError) as exc:
+            raise DuplicatiError("Could not load " + path + ": " + str(exc))
+        if not isinstance(data, dict) or "server" not in data:
+            raise DuplicatiError("Configuration appears to be invalid")
+        # Logins triggered by the client update the same config file
+        config.CONFIG_FILE = path
+        return cls(data, **kwargs)
+
+    @property
+    def verify(self):
+        return self.data.get("server", {}).get("verify", True)
+
+    # Drop cached responses, e.g. after the server was changed elsewhere
+    def clear_cache(self):
+        if hasattr(self.http, "clear_cache"):
+            self.http.clear_cache()
+
+    # Log in with the stored server settings, e.g. after the token expired
+    # Unlike auth.login this never prompts and only writes the config file
+    # with persist set
+    @tracing.traced("login")
+    def login(self, password=None):
+        if password is None:
+            password = self.password
+        # A cached response would carry the previous token
+        self.clear_cache()
+
+        headers = None
+        if self.data.get("authorization", ""):
+            headers = {"Authorization": self.data["authorization"]}
+        try:
+            token = auth.handshake(self.data, password, self.verify, headers,
+                                   self.http)
+        except auth.LoginError as error:
+            self.check_connection(error.status_code)
+            raise AuthenticationError(error.message, error.status_code)
+
+        now = datetime.datetime.now()
+        expiration = now + datetime.timedelta(0, TOKEN_LIFETIME)
+        self.data["token"] = token
+        self.data["token_expires"] = expiration
+        self.data["last_login"] = now
+        if self.persist:
+            common.write_config(self.data)
+
+    # Make sure there is a valid token, logging in again when it expired
+    def ensure_login(self):
+        token = self.data.get("token", None)
+        expires = self.data.get("token_expires", None)
+        if token is None or expires is None:
+            raise AuthenticationError("Not logged in")
+        if datetime.datetime.now() < expires:
+            return
+        if not self.relogin:
+            raise AuthenticationError("Token expired")
+        self.login()
+
+    # Make an authenticated request against the API
+    def request(self, method, path, params=None, payload=None, files=None,
+                stream=False, append_token=False):
+        self.ensure_login()
+        baseurl = common.create_baseurl(self.data, path, append_token)
+        kwargs = {
+            "cookies": common.create_cookies(self.data),
+            "verify": self.verify
+        }
+        # Uploads authenticate with the token in the URL instead
+        if not append_token:
+            kwargs["headers"] = common.create_headers(self.data)
+        if params is not None:
+            kwargs["params"] = params
+        if payload is not None:
+            kwargs["data"] = payload
+        if files is not None:
+            kwargs["files"] = files
+        if method == "get":
+            kwargs["stream"] = stream
+
+        r = getattr(self.http, method)(baseurl, **kwargs)
+        self.check_status(r.status_code)
+        return r
+
+    # Raise errors for the status codes of failed connections
+    def check_connection(self, status_code):
+        message = CONNECTION_ERRORS.get(status_code, None)
+        if status_code == 400:
+            raise AuthenticationError(message, status_code)
+        if message is not None:
+            raise DuplicatiError(message, status_code)
+
+    # Raise errors for failed connections and renew the token on success
+    def check_status(self, status_code):
+        self.check_connection(status_code)
+        if status_code == 200:
+            expiration = datetime.datetime.now()
+            expiration += datetime.timedelta(0, TOKEN_LIFETIME)
+            self.data["token_expires"] = expiration
+            if self.persist:
+                common.write_config(self.data)
+
+    # Raise an error with the given message unless the request succeeded
+    def raise_for_status(self, r, message):
+        if r.status_code == 200:
+            return
+        if r.status_code == 404:
+            raise NotFoundError(message, r.status_code)
+        raise DuplicatiError(message, r.status_code)
+
+    # List all resources of a type, e.g. "backups" or "serversettings"
+    # With stream set the result is an iterator decoding items on demand
+    def list_resource(self, resource, stream=False):
+        stream = stream and streaming.available()
+        r = self.request("get", "/api/v1/" + resource, stream=stream)
+        if r.status_code == 404:
+            raise NotFoundError("No entries found", r.status_code)
+        self.raise_for_status(r, "Error connecting")
+        if stream:
+            return streaming.iterate(r)
+        return decode(r)
+
+    # Progress of the task running on the server, None when idle
+    @tracing.traced("progress state")
+    def progress_state(self):
+        try:
+            r = self.request("get", "/api/v1/progressstate")
+        except DuplicatiError:
+            return None
+        if r.status_code != 200:
+            return None
+        progress = models.ProgressState(decode(r))
+        if progress.finished:
+            return None
+        return progress
+
+    # Add the progress to a backup if it is the one running
+    def attach_progress(self, item, progress):
+        backup_id = models.Backup(item).id
+        if progress is not None and progress.backup_id == backup_id:
+            if progress.overall_progress != 1:
+                item["Progress"] = progress.raw
+        return models.Backup(item)
+
+    # Iterate over all backups without holding the whole list
+    def iter_backups(self):
+        progress = self.progress_state()
+        for item in self.list_resource("backups", True):
+            yield self.attach_progress(item, progress)
+
+    # All backups on the server
+    def list_backups(self):
+        return list(self.iter_backups())
+
+    # A single backup with its full configuration
+    def get_backup(self, backup_id, progress=None):
+        r = self.request("get", "/api/v1/backup/" + str(backup_id))
+        self.raise_for_status(r, "Error getting backup " + str(backup_id))
+        return self.attach_progress(decode(r)["data"], progress)
+
+    # Several backups, fetching the progress state only once
+    def get_backups(self, backup_ids):
+        progress = self.progress_state()
+        return [self.get_backup(backup_id, progress)
+                for backup_id in backup_ids]
+
+    # Whether the local database of a backup exists on the server
+    def database_exists(self, db_path):
+        try:
+            r = self.request("post", "/api/v1/filesystem/validate",
+                             params={'path': db_path})
+        except DuplicatiError:
+            return False
+        return r.status_code == 200
+
+    # All notifications on the server
+    def list_notifications(self):
+        items = self.list_resource("notifications", True)
+        return [models.Notification(item) for item in items]
+
+    # Notifications with the given ID's
+    def get_notifications(self, notification_ids):
+        return [notification for notification in self.list_notifications()
+                if notification.id in notification_ids]
+
+    # Delete a single notification
+    def dismiss(self, notification_id):
+        path = "/api/v1/notification/" + str(notification_id)
+        r = self.request("delete", path)
+        if r.status_code == 404:
+            raise NotFoundError("Notification not found", r.status_code)
+        self.raise_for_status(r, "Error deleting notification")
+
+    # Schedule a backup to run next
+    def run(self, backup_id):
+        path = "/api/v1/backup/" + str(backup_id) + "/run"
+        r = self.request("post", path)
+        self.raise_for_status(r, "Error scheduling backup")
+
+    # Abort a running task
+    def abort(self, task_id):
+        r = self.request("post", "/api/v1/task/" + str(task_id) + "/abort")
+        self.raise_for_status(r, "Error aborting task")
+
+    # Start a repair of the local database
+    def repair(self, backup_id):
+        self.backup_command(backup_id, "repair",
+                            "Failed to initialize database repair")
+
+    # Start a verification of the remote files
+    def verify_files(self, backup_id):
+        self.backup_command(backup_id, "verify",
+                            "Failed to initialize remote file verification")
+
+    # Start a compaction of the remote files
+    def compact(self, backup_id):
+        self.backup_command(backup_id, "compact",
+                            "Failed to initialize remote data compaction")
+
+    # Call a subcommand of a backup, e.g. "/api/v1/backup/id/compact"
+    def backup_command(self, backup_id, command, fail_message):
+        path = "/api/v1/backup/" + str(backup_id) + "/" + command
+        r = self.request("post", path)
+        self.raise_for_status(r, fail_message)
+
+    # Delete a backup, remote files are kept as deleting them needs a captcha
+    def delete_backup(self, backup_id, delete_db=False):
+        payload = {'delete-local-db': delete_db, 'delete-remote-files': False}
+        r = self.request("delete", "/api/v1/backup/" + str(backup_id),
+                         params=payload)
+        self.raise_for_status(r, "Error deleting backup")
+
+    # Delete the local database of a backup
+    def delete_database(self, backup_id):
+        path = "/api/v1/backup/" + str(backup_id) + "/deletedb"
+        r = self.request("post", path)
+        self.raise_for_status(r, "Error deleting database")
+
+    # Replace the configuration of a backup
+    def update_backup(self, backup_id, backup_config, import_meta=True):
+        if import_meta is not None and not import_meta:
+            backup_config.get("Backup", {}).pop("Metadata", None)
+        payload = json.dumps(backup_config, default=str)
+        r = self.request("put", "/api/v1/backup/" + str(backup_id),
+                         payload=payload)
+        if r.status_code == 404:
+            raise NotFoundError("Backup not found", r.status_code)
+        self.raise_for_status(r, "Error updating backup")
+
+    # Create a backup from a configuration
+    def create_backup(self, backup_config, import_meta=None):
+        if import_meta is None or import_meta is not True:
+            backup_config["Backup"]["Metadata"] = {}
+
+        # Upload the configuration as a file
+        content = json.dumps(backup_config, default=str)
+        files = {
+            'config': ('backup_config.json', content, 'application/json')
+        }
+        # Will eventually support passphrase encrypted configs, but we will
+        # need to decrypt them in the client in order to convert them
+        payload = {
+            'passphrase': '',
+            'import_metadata': import_meta,
+            'direct': True
+        }
+        r = self.request("post", "/api/v1/backups/import", payload=payload,
+                         files=files, append_token=True)
+
+        # Errors are posted with inline javascript and a 200 OK status code
+        try:
+            text = r.text
+            start = text.index("if (rp) { rp('") + 14
+            end = text.index(", line ")
+            error = text[start:end].replace("\\'", "'") + "."
+            raise DuplicatiError(error)
+        except ValueError:
+            pass
+        self.raise_for_status(r, "Error importing backup configuration")
+
+    # Logs of a backup, or the remote log with remote set
+    def backup_logs(self, backup_id, remote=False, page_size=5):
+        log_type = "remotelog" if remote else "log"
+        path = "/api/v1/backup/" + str(backup_id) + "/" + log_type
+        return self.fetch_logs(path, {'pagesize': page_size}, page_size)
+
+    # Live logs of the given level, starting after first_id
+    def live_logs(self, level, page_size=5, first_id=0):
+        params = {'level': level, 'id': first_id, 'pagesize': page_size}
+        return self.fetch_logs("/api/v1/logdata/poll", params, page_size)
+
+    # Logs stored by the server
+    def stored_logs(self, page_size=5):
+        params = {'pagesize': page_size}
+        return self.fetch_logs("/api/v1/logdata/log", params, page_size)
+
+    # Logs of any type, using the names of the logs command
+    def logs(self, log_type, backup_id=None, remote=False, page_size=5):
+        if log_type == "backup":
+            if backup_id is None:
+                raise DuplicatiError("A backup id must be provided")
+            return self.backup_logs(backup_id, remote, page_size)
+        if log_type == "stored":
+            return self.stored_logs(page_size)
+        return self.live_logs(log_type, page_size)
+
+    # Fetch the last page_size log entries from an endpoint
+    def fetch_logs(self, path, params, page_size):
+        r = self.request("get", path, params=params,
+                         stream=streaming.available())
+        if r.status_code == 500:
+            message = "Error getting log, database may be locked by backup"
+            raise DuplicatiError(message, r.status_code)
+        self.raise_for_status(r, "Error getting log")
+        items = streaming.tail(streaming.iterate(r), page_size)
+        return [models.LogEntry(item) for item in items]
+
+    # Information about the server, such as its version
+    def system_info(self):
+        return self.list_resource("systeminfo")
+
+    # Settings of the server
+    def server_settings(self):
+        return self.list_resource("serversettings")
+
+    # Change some of the server settings, the others are left as they are
+    def update_server_settings(self, changes):
+        payload = json.dumps(changes, default=str)
+        r = self.request("patch", "/api/v1/serversettings", payload=payload)
+        self.raise_for_status(r, "Error updating server settings")
+
+    # State of the server, LastDataUpdateID changes with every change to the
+    # backups or settings
+    def server_state(self):
+        return self.list_resource("serverstate")
+
+    # Configuration of a backup ready to be imported again
+    def export(self, backup_id, server_version=None):
+        backup = self.get_backup(backup_id)
+        if server_version is None:
+            server_version = self.system_info().get("ServerVersion", None)
+        if server_version is None:
+            raise DuplicatiError("Error exporting backup")
+        backup_config = backup.config()
+        backup_config["CreatedByVersion"] = server_version
+        return backup_config
+
+
+# Client with its own connection pool for up to workers requests in flight
+def pooled_client(data, workers, cache_ttl=0, **kwargs):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    http = requests_wrapper.session_wrapper(session, cache_ttl)
+    return DuplicatiClient(data, http=http, **kwargs)
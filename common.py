@@ -4,11 +4,25 @@ import config
 import datetime
 import sys
 import os.path
+import threading
+import tracing
 import yaml
 import compatibility
 
 from dateutil import tz
 
+# Parsed parameters files keyed by path, reused by long running processes
+parameters_cache = {}
+
+# Serializes config writes from commands running in parallel
+config_lock = threading.Lock()
+
+# Serializes logging in again from commands running in parallel
+login_lock = threading.Lock()
+
+# Per thread capture of log_output, see start_capture()
+captured = threading.local()
+
 
 # Common function for validating that required config fields are present
 def validate_config(data):
@@ -40,8 +54,9 @@ def write_config(data):
         message = "Created directory \"" + directory + "\""
         log_output(message, True)
         os.makedirs(directory)
-    with open(config.CONFIG_FILE, 'w') as file:
-        file.write(yaml.dump(data, default_flow_style=False))
+    with config_lock:
+        with open(config.CONFIG_FILE, 'w') as file:
+            file.write(yaml.dump(data, default_flow_style=False))
 
 
 # Common function for getting parameters from file
@@ -55,6 +70,12 @@ def load_parameters(data, args):
     if os.path.isfile(file) is False:
         return args
 
+    # Reuse the parameters if the file is unchanged since it was loaded
+    modified = os.path.getmtime(file)
+    cached = parameters_cache.get(file, None)
+    if cached is not None and cached[0] == modified:
+        return apply_parameters(data, args, cached[1])
+
     # Load the parameters from the file
     with open(file, 'r') as file_handle:
         try:
@@ -63,14 +84,8 @@ def load_parameters(data, args):
             message = "Loaded " + str(parameters) + " parameters from file"
             log_output(message, True)
 
-            for key, value in parameters_file.items():
-                # Make sure not to override CLI provided arguments
-                if args.get(key, None) is None:
-                    args[key] = value
-
-            # Verbose is special because verbose is a command not an argument
-            if parameters_file.get("verbose", None) is not None:
-                data["verbose"] = parameters_file.get("verbose")
+            parameters_cache[file] = (modified, parameters_file)
+            args = apply_parameters(data, args, parameters_file)
 
             # Update parameters_file variable in config file
             data["parameters_file"] = file
@@ -81,16 +96,51 @@ def load_parameters(data, args):
             return args
 
 
+# Common function for merging loaded parameters into the arguments
+def apply_parameters(data, args, parameters_file):
+    for key, value in parameters_file.items():
+        # Make sure not to override CLI provided arguments
+        if args.get(key, None) is None:
+            args[key] = value
+
+    # Verbose is special because verbose is a command not an argument
+    if parameters_file.get("verbose", None) is not None:
+        data["verbose"] = parameters_file.get("verbose")
+
+    return args
+
+
 # Common function for logging messages
 def log_output(text, important, code=None):
+    lines = getattr(captured, "lines", None)
+    if lines is not None and code is not None:
+        captured.code = code
+
     # Determine whether the message should be displayed in stdout
     if config.VERBOSE is False and important is False:
         return
-    if code is None or config.VERBOSE is False:
-        print(text)
+    if code is not None and config.VERBOSE is not False:
+        text = text + "\nCode: " + str(code)
+
+    if lines is not None:
+        lines.append(str(text))
         return
+    print(text)
+
 
-    print(text + "\nCode: " + str(code))
+# Capture log_output of the current thread instead of printing it
+def start_capture():
+    captured.lines = []
+    captured.code = None
+
+
+# Stop capturing and return the captured text and last status code
+def stop_capture():
+    text = "\n".join(getattr(captured, "lines", None) or [])
+    code = getattr(captured, "code", None)
+    captured.lines = None
+    captured.code = None
+    return text, code
 
 
 # Common function for creating cookies to authenticate against the API
@@ -184,6 +234,7 @@ def check_response(data, status_code):
 
 
 # Common function for verifying token validity
+@tracing.traced("verify token")
 def verify_token(data):
     token = data.get("token", None)
     expires = data.get("token_expires", None)
@@ -191,6 +242,33 @@ def verify_token(data):
         log_output("Not logged in", True)
         sys.exit(2)
 
+    # Check if token is still valid
+    if token_valid(data):
+        return
+
+    # Commands running in parallel share data, only one of them logs in
+    with login_lock:
+        if token_valid(data):
+            return
+
+        # Try to log in again
+        log_output("Token expired, trying to log in again", True)
+        verify = data.get("server", {}).get("verify", True)
+        args = load_parameters(data, {})
+        password = args.get("password", None)
+        if auth.login(data, password=password, verify=verify):
+            return
+
+    # Exit if token is invalid and an attempt to login failed
+    sys.exit(2)
+
+
+# Whether the token in data has not expired yet
+def token_valid(data):
+    expires = data.get("token_expires", None)
+    if data.get("token", None) is None or expires is None:
+        return False
+
     # Get time
     now = datetime.datetime.now()
 
@@ -199,21 +277,7 @@ def verify_token(data):
     now = now.astimezone(tz.tzlocal())
     expires = expires.replace(tzinfo=tz.tzutc())
     expires = expires.astimezone(tz.tzlocal())
-
-    # Check if token is still valid
-    if now < expires:
-        return
-
-    # Try to log in again
-    log_output("Token expired, trying to log in again", True)
-    verify = data.get("server", {}).get("verify", True)
-    args = load_parameters(data, {})
-    password = args.get("password", None)
-    if auth.login(data, password=password, verify=verify):
-        return
-
-    # Exit if token is invalid and an attempt to login failed
-    sys.exit(2)
+    return now < expires
 
 
 def ensure_trailing_slash(path):
@@ -19,12 +19,39 @@ def get_config_location():
     return config_file
 
 
-# Clear terminal prompt
-def clear_prompt():
+# Whether terminal control sequences have been enabled
+terminal_ready = False
+
+
+# Make the console interpret terminal control sequences
+def enable_terminal_sequences():
+    global terminal_ready
+    if terminal_ready:
+        return
+    terminal_ready = True
     if platform.system() == 'Windows':
-        os.system('cls')
-    else:
-        os.system('clear')
+        # Running any command turns on VT processing of the console
+        os.system('')
+
+
+# Clear terminal prompt with control sequences rather than forking clear
+def clear_prompt():
+    if not sys.stdout.isatty():
+        return
+    enable_terminal_sequences()
+    sys.stdout.write("\x1b[H\x1b[2J")
+    sys.stdout.flush()
+
+
+# Rewrite a line above the cursor, lines counted from the cursor line
+def rewrite_line(lines_up, text):
+    if not sys.stdout.isatty():
+        return
+    enable_terminal_sequences()
+    up = "\x1b[" + str(lines_up) + "F"
+    down = "\x1b[" + str(lines_up) + "E"
+    sys.stdout.write(up + "\x1b[2K" + text + down)
+    sys.stdout.flush()
 
 
 # Python 3 vs 2 urllib compatibility issues
@@ -0,0 +1,449 @@
+# Module for shell completion of commands, options, backup ID's and names
+# The completion scripts for bash, zsh and fish are generated from the
+# argument parser. Dynamic values such as backup ID's and names are served
+# from the backup index by "duc complete <kind>", which only ever reads the
+# local cache. Stale caches are refreshed by a detached background process,
+# so a completion never waits on the server.
+import argparse
+import arg_parser
+import common
+import index
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Seconds before cached completion values are refreshed in the background
+COMPLETION_TTL = 60
+
+# Seconds a completion may take before it gives up and completes nothing
+COMPLETION_TIMEOUT = 0.5
+
+# Seconds to wait before starting another background refresh
+REFRESH_BACKOFF = 30
+
+# Commands whose ID arguments refer to notifications rather than backups
+NOTIFICATION_COMMANDS = ["dismiss"]
+
+# Commands whose ID arguments are not cached, e.g. task ID's
+UNCACHED_COMMANDS = ["abort"]
+
+# Kinds of dynamic values that can be completed
+KINDS = ["backups", "backup-ids", "backup-names", "notifications", "log-types"]
+
+
+# Get the subcommand parsers keyed by command name
+def get_subparsers(parser):
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            return action
+    return None
+
+
+# Describe each command of a parser for the completion scripts
+def describe_commands(parser=None):
+    if parser is None:
+        parser = arg_parser.parser
+    subparsers = get_subparsers(parser)
+    helps = {}
+    for action in subparsers._choices_actions:
+        helps[action.dest] = action.help or ""
+
+    commands = []
+    for name, subparser in subparsers.choices.items():
+        # Hidden commands have no help text
+        if name not in helps:
+            continue
+        commands.append(describe_command(name, subparser, helps[name]))
+    return commands
+
+
+# Describe the options and positional arguments of a single command
+def describe_command(name, subparser, help_text=""):
+    command = {
+        "name": name,
+        "help": help_text,
+        "options": [],
+        "value_options": {},
+        "choices": [],
+        "id_position": -1,
+        "id_many": False,
+        "id_kind": "",
+        "files": False,
+    }
+    positionals = []
+    nested = get_subparsers(subparser)
+    for action in subparser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            positionals.append({"dest": "command",
+                                "choices": list(action.choices.keys()),
+                                "nargs": None})
+        elif action.option_strings:
+            command["options"].extend(action.option_strings)
+            if action.nargs != 0:
+                choices = list(action.choices or [])
+                for option in action.option_strings:
+                    command["value_options"][option] = choices
+        else:
+            positionals.append({"dest": action.dest,
+                                "choices": list(action.choices or []),
+                                "nargs": action.nargs})
+
+    # Options of nested commands such as "set password"
+    if nested is not None:
+        for subcommand in nested.choices.values():
+            described = describe_command(name, subcommand)
+            for option in described["options"]:
+                if option not in command["options"]:
+                    command["options"].append(option)
+            command["value_options"].update(described["value_options"])
+
+    for positional in positionals:
+        if is_path(positional["dest"]):
+            command["files"] = True
+
+    if len(positionals) > 0 and len(positionals[0]["choices"]) > 0:
+        command["choices"] = positionals[0]["choices"]
+
+    dests = [positional["dest"] for positional in positionals]
+    if "id" in dests and name not in UNCACHED_COMMANDS:
+        position = dests.index("id")
+        command["id_position"] = position
+        command["id_many"] = positionals[position]["nargs"] in ["+", "*"]
+        if name in NOTIFICATION_COMMANDS:
+            command["id_kind"] = "notifications"
+        elif "type" in dests:
+            command["id_kind"] = "typed"
+        else:
+            command["id_kind"] = "backups"
+
+    return command
+
+
+# Whether an argument takes a file or directory path
+def is_path(name):
+    return "file" in name or "path" in name
+
+
+# Generate the completion script for a shell
+def generate(shell, prog="duc"):
+    commands = describe_commands()
+    if shell == "fish":
+        return generate_fish(commands, prog)
+    script = generate_bash(commands, prog)
+    if shell == "zsh":
+        header = "# duc zsh completion, generated by `" + prog
+        header += " completion zsh`\n"
+        header += "autoload -U +X bashcompinit && bashcompinit\n"
+        script = header + script
+    return script
+
+
+# Quote a list of words for use in a shell script
+def _words(words):
+    return " ".join(words).replace('"', '\\"')
+
+
+# Generate the bash completion script, also used by zsh through bashcompinit
+def generate_bash(commands, prog="duc"):
+    function = "_" + prog.replace("-", "_").replace(".", "_") + "_complete"
+    value_options = set()
+    for command in commands:
+        value_options.update(command["value_options"].keys())
+
+    lines = [
+        "# " + prog + " bash completion, generated by `" + prog +
+        " completion bash`",
+        function + "() {",
+        "    local cur prev cmd word i positional type",
+        "    local options choices id_position id_many id_kind kind",
+        "    COMPREPLY=()",
+        "    cur=\"${COMP_WORDS[COMP_CWORD]}\"",
+        "    prev=\"${COMP_WORDS[COMP_CWORD-1]}\"",
+        "    if [ \"$COMP_CWORD\" -eq 1 ]; then",
+        "        COMPREPLY=( $(compgen -W \"" +
+        _words([command["name"] for command in commands]) +
+        " -h --help\" -- \"$cur\") )",
+        "        return 0",
+        "    fi",
+        "    cmd=\"${COMP_WORDS[1]}\"",
+        "    options=\"\"; choices=\"\"; id_position=-1; id_many=0; id_kind=\"\"",
+        "    case \"$cmd\" in",
+    ]
+    for command in commands:
+        lines.append("        " + command["name"] + ")")
+        lines.append("            options=\"" + _words(command["options"]) +
+                     "\"")
+        lines.append("            choices=\"" + _words(command["choices"]) +
+                     "\"")
+        lines.append("            id_position=" +
+                     str(command["id_position"]))
+        lines.append("            id_many=" + str(int(command["id_many"])))
+        lines.append("            id_kind=\"" + command["id_kind"] + "\"")
+        lines.append("            ;;")
+    lines.extend([
+        "    esac",
+        "",
+        "    # Count the positional arguments before the current word",
+        "    positional=0; type=\"\"; i=2",
+        "    while [ \"$i\" -lt \"$COMP_CWORD\" ]; do",
+        "        word=\"${COMP_WORDS[i]}\"",
+        "        case \" " + _words(sorted(value_options)) + " \" in",
+        "            *\" $word \"*) i=$((i + 2)); continue ;;",
+        "        esac",
+        "        case \"$word\" in",
+        "            -*) ;;",
+        "            *)",
+        "                [ \"$positional\" -eq 0 ] && type=\"$word\"",
+        "                positional=$((positional + 1)) ;;",
+        "        esac",
+        "        i=$((i + 1))",
+        "    done",
+        "",
+        "    case \"$prev\" in",
+    ])
+    for option in sorted(value_options):
+        choices = []
+        for command in commands:
+            choices = command["value_options"].get(option, choices) or choices
+        if option == "--id":
+            lines.append("        --id) kind=backups ;;")
+        elif len(choices) > 0:
+            lines.append("        " + option + ")")
+            lines.append("            COMPREPLY=( $(compgen -W \"" +
+                         _words(choices) + "\" -- \"$cur\") )")
+            lines.append("            return 0 ;;")
+        elif is_path(option):
+            lines.append("        " + option + ")")
+            lines.append("            COMPREPLY=( $(compgen -f -- \"$cur\") )")
+            lines.append("            return 0 ;;")
+        else:
+            lines.append("        " + option + ") return 0 ;;")
+    lines.extend([
+        "    esac",
+        "",
+        "    if [ -z \"$kind\" ]; then",
+        "        if [[ \"$cur\" == -* ]]; then",
+        "            COMPREPLY=( $(compgen -W \"$options\" -- \"$cur\") )",
+        "            return 0",
+        "        fi",
+        "        if [ \"$positional\" -eq 0 ] && [ -n \"$choices\" ]; then",
+        "            COMPREPLY=( $(compgen -W \"$choices\" -- \"$cur\") )",
+        "            return 0",
+        "        fi",
+        "        if [ \"$id_position\" -ge 0 ] && { \\",
+        "            [ \"$positional\" -eq \"$id_position\" ] || \\",
+        "            { [ \"$id_many\" -eq 1 ] && \\",
+        "              [ \"$positional\" -gt \"$id_position\" ]; }; }; then",
+        "            kind=\"$id_kind\"",
+        "        fi",
+        "    fi",
+        "    if [ \"$kind\" = \"typed\" ]; then",
+        "        if [ \"$type\" = \"notification\" ]; then",
+        "            kind=notifications",
+        "        else",
+        "            kind=backups",
+        "        fi",
+        "    fi",
+        "    if [ -n \"$kind\" ]; then",
+        "        local IFS=$'\\n'",
+        "        COMPREPLY=( $(compgen -W \"$(\"${COMP_WORDS[0]}\" complete " +
+        "\"$kind\" 2>/dev/null)\" -- \"$cur\") )",
+        "        return 0",
+        "    fi",
+        "    COMPREPLY=( $(compgen -f -- \"$cur\") )",
+        "}",
+        "complete -F " + function + " " + prog,
+        "",
+    ])
+    return "\n".join(lines)
+
+
+# Generate the fish completion script
+def generate_fish(commands, prog="duc"):
+    value_options = set()
+    for command in commands:
+        value_options.update(command["value_options"].keys())
+
+    lines = [
+        "# " + prog + " fish completion, generated by `" + prog +
+        " completion fish`",
+        "",
+        "# Number of positional arguments after the command",
+        "function __" + prog + "_positionals",
+        "    set -l tokens (commandline -opc)",
+        "    set -l count 0",
+        "    set -l skip 0",
+        "    for token in $tokens[3..-1]",
+        "        if test $skip -eq 1",
+        "            set skip 0",
+        "            continue",
+        "        end",
+        "        switch $token",
+        "            case " + " ".join(sorted(value_options)),
+        "                set skip 1",
+        "            case '-*'",
+        "            case '*'",
+        "                set count (math $count + 1)",
+        "        end",
+        "    end",
+        "    echo $count",
+        "end",
+        "",
+        "# Complete dynamic values from the local cache",
+        "function __" + prog + "_dynamic",
+        "    set -l tokens (commandline -opc)",
+        "    set -l kind $argv[1]",
+        "    if test \"$kind\" = typed",
+        "        if contains -- notification $tokens",
+        "            set kind notifications",
+        "        else",
+        "            set kind backups",
+        "        end",
+        "    end",
+        "    $tokens[1] complete $kind 2>/dev/null",
+        "end",
+        "",
+        "complete -c " + prog + " -f",
+    ]
+    for command in commands:
+        name = command["name"]
+        help_text = command["help"].replace("'", "\\'")
+        lines.append("complete -c " + prog +
+                     " -n '__fish_use_subcommand' -a " + name +
+                     " -d '" + help_text + "'")
+        seen = "__fish_seen_subcommand_from " + name
+        for option in command["options"]:
+            if option.startswith("--"):
+                flag = "-l " + option[2:]
+            else:
+                flag = "-s " + option[1:]
+            extra = ""
+            choices = command["value_options"].get(option, None)
+            if option == "--id":
+                extra = " -x -a '(__" + prog + "_dynamic backups)'"
+            elif choices:
+                extra = " -x -a '" + " ".join(choices) + "'"
+            elif choices is not None and is_path(option):
+                extra = " -r -F"
+            elif choices is not None:
+                extra = " -x"
+            lines.append("complete -c " + prog + " -n '" + seen + "' " +
+                         flag + extra)
+        if command["files"]:
+            lines.append("complete -c " + prog + " -n '" + seen + "' -F")
+        if len(command["choices"]) > 0:
+            lines.append("complete -c " + prog + " -n '" + seen +
+                         "; and test (__" + prog + "_positionals) -eq 0' -a '" +
+                         " ".join(command["choices"]) + "'")
+        if command["id_position"] >= 0:
+            comparison = "-ge" if command["id_many"] else "-eq"
+            lines.append("complete -c " + prog + " -n '" + seen +
+                         "; and test (__" + prog + "_positionals) " +
+                         comparison + " " + str(command["id_position"]) +
+                         "' -a '(__" + prog + "_dynamic " +
+                         command["id_kind"] + ")'")
+    lines.append("")
+    return "\n".join(lines)
+
+
+# Print the cached values of a kind within a fixed time budget
+# Loading the config and the index, and starting a refresh, run on a thread
+# so a slow disk or process start prints nothing rather than blocking the
+# keypress. load_config is called with data to read the configuration.
+def serve(load_config, data, kind, timeout=COMPLETION_TIMEOUT):
+    values = []
+
+    def lookup():
+        values.extend(complete(load_config(data), kind))
+
+    thread = threading.Thread(target=lookup)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive() or len(values) == 0:
+        return
+    sys.stdout.write("\n".join(values) + "\n")
+    sys.stdout.flush()
+
+
+# The cached values of a kind, refreshing stale caches in background
+def complete(data, kind):
+    entry = index.read_index().get(index.server_key(data), None)
+    if entry is None or time.time() - entry.get("updated", 0) > \
+            COMPLETION_TTL:
+        start_background_refresh()
+    if entry is None:
+        return []
+    return cached_values(entry, kind)
+
+
+# Values of a kind from an index entry
+def cached_values(entry, kind):
+    backups = entry.get("backups", {})
+    ids = sorted(backups.keys(), key=lambda key: (len(key), key))
+    names = sorted(set([record.get("Name", "") for record in
+                        backups.values()]))
+    if kind == "backup-ids":
+        return ids
+    if kind == "backup-names":
+        return names
+    if kind == "backups":
+        return ids + names
+    if kind == "notifications":
+        return [str(item.get("ID", "")) for item in
+                entry.get("notifications", [])]
+    if kind == "log-types":
+        subparsers = get_subparsers(arg_parser.parser)
+        logs_parser = subparsers.choices["logs"]
+        return describe_command("logs", logs_parser)["choices"]
+    return []
+
+
+# Start a detached process refreshing the completion cache
+def start_background_refresh():
+    marker = index.get_index_location() + ".refreshing"
+    try:
+        if time.time() - os.path.getmtime(marker) < REFRESH_BACKOFF:
+            return
+    except OSError:
+        pass
+
+    try:
+        directory = os.path.dirname(marker)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(marker, 'w') as file_handle:
+            file_handle.write(str(os.getpid()))
+
+        # Self contained binaries are their own interpreter
+        if getattr(sys, "frozen", False):
+            command = [sys.executable]
+        else:
+            command = [sys.executable, os.path.abspath(sys.argv[0])]
+        command += ["complete", "--refresh"]
+
+        options = {}
+        if os.name == "nt":
+            options["creationflags"] = 0x00000008  # DETACHED_PROCESS
+        else:
+            options["start_new_session"] = True
+        subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, close_fds=True,
+                         **options)
+    except Exception as exc:
+        common.log_output(exc, False)
+
+
+# Refresh the cached backups and notifications, run in the background
+def refresh(data):
+    try:
+        index.refresh(data)
+        index.refresh_notifications(data)
+    finally:
+        try:
+            os.remove(index.get_index_location() + ".refreshing")
+        except OSError:
+            pass
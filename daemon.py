@@ -0,0 +1,594 @@
+# Module for daemon mode
+# The daemon polls a task server for tasks, validates them, executes them
+# against the Duplicati server and posts the results back, see "Task server
+# API specification" in the README. It runs on an event loop: polling never
+# waits for running tasks, independent tasks run concurrently up to a limit,
+# and results are posted again until the task server answers 200 OK.
+# Tasks are recorded in a journal before they are acknowledged, so tasks
+# that were not finished and delivered are resumed after a crash. Task
+# servers that advertise batch support get acknowledgements and results in
+# batches, all others one request per task.
+import async_client
+import asyncio
+import client
+import collections
+import common
+import functools
+import index
+import journal
+import json
+import policy
+import random
+import requests
+import requests_wrapper
+import signal
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds between polls while the task server has no new tasks
+POLL_INTERVAL = 10
+
+# Tasks executed at the same time unless configured otherwise
+JOBS = 4
+
+# Results posted to the task server at the same time
+UPLOAD_LIMIT = 8
+
+# Seconds before posting a result again, doubled on every failure
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+# Seconds to wait for running tasks when stopping
+SHUTDOWN_TIMEOUT = 30
+
+# Seconds results wait for others to share their batch, and the most
+# results in one batch
+FLUSH_INTERVAL = 0.05
+BATCH_SIZE = 100
+
+# Status codes of task servers without the batch endpoint
+BATCH_UNSUPPORTED = [404, 405, 501]
+
+# Status of a task as reported to the task server
+ACCEPTED = "accepted"
+REFUSED = "refused"
+COMPLETED = "completed"
+ERROR = "error"
+
+# Resource types that are not identified by an ID
+TYPES_WITHOUT_ID = [
+    "backups",
+    "notifications",
+    "serversettings",
+    "systeminfo",
+    "stored",
+    "profiling",
+    "information",
+    "warning",
+    "error"
+]
+
+
+# List all resources of a type
+async def list_resource(server, resource):
+    resource_type = resource["Type"]
+    if resource_type == "backups":
+        return [backup.raw for backup in await server.list_backups()]
+    if resource_type == "notifications":
+        notifications = await server.list_notifications()
+        return [notification.raw for notification in notifications]
+    return await server.call("list_resource", resource_type)
+
+
+# Get a single backup or notification
+async def get_resource(server, resource):
+    if resource["Type"] == "backup":
+        return (await server.get_backup(resource["ID"])).raw
+    notifications = await server.get_notifications([resource["ID"]])
+    if len(notifications) == 0:
+        raise client.NotFoundError("Notification not found", 404)
+    return notifications[0].raw
+
+
+async def run_backup(server, resource):
+    await server.run(resource["ID"])
+    return "Backup scheduled"
+
+
+async def abort_task(server, resource):
+    await server.abort(resource["ID"])
+    return "Task aborted"
+
+
+async def repair_database(server, resource):
+    await server.call("repair", resource["ID"])
+    return "Initialized database repair"
+
+
+async def verify_remote_files(server, resource):
+    await server.call("verify_files", resource["ID"])
+    return "Initialized remote file verification"
+
+
+async def compact_remote_files(server, resource):
+    await server.call("compact", resource["ID"])
+    return "Initialized remote file compaction"
+
+
+async def dismiss_notification(server, resource):
+    await server.dismiss(resource["ID"])
+    return "Notification deleted"
+
+
+# Logs of a backup or of the server, optionally with PageSize and Remote
+async def get_logs(server, resource):
+    page_size = resource.get("PageSize", 5)
+    if resource["Type"] == "backup":
+        remote = resource.get("Remote", False)
+        logs = await server.logs("backup", resource["ID"], remote, page_size)
+    else:
+        logs = await server.logs(resource["Type"], None, False, page_size)
+    return [entry.raw for entry in logs]
+
+
+async def export_backup(server, resource):
+    return await server.export(resource["ID"])
+
+
+# Delete a backup, optionally with DeleteDB, a database or a notification
+async def delete_resource(server, resource):
+    resource_id = resource["ID"]
+    if resource["Type"] == "backup":
+        delete_db = resource.get("DeleteDB", False)
+        await server.call("delete_backup", resource_id, delete_db)
+        index.remove(server.data, resource_id)
+        return "Backup deleted"
+    if resource["Type"] == "database":
+        await server.call("delete_database", resource_id)
+        return "Database deleted"
+    return await dismiss_notification(server, resource)
+
+
+# Operations the daemon executes and the resource types they accept
+OPERATIONS = {
+    "list": (list_resource,
+             ["backups", "notifications", "serversettings", "systeminfo"]),
+    "get": (get_resource, ["backup", "notification"]),
+    "describe": (get_resource, ["backup", "notification"]),
+    "run": (run_backup, ["backup"]),
+    "abort": (abort_task, ["task"]),
+    "repair": (repair_database, ["backup"]),
+    "verify": (verify_remote_files, ["backup"]),
+    "compact": (compact_remote_files, ["backup"]),
+    "dismiss": (dismiss_notification, ["notification"]),
+    "logs": (get_logs, ["backup", "stored", "profiling", "information",
+                        "warning", "error"]),
+    "export": (export_backup, ["backup"]),
+    "delete": (delete_resource, ["backup", "database", "notification"]),
+}
+
+
+# The API url of the task server, anything after api/ is added per request
+def create_api_url(url):
+    url = url.rstrip("/")
+    if "://" not in url:
+        url = "http://" + url
+    if not url.endswith("/api"):
+        url += "/api"
+    return url + "/"
+
+
+# Whether the task list response advertises batched results
+def supports_batches(content):
+    return isinstance(content, dict) and content.get("Batch", False) is True
+
+
+# Tasks from the task list response, a list, a single task or {"Tasks": []}
+def parse_tasks(content):
+    if isinstance(content, dict):
+        content = content.get("Tasks", [content])
+    if not isinstance(content, list):
+        return []
+    return content
+
+
+# Reason for refusing a task, None if the task is valid
+def validate_task(task):
+    if task.get("ID", None) is None or task.get("Operation", None) is None:
+        return "ID and Operation are required"
+
+    operation = task.get("Operation")
+    if operation not in OPERATIONS:
+        return "Unsupported operation: " + str(operation)
+
+    resources = task.get("Resources", None)
+    if not isinstance(resources, list) or len(resources) == 0:
+        return "At least one resource is required"
+
+    resource_types = OPERATIONS[operation][1]
+    for resource in resources:
+        if not isinstance(resource, dict):
+            return "Invalid resource: " + str(resource)
+        resource_type = resource.get("Type", None)
+        if resource_type not in resource_types:
+            message = "Unsupported resource type for " + operation + ": "
+            return message + str(resource_type)
+        if resource_type in TYPES_WITHOUT_ID:
+            continue
+        resource_id = str(resource.get("ID", ""))
+        if not resource_id.isdigit():
+            return "Invalid resource ID: " + resource_id
+    return None
+
+
+# Daemon serving the tasks of one task server
+class Daemon(object):
+    def __init__(self, data, url, interval=POLL_INTERVAL, jobs=JOBS,
+                 password=None, journal_path=None, task_policy=None):
+        self.api = create_api_url(url)
+        self.journal = journal.Journal(journal_path)
+        if task_policy is None:
+            task_policy = policy.Policy(policy.DEFAULT_POLICY)
+        self.policy = task_policy
+        self.interval = interval
+        self.jobs = max(1, jobs)
+        self.server = async_client.AsyncDuplicatiClient(
+            data, password=password, host_limit=self.jobs)
+
+        # Pooled session and threads for talking to the task server
+        self.session = requests.Session()
+        pool_size = UPLOAD_LIMIT + 1
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+        # ID's of tasks seen in this daemon session
+        self.seen = set()
+        self.running = set()
+        self.stats = {ACCEPTED: 0, REFUSED: 0, COMPLETED: 0, ERROR: 0}
+
+        # Results waiting for the next batch, keyed by task ID
+        # batching is None until the task server tells whether it supports
+        # batches, and False for good once the batch endpoint is missing
+        self.batching = None
+        self.pending = collections.OrderedDict()
+
+        # Created inside the event loop
+        self.stopping = None
+        self.job_slots = None
+        self.upload_slots = None
+        self.results_waiting = None
+        self.batch_full = None
+
+    # Run until interrupted
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.journal.close()
+            self.server.close()
+            self.session.close()
+            self.executor.shutdown(wait=False)
+
+        message = "Daemon stopped, " + ", ".join(
+            str(count) + " " + status for status, count in self.stats.items())
+        common.log_output(message, True)
+
+    # Request stopping, running tasks are allowed to finish
+    def stop(self):
+        if not self.stopping.is_set():
+            common.log_output("Stopping daemon...", True)
+        self.stopping.set()
+
+    # Create the events and semaphores inside the running loop
+    def setup(self):
+        self.stopping = asyncio.Event()
+        self.job_slots = asyncio.Semaphore(self.jobs)
+        self.upload_slots = asyncio.Semaphore(UPLOAD_LIMIT)
+        self.results_waiting = asyncio.Event()
+        self.batch_full = asyncio.Event()
+
+    # Poll the task server until stopped
+    async def serve(self):
+        self.setup()
+        flusher = asyncio.ensure_future(self.flush_loop())
+
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not supported on Windows, KeyboardInterrupt is used instead
+                pass
+
+        self.recover()
+        message = "Daemon polling " + self.api + "tasks/status"
+        common.log_output(message, True)
+        while not self.stopping.is_set():
+            try:
+                new_tasks = await self.poll()
+            except Exception as exc:
+                common.log_output("Polling failed: " + repr(exc), True)
+                new_tasks = 0
+
+            # Ask again right away while new tasks keep coming in
+            delay = 0 if new_tasks > 0 else self.interval
+            try:
+                await asyncio.wait_for(self.stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+        await self.drain()
+        flusher.cancel()
+
+    # Resume the unfinished tasks of the journal
+    # Tasks with a result only need it delivered, others are executed again
+    def recover(self):
+        recovered = self.journal.open()
+        if len(recovered) > 0:
+            message = "Resuming " + str(len(recovered)) + " unfinished tasks"
+            common.log_output(message, True)
+
+        for record in recovered:
+            task_id = record["ID"]
+            self.seen.add(task_id)
+            if record["State"] == journal.RESULT:
+                work = self.deliver(task_id, record.get("Status", ERROR),
+                                    record.get("Data", None))
+            else:
+                work = self.handle(record.get("Task", {"ID": task_id}))
+            self.track(asyncio.ensure_future(work))
+
+    # Keep a reference to a running task until it is done
+    def track(self, future):
+        self.running.add(future)
+        future.add_done_callback(self.running.discard)
+
+    # Record a state change and wait until it is durable
+    async def record(self, task_id, state, **fields):
+        future = self.journal.record(task_id, state, **fields)
+        await asyncio.wrap_future(future)
+
+    # Wait for running tasks before stopping
+    async def drain(self):
+        if len(self.running) == 0:
+            return
+        message = "Waiting for " + str(len(self.running)) + " tasks..."
+        common.log_output(message, True)
+        running = list(self.running)
+        done, pending = await asyncio.wait(running, timeout=SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            message = str(len(pending)) + " tasks did not finish in time"
+            common.log_output(message, True)
+
+    # Make a request to the task server without blocking the loop
+    async def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", requests_wrapper.timeout_seconds)
+        call = functools.partial(requests_wrapper.request, method,
+                                 self.api + path,
+                                 client_session=self.session, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, call)
+
+    # Check the status and start all new tasks, returns the number started
+    async def poll(self):
+        r = await self.request("get", "tasks/status", allow_redirects=False)
+        if r.status_code == 304:
+            return 0
+        if r.status_code != 303:
+            message = "Error polling the task server"
+            common.log_output(message, True, r.status_code)
+            return 0
+
+        r = await self.request("get", "tasks")
+        if r.status_code != 200:
+            message = "Error fetching the task list"
+            common.log_output(message, True, r.status_code)
+            return 0
+
+        try:
+            content = r.json()
+        except ValueError:
+            common.log_output("Invalid task list", True)
+            return 0
+        if self.batching is not False:
+            self.batching = supports_batches(content)
+        tasks = parse_tasks(content)
+
+        started = 0
+        for task in tasks:
+            if self.start(task):
+                started += 1
+        return started
+
+    # Start handling a task unless it was seen before
+    def start(self, task):
+        if not isinstance(task, dict) or task.get("ID", None) is None:
+            common.log_output("Skipping task without ID: " + str(task), True)
+            return False
+
+        # Task servers list tasks until they receive the accepted status
+        if task["ID"] in self.seen:
+            return False
+        self.seen.add(task["ID"])
+
+        self.track(asyncio.ensure_future(self.handle(task)))
+        return True
+
+    # Validate, execute and report a single task
+    async def handle(self, task):
+        task_id = task["ID"]
+        reason = validate_task(task)
+        if reason is None:
+            reason = self.policy.check(task)
+        if reason is not None:
+            common.log_output("Refused task " + str(task_id) + ": " + reason,
+                              False)
+            data = {"Reason": reason}
+            await self.record(task_id, journal.RESULT, Task=task,
+                              Status=REFUSED, Data=data)
+            await self.deliver(task_id, REFUSED, data)
+            return
+
+        # The task must be on disk before the task server stops listing it
+        await self.record(task_id, journal.RECEIVED, Task=task)
+
+        # Execute while the task server is informed about the acceptance
+        accepted = asyncio.ensure_future(self.post_result(task_id, ACCEPTED))
+        async with self.job_slots:
+            status, result = await self.execute(task)
+        await self.record(task_id, journal.RESULT, Status=status, Data=result)
+        # Single posts keep their order, a batched result replaces the
+        # acceptance if both are still waiting
+        if not self.batching:
+            await accepted
+        await self.deliver(task_id, status, result)
+        await accepted
+
+    # Post the final result and mark the task as finished in the journal
+    async def deliver(self, task_id, status, data):
+        await self.post_result(task_id, status, data)
+        # Losing this record only means the result is posted once more
+        self.journal.record(task_id, journal.DELIVERED)
+
+    # Execute the operation of a task on all of its resources
+    async def execute(self, task):
+        function = OPERATIONS[task["Operation"]][0]
+        calls = [self.execute_resource(function, resource)
+                 for resource in task["Resources"]]
+        results = await asyncio.gather(*calls)
+
+        status = COMPLETED
+        for result in results:
+            if "Error" in result:
+                status = ERROR
+        message = "Task " + str(task["ID"]) + " " + task["Operation"] + ": "
+        common.log_output(message + status, False)
+        return status, {"Results": results}
+
+    # Result of the operation on a single resource
+    async def execute_resource(self, function, resource):
+        result = {"Type": resource["Type"]}
+        if "ID" in resource:
+            result["ID"] = resource["ID"]
+        try:
+            result["Result"] = await function(self.server, resource)
+        except client.DuplicatiError as error:
+            result["Error"] = error.message
+            result["Code"] = error.status_code
+        except Exception as exc:
+            result["Error"] = repr(exc)
+        return result
+
+    # Post a result, in a batch when the task server supports them
+    async def post_result(self, task_id, status, data=None):
+        result = {"ID": task_id, "Status": status}
+        if data is not None:
+            result["Data"] = data
+        if not self.batching:
+            return await self.post_single(result)
+
+        # A newer result of the same task replaces the one still waiting
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = self.pending.pop(task_id, None)
+        futures = [future] if entry is None else entry[1] + [future]
+        self.pending[task_id] = (result, futures)
+        self.results_waiting.set()
+        if len(self.pending) >= BATCH_SIZE:
+            self.batch_full.set()
+        await future
+
+    # Send the waiting results in batches until cancelled
+    async def flush_loop(self):
+        while True:
+            await self.results_waiting.wait()
+            # Give other results a moment to join the batch
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.results_waiting.clear()
+            self.batch_full.clear()
+            while len(self.pending) > 0:
+                batch = []
+                while len(self.pending) > 0 and len(batch) < BATCH_SIZE:
+                    batch.append(self.pending.popitem(last=False)[1])
+                self.track(asyncio.ensure_future(self.post_batch(batch)))
+
+    # Post a batch of results until the task server confirms it
+    # batch is a list of results and the futures waiting for them
+    async def post_batch(self, batch):
+        results = [result for result, futures in batch]
+        payload = json.dumps({"Results": results}, default=str)
+        headers = {"Content-Type": "application/json"}
+
+        delay = RETRY_DELAY
+        while True:
+            async with self.upload_slots:
+                r = await self.request("post", "tasks/results", data=payload,
+                                       headers=headers)
+            if r.status_code == 200:
+                break
+            if r.status_code in BATCH_UNSUPPORTED:
+                common.log_output("Task server doesn't support batches, "
+                                  "posting results one by one", True)
+                self.batching = False
+                calls = [self.post_single(result) for result in results]
+                await asyncio.gather(*calls)
+                break
+
+            message = "Posting a batch of " + str(len(results))
+            message += " results failed, retrying in " + str(delay) + "s"
+            common.log_output(message, False, r.status_code)
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+        for result, futures in batch:
+            if r.status_code == 200:
+                self.stats[result["Status"]] += 1
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+    # Post a single result until the task server confirms it with 200 OK
+    async def post_single(self, result):
+        task_id = result["ID"]
+        status = result["Status"]
+        payload = json.dumps(result, default=str)
+        headers = {"Content-Type": "application/json"}
+        path = "tasks/" + str(task_id) + "/result"
+
+        delay = RETRY_DELAY
+        while True:
+            async with self.upload_slots:
+                r = await self.request("post", path, data=payload,
+                                       headers=headers)
+            if r.status_code == 200:
+                self.stats[status] += 1
+                return
+
+            message = "Posting " + status + " for task " + str(task_id)
+            message += " failed, retrying in " + str(delay) + "s"
+            common.log_output(message, False, r.status_code)
+            # Jitter keeps many failed uploads from retrying in lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+# Run the daemon for the task server at url
+def run(data, url, interval=POLL_INTERVAL, jobs=JOBS, journal_path=None,
+        policy_path=None):
+    task_policy = policy.load(policy_path)
+    common.verify_token(data)
+    password = common.load_parameters(data, {}).get("password", None)
+    daemon = Daemon(data, url, interval, jobs, password, journal_path,
+                    task_policy)
+    daemon.run()
+    return data
@@ -0,0 +1,191 @@
+# Module for detecting configuration drift across the servers of a fleet
+# The backups and server settings of every server in the inventory are
+# fetched at the same time, normalized like for duc apply and hashed. Each
+# backup, matched by name, and the server settings are then grouped into
+# clusters of servers with identical configurations. The largest cluster is
+# taken as the reference and the fields in which the other clusters differ
+# are listed. Normalized configurations are kept in the snapshot store and
+# their hashes in a cache, so servers whose LastDataUpdateID didn't change
+# since the last scan are not fetched again.
+import apply
+import asyncio
+import client
+import common
+import config
+import inventory
+import json
+import models
+import os
+import settings
+import snapshot
+import sys
+
+# Key of the server settings in the scan of a server
+SETTINGS_KEY = "Server settings"
+
+
+# Location of the hash cache, next to the config file
+def get_cache_location():
+    directory = os.path.dirname(config.CONFIG_FILE)
+    return os.path.join(directory, "drift-cache.json")
+
+
+# Read the hash cache
+def read_cache():
+    try:
+        with open(get_cache_location(), 'r') as file_handle:
+            return json.load(file_handle)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+# Write the hash cache atomically
+def write_cache(cache):
+    snapshot.write_atomic(get_cache_location(), json.dumps(cache))
+
+
+# Key of a server in the cache
+def cache_key(server):
+    return server.name + " " + common.create_baseurl(server.data)
+
+
+# Store a document in the snapshot store and return its hash
+def store(store_path, document):
+    content, digest = snapshot.serialize(document)
+    path = snapshot.object_path(store_path, digest)
+    if not os.path.isfile(path):
+        snapshot.write_atomic(path, content)
+    return digest
+
+
+# Hash the backups and settings of a server
+# Returns the scan of the server and whether it was fetched
+async def scan(server, duplicati, cached, store_path, refresh=False):
+    try:
+        state = await duplicati.server_state()
+        update_id = state.get("LastDataUpdateID", None)
+    except client.DuplicatiError:
+        update_id = None
+    if not refresh and update_id is not None and cached is not None and \
+            cached.get("DataUpdateID", None) == update_id:
+        return cached, False
+
+    items, server_settings = await asyncio.gather(
+        duplicati.list_resource("backups"), duplicati.server_settings())
+    hashes = {}
+    for item in items:
+        backup = models.Backup(item)
+        name = backup.name
+        if name in hashes:
+            name += " (ID:" + str(backup.id) + ")"
+        hashes[name] = store(store_path, apply.normalize(item))
+    hashes[SETTINGS_KEY] = store(store_path,
+                                 settings.visible(server_settings))
+    return {"DataUpdateID": update_id, "Hashes": hashes}, True
+
+
+# Group servers by the hash of a configuration, largest group first
+# hashes maps server names to hashes, None for servers without it
+def clusters(hashes):
+    groups = {}
+    for name in sorted(hashes):
+        if hashes[name] is not None:
+            groups.setdefault(hashes[name], []).append(name)
+    return sorted(groups.items(), key=lambda group: (-len(group[1]),
+                                                     group[1][0]))
+
+
+# Configuration in a shape that names the changed options in diffs
+def comparable(document):
+    document = json.loads(json.dumps(document))
+    backup = document.get("Backup", None)
+    if isinstance(backup, dict) and isinstance(backup.get("Settings", None),
+                                               list):
+        options = {}
+        for option in backup["Settings"]:
+            if isinstance(option, dict) and "Name" in option:
+                options[option["Name"]] = option.get("Value", None)
+        backup["Settings"] = options
+    return document
+
+
+# Fields that differ between two stored configurations
+def changed_fields(store_path, reference, digest):
+    try:
+        old = comparable(snapshot.read_object(store_path, reference))
+        new = comparable(snapshot.read_object(store_path, digest))
+    except (IOError, OSError, ValueError):
+        # The store was cleaned up since the hashes were cached
+        return []
+    fields = set(apply.diff(old, new)) | set(apply.diff(new, old))
+    return sorted(fields)
+
+
+# Compare the scans of all servers, returning the report of every drifted
+# configuration as (name, clusters, missing) with the fields of every
+# cluster but the first
+def compare(scans, store_path):
+    names = set()
+    for scan_result in scans.values():
+        names.update(scan_result["Hashes"])
+
+    report = []
+    for name in sorted(names, key=lambda item: (item != SETTINGS_KEY, item)):
+        hashes = dict((server, scan_result["Hashes"].get(name, None))
+                      for server, scan_result in scans.items())
+        groups = clusters(hashes)
+        missing = sorted(server for server, digest in hashes.items()
+                         if digest is None)
+        if len(groups) <= 1 and len(missing) == 0:
+            continue
+        reference = groups[0][0]
+        detailed = []
+        for position, (digest, servers) in enumerate(groups):
+            fields = []
+            if position > 0:
+                fields = changed_fields(store_path, reference, digest)
+            detailed.append((digest, servers, fields))
+        report.append((name, detailed, missing))
+    return report
+
+
+# Scan all servers of the inventory and print the drifted configurations
+def run(data, inventory_path=None, refresh=False):
+    servers = inventory.load(data, inventory_path)
+    store_path = snapshot.get_store_location()
+    cache = read_cache()
+
+    async def scan_server(server, duplicati):
+        return await scan(server, duplicati, cache.get(cache_key(server)),
+                          store_path, refresh)
+
+    results = inventory.gather(servers, scan_server)
+    failed = inventory.report_errors(servers, results)
+    scans = {}
+    fetched = 0
+    for server, (result, error) in zip(servers, results):
+        if error is None:
+            scan_result, was_fetched = result
+            scans[server.name] = scan_result
+            cache[cache_key(server)] = scan_result
+            fetched += 1 if was_fetched else 0
+    write_cache(cache)
+
+    report = compare(scans, store_path)
+    for name, groups, missing in report:
+        message = name + ": " + str(len(groups)) + " variants"
+        common.log_output(message, True)
+        for digest, servers_in_group, fields in groups:
+            message = "  " + digest[:12] + "  " + ", ".join(servers_in_group)
+            if len(fields) > 0:
+                message += "\n      differs in " + ", ".join(fields)
+            common.log_output(message, True)
+        if len(missing) > 0:
+            common.log_output("  missing       " + ", ".join(missing), True)
+
+    message = "Scanned " + str(len(scans)) + " servers, fetched "
+    message += str(fetched) + ", " + str(len(report)) + " drifted"
+    common.log_output(message, True, 200 if failed == 0 else None)
+    if failed > 0:
+        sys.exit(2)
+    return report
@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
+import apply
 import arg_parser as ArgumentParser
+import archive
+import batch
+import client
 import config
+import daemon
+import drift
+import events
+import exporter
 import json
 import os.path
 import sys
@@ -8,23 +16,40 @@ import datetime
 import time
 import yaml
 import compatibility
+import completion
 import common
 import auth
 import helper
-
+import index
+import models
+import probe
+import profiling
+import requests_wrapper
+import settings
+import shell
+import snapshot
+import top
+import tracing
+
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser
 from os.path import splitext
 from requests_wrapper import requests_wrapper as requests
 
+# Backups exported at the same time
+EXPORT_WORKERS = 8
+
+# YAML dumping, tagged as a section of --profile reports
+safe_dump = profiling.section("yaml.safe_dump")(yaml.safe_dump)
+
 
 def main(**args):
     # Command method
-    method = sys.argv[1]
+    method = args.get("method", None)
 
-    if method == "version":
-        message = "Duplicati client version "
-        message += config.APPLICATION_VERSION
-        return common.log_output(message, True)
+    # Commands that don't need the configuration
+    if method in ["version", "completion"]:
+        return run_command(None, method, args)
 
     # Default values
     data = {
@@ -45,9 +70,93 @@ def main(**args):
     # Detect home dir for config file
     config.CONFIG_FILE = compatibility.get_config_location()
 
+    # Serve dynamic completions from the local cache without blocking
+    if method == "complete" and not args.get("refresh", False):
+        return completion.serve(load_config, data, args.get("kind", None))
+
     # Load configuration
     overwrite = args.get("overwrite", False)
-    data = load_config(data, overwrite)
+    with tracing.span("load config"):
+        data = load_config(data, overwrite)
+
+    # Start an interactive shell reusing the loaded configuration
+    if method == "shell":
+        return shell.run(data, run_command)
+
+    # Run the commands of a batch file over one session
+    if method == "batch":
+        return batch.run(data, run_command, args.get("file"),
+                         args.get("jobs", 4))
+
+    # Execute tasks from a task server until interrupted
+    if method == "daemon":
+        config.VERBOSE = data.get("verbose", False)
+        return daemon.run(data, args.get("url"), args.get("interval", 10),
+                          args.get("jobs", 4), args.get("journal", None),
+                          args.get("policy", None))
+
+    # Serve metrics to Prometheus until interrupted
+    if method == "exporter":
+        config.VERBOSE = data.get("verbose", False)
+        inventory_path = args.get("inventory", None)
+        if inventory_path is not None:
+            inventory_path = expanduser(inventory_path)
+        return exporter.run(data, args.get("listen", exporter.LISTEN),
+                            args.get("interval", exporter.POLL_INTERVAL),
+                            inventory_path)
+
+    # Measure the latency of the servers until interrupted
+    if method == "probe":
+        config.VERBOSE = data.get("verbose", False)
+        inventory_path = args.get("inventory", None)
+        if inventory_path is not None:
+            inventory_path = expanduser(inventory_path)
+        output = args.get("output", None)
+        if output not in [None, "-"]:
+            output = expanduser(output)
+        return probe.run(data, inventory_path, args.get("endpoint", None),
+                         args.get("rate", probe.RATE),
+                         args.get("interval", probe.INTERVAL),
+                         args.get("window", probe.WINDOW),
+                         args.get("duration", None), output,
+                         args.get("slo_p99", None),
+                         args.get("slo_errors", None))
+
+    # Stream state changes as events until interrupted
+    if method == "events":
+        config.VERBOSE = data.get("verbose", False)
+        inventory_path = args.get("inventory", None)
+        if inventory_path is not None:
+            inventory_path = expanduser(inventory_path)
+        return events.run(data, inventory_path,
+                          args.get("interval", events.INTERVAL),
+                          args.get("webhook", None), args.get("event", None),
+                          args.get("duration", None))
+
+    # Show the progress of running and queued backups until interrupted
+    if method == "top":
+        config.VERBOSE = data.get("verbose", False)
+        inventory_path = args.get("inventory", None)
+        if inventory_path is not None:
+            inventory_path = expanduser(inventory_path)
+        return top.run(data, inventory_path,
+                       args.get("interval", top.INTERVAL),
+                       args.get("once", False))
+
+    return run_command(data, method, args)
+
+
+# Run a single command against the loaded configuration
+def run_command(data, method, args):
+    if method == "version":
+        message = "Duplicati client version "
+        message += config.APPLICATION_VERSION
+        return common.log_output(message, True)
+
+    # Print a shell completion script
+    if method == "completion":
+        script = completion.generate(args.get("shell"), args.get("prog"))
+        return common.log_output(script, True)
 
     param_file = args.get("param-file", None)
     # Set parameters file
@@ -69,6 +178,10 @@ def main(**args):
     # Write verbosity setting to config variable
     config.VERBOSE = data.get("verbose", False)
 
+    # Refresh the completion cache, run in the background by completions
+    if method == "complete":
+        completion.refresh(data)
+
     # Display the config if requested
     if method == "config":
         display_config(data)
@@ -102,18 +215,18 @@ def main(**args):
     # Get resources
     if method == "get":
         resource_type = args.get("type", None)
-        resource_ids = args.get("id", None)
+        resource_ids = resolve_ids(data, resource_type, args.get("id", None))
         get_resources(data, resource_type, resource_ids)
 
     # Describe resources
     if method == "describe":
         resource_type = args.get("type", None)
-        resource_ids = args.get("id", None)
+        resource_ids = resolve_ids(data, resource_type, args.get("id", None))
         describe_resources(data, resource_type, resource_ids)
 
     # Set resource values
     if method == "set":
-        resource = sys.argv[2]
+        resource = args.get("resource", None)
         if resource == "password":
             password = args.get("password", None)
             disable_login = args.get("disable", False)
@@ -122,18 +235,18 @@ def main(**args):
 
     # Repair a database
     if method == "repair":
-        backup_id = args.get("id", None)
-        repair_database(data, backup_id)
+        for backup_id in index.resolve(data, args.get("id", None)):
+            repair_database(data, backup_id)
 
     # Verify remote data files
     if method == "verify":
-        backup_id = args.get("id", None)
-        verify_remote_files(data, backup_id)
+        for backup_id in index.resolve(data, args.get("id", None)):
+            verify_remote_files(data, backup_id)
 
     # Compact remote data
     if method == "compact":
-        backup_id = args.get("id", None)
-        compact_remote_files(data, backup_id)
+        for backup_id in index.resolve(data, args.get("id", None)):
+            compact_remote_files(data, backup_id)
 
     # Dismiss notifications
     if method == "dismiss":
@@ -147,6 +260,8 @@ def main(**args):
     if method == "logs":
         log_type = args.get("type", None)
         backup_id = args.get("id", None)
+        if backup_id is not None:
+            backup_id = index.resolve_one(data, backup_id)
         remote = args.get("remote", False)
         follow = args.get("follow", False)
         lines = args.get("lines", 10)
@@ -155,8 +270,8 @@ def main(**args):
 
     # Run backup
     if method == "run":
-        backup_id = args.get("id", None)
-        run_backup(data, backup_id)
+        for backup_id in index.resolve(data, args.get("id", None)):
+            run_backup(data, backup_id)
 
     # Abort backup
     if method == "abort":
@@ -168,13 +283,29 @@ def main(**args):
         import_type = args.get("type", None)
         import_file = args.get("import-file", None)
         import_meta = args.get("import_metadata", None)
+        from_dir = args.get("from_dir", None)
+        from_archive = args.get("from_archive", None)
 
-        import_resource(data, import_type, import_file, None, import_meta)
+        sources = [import_file, from_dir, from_archive]
+        if len([source for source in sources if source is not None]) > 1:
+            message = "Provide only one of a file, --from-dir or "
+            message += "--from-archive"
+            common.log_output(message, True)
+            sys.exit(2)
+        if from_dir is not None:
+            apply.create(data, expanduser(from_dir), import_meta,
+                         args.get("jobs", 4))
+        elif from_archive is not None:
+            archive.create(data, expanduser(from_archive), import_meta,
+                           args.get("jobs", 4))
+        else:
+            import_resource(data, import_type, import_file, None,
+                            import_meta)
 
     # Update method
     if method == "update":
         import_type = args.get("type", None)
-        import_id = args.get("id", None)
+        import_id = index.resolve_one(data, args.get("id", None))
         import_file = args.get("import-file", None)
         # import-metadata is the inverse of strip-metadata
         import_meta = not args.get("strip_metadata", False)
@@ -183,24 +314,109 @@ def main(**args):
 
     # Delete a resource
     if method == "delete":
-        resource_id = args.get("id", None)
         resource_type = args.get("type", None)
+        resource_ids = resolve_ids(data, resource_type, args.get("id", None))
         delete_db = args.get("delete_db", False)
         confirm = args.get("confirm", False)
         recreate = args.get("recreate", False)
-        delete_resource(data, resource_type, resource_id,
-                        confirm, delete_db, recreate)
+        for resource_id in resource_ids:
+            delete_resource(data, resource_type, resource_id,
+                            confirm, delete_db, recreate)
 
     # Export method
     if method == "export":
         resource_type = args.get("type", None)
-        resource_id = args.get("id", None)
+        resource_ids = args.get("id", None) or []
         output_type = args.get("output", None)
         path = args.get("output_path", None)
         all_ids = args.get("all", False)
         timestamp = args.get("timestamp", False)
-        export_resource(data, resource_type, resource_id, output_type,
-                        path, all_ids, timestamp)
+        archive_path = args.get("archive", None)
+        if resource_type == "backup":
+            if len(resource_ids) == 0 and not all_ids:
+                common.log_output("A backup id must be provided", True)
+                sys.exit(2)
+            if not all_ids:
+                resource_ids = index.resolve(data, resource_ids)
+        if archive_path is not None:
+            # The server settings are always part of an archive
+            all_ids = all_ids or resource_type == "serversettings"
+            archive.export(data, expanduser(archive_path), resource_ids,
+                           all_ids, output_type)
+        elif resource_type == "backup":
+            export_backups(data, resource_ids, output_type, path, all_ids,
+                           timestamp)
+        else:
+            export_resource(data, resource_type, None, output_type, path,
+                            all_ids, timestamp)
+
+    # Apply method
+    if method == "apply":
+        apply.run(data, expanduser(args.get("directory")),
+                  args.get("dry_run", False), args.get("delete", False),
+                  args.get("jobs", 4))
+
+    # Settings method
+    if method == "settings" and args.get("action", None) == "apply":
+        inventory_path = args.get("inventory", None)
+        if inventory_path is not None:
+            inventory_path = expanduser(inventory_path)
+        settings.apply_file(data, expanduser(args.get("file")),
+                            inventory_path, args.get("dry_run", False))
+
+    # Drift method
+    if method == "drift":
+        inventory_path = args.get("inventory", None)
+        if inventory_path is not None:
+            inventory_path = expanduser(inventory_path)
+        drift.run(data, inventory_path, args.get("refresh", False))
+
+    # Snapshot method
+    if method == "snapshot":
+        store = args.get("store", None)
+        if store is not None:
+            store = expanduser(store)
+        if args.get("list", False):
+            snapshot.display_runs(data, store)
+        elif args.get("since", None) is not None:
+            snapshot.display_changes(data, args["since"], store)
+        else:
+            snapshot.take(data, store)
+
+    return data
+
+
+# Client for the loaded configuration
+# It shares the session and cache of the CLI, and leaves logging in again to
+# common.verify_token so expired sessions are handled like before
+def get_client(data):
+    return client.DuplicatiClient(data, http=requests, persist=True,
+                                  relogin=False)
+
+
+# Client with its own connection pool for workers concurrent requests
+def get_pooled_client(data, workers):
+    return client.pooled_client(data, workers, persist=True, relogin=False)
+
+
+# Report an error raised by the client and exit
+def fail(error):
+    common.log_output(error.message, True, error.status_code)
+    sys.exit(2)
+
+
+# Report an error raised by the client, exiting only on failed connections
+def report(error):
+    if error.status_code in client.CONNECTION_ERRORS:
+        fail(error)
+    common.log_output(error.message, True, error.status_code)
+
+
+# Resolve ID selectors, backups are looked up in the backup index
+def resolve_ids(data, resource_type, selectors):
+    if resource_type in ["backup", "database"]:
+        return index.resolve(data, selectors)
+    return index.parse_ids(selectors)
 
 
 # Function for display a list of resources
@@ -211,160 +427,130 @@ def list_resources(data, resource):
         resource_list = fetch_backup_list(data)
     elif resource == "databases":
         resource_list = fetch_database_list(data)
+    elif resource == "notifications":
+        resource_list = fetch_resource_list(data, resource, True)
     else:
         resource_list = fetch_resource_list(data, resource)
 
-    resource_list = list_filter(resource_list, resource)
+    # Systeminfo is a single object rather than a list
+    if resource == "systeminfo":
+        if len(resource_list) == 0:
+            common.log_output("No items found", True)
+            sys.exit(2)
+        message = safe_dump(resource_list, default_flow_style=False)
+        common.log_output(message, True, 200)
+        return
 
-    if len(resource_list) == 0:
+    # Filter and output one item at a time to avoid holding the whole list
+    count = 0
+    for item in iterate_list_filter(resource_list, resource):
+        count += 1
+        # Must use safe_dump for python 2 compatibility
+        with tracing.span("dump yaml"):
+            message = safe_dump([item], default_flow_style=False)
+        common.log_output(message.rstrip("\n"), True)
+
+    if count == 0:
         common.log_output("No items found", True)
         sys.exit(2)
 
-    # Must use safe_dump for python 2 compatibility
-    message = yaml.safe_dump(resource_list, default_flow_style=False)
-    common.log_output(message, True, 200)
+    common.log_output("", True, 200)
 
 
-# Fetch all backups
+# Fetch all backups, yielding them one at a time
 def fetch_backup_list(data):
-    backups = fetch_resource_list(data, "backups")
-
-    # Fetch progress state
-    progress_state, active_id = fetch_progress_state(data)
-    progress = progress_state.get("OverallProgress", 1)
-
-    backup_list = []
-    for backup in backups:
-        backup_id = backup.get("Backup", {}).get("ID", 0)
-        if active_id is not None and backup_id == active_id and progress != 1:
-            backup["Progress"] = progress_state
-        backup_list.append(backup)
-
-    return backup_list
+    common.log_output("Fetching backups list from API...", False)
+    try:
+        for backup in get_client(data).iter_backups():
+            yield backup.raw
+    except client.DuplicatiError as error:
+        fail(error)
 
 
-# Fetch all databases
+# Fetch all databases, yielding them one at a time
 def fetch_database_list(data):
-    databases = fetch_resource_list(data, "backups")
+    duplicati = get_client(data)
+    databases = fetch_resource_list(data, "backups", True)
 
-    database_list = []
-    for backup in databases:
-        db_path = backup.get("Backup", {}).get("DBPath", "")
-        db_exists = validate_database_exists(data, db_path)
+    for item in databases:
+        backup = models.Backup(item)
+        db_exists = duplicati.database_exists(backup.db_path)
         database = {
-            "Backup": backup.get("Backup", {}).get("Name", 0),
-            "DBPath": db_path,
-            "ID": backup.get("Backup", {}).get("ID", 0),
+            "Backup": backup.name,
+            "DBPath": backup.db_path,
+            "ID": backup.id,
             "Exists": db_exists
         }
-        database_list.append(database)
-
-    return database_list
-
-
-# Validate that the database exists on the server
-def validate_database_exists(data, db_path):
-    common.verify_token(data)
-
-    # api/v1/filesystem/validate
-    baseurl = common.create_baseurl(data, "/api/v1/filesystem/validate")
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    payload = {'path': db_path}
-    verify = data.get("server", {}).get("verify", True)
-    r = requests.post(baseurl, headers=headers, params=payload,
-                      cookies=cookies, verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code != 200:
-        return False
-    return True
+        yield database
 
 
 # Fetch all resources of a certain type
-def fetch_resource_list(data, resource):
-    baseurl = common.create_baseurl(data, "/api/v1/" + resource)
+# With stream set the result is an iterator decoding list items on demand
+def fetch_resource_list(data, resource, stream=False):
     common.log_output("Fetching " + resource + " list from API...", False)
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    r = requests.get(baseurl, headers=headers, cookies=cookies, verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code == 404:
-        common.log_output("No entries found", True, r.status_code)
-        sys.exit(2)
-    elif r.status_code != 200:
-        common.log_output("Error connecting", True, r.status_code)
-        sys.exit(2)
-    else:
-        return r.json()
+    try:
+        return get_client(data).list_resource(resource, stream)
+    except client.DuplicatiError as error:
+        fail(error)
 
 
 # Filter logic for the list function to facilitate readable output
+@profiling.section("list_filter")
 def list_filter(json_input, resource):
-    resource_list = []
+    if resource not in ["backups", "notifications", "serversettings"]:
+        return json_input
+    return list(iterate_list_filter(json_input, resource))
+
+
+# Lazy version of list_filter yielding one filtered item at a time
+@profiling.section("iterate_list_filter")
+def iterate_list_filter(json_input, resource):
     if resource == "backups":
-        for key in json_input:
-            backup = key.get("Backup", None)
-            schedule = key.get("Schedule", None)
-            progress_state = key.get("Progress", None)
-            backup_name = backup.get("Name", "")
-            backup = {
-                backup_name: {
-                    "ID": backup.get("ID", ""),
-                }
+        for item in json_input:
+            backup = models.Backup(item)
+            entry = {
+                "ID": backup.id,
             }
 
-            if backup.get('Metadata', {}).get('SourceSizeString') is not None:
-                size = backup.get('Metadata', {}).get('SourceSizeString')
-                backup[backup_name]["Source size"] = size
+            size = backup.metadata.source_size_string
+            if size is not None:
+                entry["Source size"] = size
 
+            schedule = backup.schedule
             if schedule is not None:
-                next_run = helper.format_time(schedule.get("Time", ""))
+                next_run = helper.format_datetime(schedule.next_run)
                 if next_run is not None:
-                    backup[backup_name]["Next run"] = next_run
+                    entry["Next run"] = next_run
 
-                last_run = helper.format_time(schedule.get("LastRun", ""))
+                last_run = helper.format_datetime(schedule.last_run)
                 if last_run is not None:
-                    backup[backup_name]["Last run"] = last_run
+                    entry["Last run"] = last_run
 
+            progress_state = backup.progress
             if progress_state is not None:
-                backup[backup_name]["Running"] = {
-                    "Task ID": progress_state.get("TaskID", None),
-                    "State": progress_state.get("Phase", None),
+                entry["Running"] = {
+                    "Task ID": progress_state.task_id,
+                    "State": progress_state.phase,
                 }
 
-            resource_list.append(backup)
+            yield {backup.name: entry}
 
     elif resource == "notifications":
-        for val in json_input:
-            notification = {
-                val.get("Title", ""): {
-                    "Backup ID": val.get("BackupID", ""),
-                    "Notification ID": val.get("ID", ""),
-                }
+        for item in json_input:
+            notification = models.Notification(item)
+            entry = {
+                "Backup ID": notification.backup_id,
+                "Notification ID": notification.id,
             }
-            timestamp = helper.format_time(val.get("Timestamp", ""))
+            timestamp = helper.format_datetime(notification.timestamp)
             if timestamp is not None:
-                notification["Timestamp"] = timestamp
+                entry["Timestamp"] = timestamp
 
-            resource_list.append(notification)
+            yield {notification.raw.get("Title", ""): entry}
 
     elif resource == "serversettings":
         for key, value in json_input.items():
-            hidden_values = [
-                "update-check-latest",
-                "last-update-check",
-                "is-first-run",
-                "update-check-interval",
-                "server-passphrase",
-                "server-passphrase-salt",
-                "server-passphrase-trayicon",
-                "server-passphrase-trayicon-hash",
-                "unacked-error",
-                "unacked-warning",
-                "has-fixed-invalid-backup-id",
-            ]
-            if key in hidden_values:
+            if key in settings.HIDDEN_SETTINGS:
                 continue
             setting = {
                 key: {
@@ -372,11 +558,10 @@ def list_filter(json_input, resource):
                 }
             }
 
-            resource_list.append(setting)
+            yield setting
     else:
-        resource_list = json_input
-
-    return resource_list
+        for item in json_input:
+            yield item
 
 
 # Get one or more resources with somewhat limited fields
@@ -386,7 +571,8 @@ def get_resources(data, resource_type, resource_ids):
     elif resource_type == "notification":
         result = fetch_notifications(data, resource_ids, "get")
 
-    message = yaml.safe_dump(result, default_flow_style=False)
+    with tracing.span("dump yaml"):
+        message = safe_dump(result, default_flow_style=False)
     common.log_output(message, True, 200)
 
 
@@ -398,7 +584,8 @@ def describe_resources(data, resource_type, resource_ids):
         result = fetch_notifications(data, resource_ids, "describe")
 
     # Must use safe_dump for python 2 compatibility
-    message = yaml.safe_dump(result, default_flow_style=False)
+    with tracing.span("dump yaml"):
+        message = safe_dump(result, default_flow_style=False)
     common.log_output(message, True, 200)
 
 
@@ -407,24 +594,15 @@ def fetch_notifications(data, notification_ids, method):
     common.verify_token(data)
 
     common.log_output("Fetching notifications from API...", False)
-    baseurl = common.create_baseurl(data, "/api/v1/notifications")
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    notification_list = []
-    r = requests.get(baseurl, headers=headers, cookies=cookies, verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code != 200:
-        id_list = ', '.join(notification_ids)
+    try:
+        notifications = get_client(data).get_notifications(notification_ids)
+    except client.DuplicatiError as error:
+        id_list = ', '.join([str(item) for item in notification_ids])
         message = "Error getting notifications " + id_list
-        common.log_output(message, True, r.status_code)
-    else:
-        data = r.json()
+        common.log_output(message, True, error.status_code)
+        notifications = []
 
-    for notification in data:
-        notification_id = notification.get("ID", -1)
-        if notification_id in notification_ids:
-            notification_list.append(notification)
+    notification_list = [notification.raw for notification in notifications]
 
     # Only get uses a filter
     if method == "get":
@@ -434,23 +612,23 @@ def fetch_notifications(data, notification_ids, method):
 
 
 # Filter logic for the notification get command
+@profiling.section("notification_filter")
+@tracing.traced("filter")
 def notification_filter(json_input):
     notification_list = []
-    for key in json_input:
-        title = key.get("Title", "Notification")
-        notification = {
-            title: {
-                "Backup ID": key.get("BackupID", ""),
-                "Notification ID": key.get("ID", ""),
-                "Message": key.get("Message", ""),
-                "Type": key.get("Type", ""),
-            }
+    for item in json_input:
+        notification = models.Notification(item)
+        entry = {
+            "Backup ID": notification.backup_id,
+            "Notification ID": notification.id,
+            "Message": notification.message,
+            "Type": notification.type,
         }
-        timestamp = helper.format_time(key.get("Timestamp", ""))
+        timestamp = helper.format_datetime(notification.timestamp)
         if timestamp is not None:
-            notification[title]["Timestamp"] = timestamp
+            entry["Timestamp"] = timestamp
 
-        notification_list.append(notification)
+        notification_list.append({notification.title: entry})
 
     return notification_list
 
@@ -460,29 +638,17 @@ def fetch_backups(data, backup_ids, method):
     common.verify_token(data)
 
     common.log_output("Fetching backups from API...", False)
-    progress_state, active_id = fetch_progress_state(data)
-    progress = progress_state.get("OverallProgress", 1)
+    duplicati = get_client(data)
+    progress = duplicati.progress_state()
     backup_list = []
-    baseurl = common.create_baseurl(data, "/api/v1/backup/")
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
     # Iterate over backup_ids and fetch their info
     for backup_id in backup_ids:
-        r = requests.get(baseurl + str(backup_id), headers=headers,
-                         cookies=cookies, verify=verify)
-        common.check_response(data, r.status_code)
-        if r.status_code != 200:
-            message = "Error getting backup " + str(backup_id)
-            common.log_output(message, True, r.status_code)
+        try:
+            backup = duplicati.get_backup(backup_id, progress)
+        except client.DuplicatiError as error:
+            report(error)
             continue
-        backup = r.json()["data"]
-
-        item_id = backup.get("Backup", {}).get("ID", 0)
-        if active_id is not None and item_id == active_id and progress != 1:
-            backup["Progress"] = progress_state
-
-        backup_list.append(backup)
+        backup_list.append(backup.raw)
 
     if len(backup_list) == 0:
         sys.exit(2)
@@ -496,121 +662,95 @@ def fetch_backups(data, backup_ids, method):
 
 # Fetch backup progress state
 def fetch_progress_state(data):
-    baseurl = common.create_baseurl(data, "/api/v1/progressstate")
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    # Check progress state and get info for the running backup
-    r = requests.get(baseurl, headers=headers, cookies=cookies, verify=verify)
-    if r.status_code != 200:
-        active_id = -1
-        progress_state = {}
-    else:
-        progress_state = r.json()
-        active_id = progress_state.get("BackupID", -1)
-
+    progress = get_client(data).progress_state()
     # Don't show progress on finished tasks
-    phase = progress_state.get("Phase", "")
-    if phase in ["Backup_Complete", "Error"]:
+    if progress is None:
         return {}, 0
-
-    return progress_state, active_id
+    return progress.raw, progress.backup_id
 
 
 # Filter logic for the fetch backup/backups methods
+@profiling.section("backup_filter")
+@tracing.traced("filter")
 def backup_filter(json_input):
     backup_list = []
-    for key in json_input:
-        backup = key.pop("Backup", {})
-        metadata = backup.pop("Metadata", {})
-        backup_name = backup.pop("Name", {})
-        backup = {
-            "ID": backup.get("ID", ""),
-            "Local database": backup.get("DBPath", ""),
+    for item in json_input:
+        backup = models.Backup(item)
+        metadata = backup.metadata
+        entry = {
+            "ID": backup.id,
+            "Local database": backup.db_path,
         }
-        backup["Versions"] = int(metadata.get("BackupListCount", 0))
-        backup["Last run"] = {
+        entry["Versions"] = metadata.versions
+        entry["Last run"] = {
             "Duration":
-            helper.format_duration(metadata.get("LastBackupDuration", "0")),
+            helper.format_duration(metadata.last_duration),
             "Started":
-            helper.format_time(metadata.get("LastBackupStarted", "0")),
+            helper.format_datetime(metadata.last_started),
             "Stopped":
-            helper.format_time(metadata.get("LastBackupFinished", "0")),
+            helper.format_datetime(metadata.last_finished),
         }
-        backup["Size"] = {
-            "Local": metadata.get("SourceSizeString", ""),
-            "Backend": metadata.get("TargetSizeString", "")
+        entry["Size"] = {
+            "Local": metadata.source_size_string or "",
+            "Backend": metadata.target_size_string or ""
         }
 
-        schedule = key.get("Schedule", None)
+        schedule = backup.schedule
         if schedule is not None:
-            next_run = helper.format_time(schedule.pop("Time", ""))
-            if next_run is not None:
-                schedule["Next run"] = next_run
-            last_run = helper.format_time(schedule.pop("LastRun", ""))
-            if last_run is not None:
-                schedule["Last run"] = last_run
-            schedule.pop("AllowedDays", None)
-            schedule.pop("ID", None)
-            schedule.pop("Rule", None)
-            schedule.pop("Tags", None)
-            backup["Schedule"] = schedule
-
-        progress_state = key.get("Progress", None)
+            entry["Schedule"] = schedule.summary()
+
+        progress_state = backup.progress
         if progress_state is not None:
-            state = progress_state.get("Phase", None)
-            speed = progress_state.get("BackendSpeed", 0)
-            progress = {
-                "State": state,
-                "Counting files": progress_state.get("StillCounting", False),
-                "Backend": {
-                    "Action": progress_state.get("BackendAction", 0)
-                },
-                "Task ID": progress_state.get("TaskID", -1),
-            }
-            if speed > 0:
-                readable_speed = helper.format_bytes(speed) + "/s"
-                progress["Backend"]["Speed"] = readable_speed
-
-            # Display item only if relevant
-            if not progress_state.get("StillCounting", False):
-                progress.pop("Counting files")
-            # Avoid 0 division
-            file_count = progress_state.get("ProcessedFileCount", 0)
-            total_file_count = progress_state.get("TotalFileCount", 0)
-            processing = state == "Backup_ProcessingFiles"
-            if file_count > 0 and total_file_count > 0 and processing:
-                processed = "{0:.2f}".format(file_count /
-                                             total_file_count * 100)
-                progress["Processed files"] = processed + "%"
-            # Avoid 0 division
-            data_size = progress_state.get("ProcessedFileSize", 0)
-            total_data_size = progress_state.get("TotalFileSize", 0)
-            processing = state == "Backup_ProcessingFiles"
-            if data_size > 0 and total_data_size > 0 and processing:
-                # Calculate percentage
-                processed = "{0:.2f}".format(data_size / total_data_size * 100)
-                # Format text "x% (y GB of z GB)"
-                processed += "% (" + str(helper.format_bytes(data_size))
-                processed += " of "
-                processed += str(helper.format_bytes(total_data_size)) + ")"
-                progress["Processed data"] = processed
-            # Avoid 0 division
-            current = progress_state.get("BackendFileProgress", 0)
-            total = progress_state.get("BackendFileSize", 0)
-            if current > 0 and total > 0:
-                backend_progress = "{0:.2f}".format(current / total * 100)
-                progress["Backend"]["Progress"] = backend_progress + "%"
-            backup["Progress"] = progress
-
-        key = {
-            backup_name: backup
-        }
-        backup_list.append(key)
+            entry["Progress"] = progress_filter(progress_state)
+
+        backup_list.append({backup.name: entry})
 
     return backup_list
 
 
+# Filter logic for the progress of a running backup
+def progress_filter(progress_state):
+    state = progress_state.phase
+    speed = progress_state.backend_speed
+    progress = {
+        "State": state,
+        "Counting files": progress_state.still_counting,
+        "Backend": {
+            "Action": progress_state.backend_action
+        },
+        "Task ID": progress_state.task_id,
+    }
+    if speed > 0:
+        readable_speed = helper.format_bytes(speed) + "/s"
+        progress["Backend"]["Speed"] = readable_speed
+
+    # Display item only if relevant
+    if not progress_state.still_counting:
+        progress.pop("Counting files")
+
+    processing = progress_state.processing_files
+    percentage = progress_state.file_percentage
+    if percentage is not None and processing:
+        progress["Processed files"] = "{0:.2f}".format(percentage) + "%"
+
+    percentage = progress_state.size_percentage
+    if percentage is not None and processing:
+        data_size = progress_state.processed_file_size
+        total_data_size = progress_state.total_file_size
+        # Format text "x% (y GB of z GB)"
+        processed = "{0:.2f}".format(percentage)
+        processed += "% (" + str(helper.format_bytes(data_size))
+        processed += " of "
+        processed += str(helper.format_bytes(total_data_size)) + ")"
+        progress["Processed data"] = processed
+
+    percentage = progress_state.backend_percentage
+    if percentage is not None:
+        progress["Backend"]["Progress"] = "{0:.2f}".format(percentage) + "%"
+
+    return progress
+
+
 # Dimiss notifications
 def dismiss_notifications(data, resource_id="all"):
     common.verify_token(data)
@@ -663,153 +803,108 @@ def get_logs(data, log_type, backup_id, remote=False,
 
 
 # Get local and remote backup logs
+@profiling.section("backup_logs")
 def get_backup_logs(data, backup_id, log_type, page_size=5, show_all=False):
-    endpoint = "/api/v1/backup/" + str(backup_id) + "/" + log_type
-    baseurl = common.create_baseurl(data, endpoint)
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    params = {'pagesize': page_size}
-
-    r = requests.get(baseurl, headers=headers, cookies=cookies, params=params,
-                     verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code == 500:
-        message = "Error getting log, "
-        message += "database may be locked by backup"
-        common.log_output(message, True)
-        return
-    elif r.status_code != 200:
-        common.log_output("Error getting log", True, r.status_code)
-        return
+    remote = log_type == "remotelog"
+    try:
+        result = get_client(data).backup_logs(backup_id, remote, page_size)
+    except client.DuplicatiError as error:
+        return report(error)
 
-    result = r.json()[-page_size:]
     logs = []
-    for log in result:
-        if log.get("Operation", "") == "list":
-            log["Data"] = "Expunged"
-        else:
-            log["Data"] = json.loads(log.get("Data", "{}"))
+    for entry in result:
+        log = log_filter(entry, show_all)
+        log["Data"] = entry.data
+        if log["Data"] != "Expunged":
+            log["Data"] = dict(log["Data"])
             size = helper.format_bytes(log["Data"].get("Size", 0))
             log["Data"]["Size"] = size
-
-        if log.get("Message", None) is not None:
-            log["Message"] = log["Message"].split("\n")
-            message_length = len(log["Message"])
-            if message_length > 15 and not show_all:
-                log["Message"] = log["Message"][:15]
-                lines = str(message_length - 15)
-                hidden_message = lines + " hidden lines (show with --all)"
-                log["Message"].append(hidden_message)
-        if log.get("Exception", None) is not None:
-            log["Exception"] = log["Exception"].split("\n")
-            exception_length = len(log["Exception"])
-            if exception_length > 15 and not show_all:
-                log["Exception"] = log["Exception"][:15]
-                lines = str(exception_length - 15)
-                hidden_message = lines + " hidden lines (show with --all)"
-                log["Exception"].append(hidden_message)
-
-        log["Timestamp"] = datetime.datetime.fromtimestamp(
-            int(log.get("Timestamp", 0))
-        ).strftime("%I:%M:%S %p %d/%m/%Y")
+        log["Timestamp"] = helper.format_datetime(entry.timestamp, True)
         logs.append(log)
-    message = yaml.safe_dump(logs, default_flow_style=False)
+    message = safe_dump(logs, default_flow_style=False)
     common.log_output(message, True)
 
 
 # Get live logs
+@profiling.section("live_logs")
 def get_live_logs(data, level, page_size=5, first_id=0):
-    baseurl = common.create_baseurl(data, "/api/v1/logdata/poll")
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    params = {'level': level, 'id': first_id, 'pagesize': page_size}
-
-    r = requests.get(baseurl, headers=headers, cookies=cookies, params=params,
-                     verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code == 500:
-        message = "Error getting log, "
-        message += "database may be locked by backup"
-        common.log_output(message, True)
-        return
-    elif r.status_code != 200:
-        common.log_output("Error getting log", True, r.status_code)
-        return
+    try:
+        result = get_client(data).live_logs(level, page_size, first_id)
+    except client.DuplicatiError as error:
+        return report(error)
 
-    result = r.json()[-page_size:]
     logs = []
-    for log in result:
-        log["When"] = helper.format_time(log.get("When", ""), True)
+    for entry in result:
+        log = dict(entry.raw)
+        log["When"] = helper.format_datetime(entry.timestamp, True)
         logs.append(log)
 
     if len(logs) == 0:
         common.log_output("No log entries found", True)
         return
 
-    message = yaml.safe_dump(logs, default_flow_style=False)
+    message = safe_dump(logs, default_flow_style=False)
     common.log_output(message, True)
 
 
 # Get stored logs
+@profiling.section("stored_logs")
 def get_stored_logs(data, page_size=5, show_all=False):
-    baseurl = common.create_baseurl(data, "/api/v1/logdata/log")
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    params = {'pagesize': page_size}
-
-    r = requests.get(baseurl, headers=headers, cookies=cookies, params=params,
-                     verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code == 500:
-        message = "Error getting log, "
-        message += "database may be locked by backup"
-        common.log_output(message, True)
-        return
-    elif r.status_code != 200:
-        common.log_output("Error getting log", True, r.status_code)
-        return
+    try:
+        result = get_client(data).stored_logs(page_size)
+    except client.DuplicatiError as error:
+        return report(error)
 
-    result = r.json()[-page_size:]
     logs = []
-    for log in result:
-        if log.get("Message", None) is not None:
-            log["Message"] = log["Message"].split("\n")
-            message_length = len(log["Message"])
-            if message_length > 15 and not show_all:
-                log["Message"] = log["Message"][:15]
-                lines = str(message_length - 15)
-                hidden_message = lines + " hidden lines (show with --all)"
-                log["Message"].append(hidden_message)
-        if log.get("Exception", None) is not None:
-            log["Exception"] = log["Exception"].split("\n")
-            exception_length = len(log["Exception"])
-            if exception_length > 15 and not show_all:
-                log["Exception"] = log["Exception"][:15]
-                lines = str(exception_length - 15)
-                hidden_message = lines + " hidden lines (show with --all)"
-                log["Exception"].append(hidden_message)
-        logs.append(log)
+    for entry in result:
+        logs.append(log_filter(entry, show_all))
 
     if len(logs) == 0:
         common.log_output("No log entries found", True)
         return
 
-    message = yaml.safe_dump(logs, default_flow_style=False)
+    message = safe_dump(logs, default_flow_style=False)
     common.log_output(message, True)
 
 
+# Filter logic for log entries, splitting long messages and exceptions
+@profiling.section("log_filter")
+def log_filter(entry, show_all=False):
+    log = dict(entry.raw)
+    message = entry.message_lines(show_all)
+    if message is not None:
+        log["Message"] = message
+    exception = entry.exception_lines(show_all)
+    if exception is not None:
+        log["Exception"] = exception
+    return log
+
+
 # Repeatedly call other functions until interrupted
+# The output of every call is captured and the screen only redrawn when it
+# changed, otherwise just the timestamp below it is rewritten in place
 def follow_function(function, interval=5):
+    shown = None
     try:
         while True:
-            compatibility.clear_prompt()
-            function()
+            # The shell caches GET responses, following needs fresh ones
+            requests_wrapper.clear_cache()
+            common.start_capture()
+            try:
+                function()
+            finally:
+                text, code = common.stop_capture()
+                if text != shown:
+                    compatibility.clear_prompt()
+                    if text != "":
+                        common.log_output(text, True)
             timestamp = helper.format_time(datetime.datetime.now(), True)
-            common.log_output(timestamp, True)
-            common.log_output("Press control+C to quit", True)
+            if text != shown:
+                common.log_output(timestamp, True)
+                common.log_output("Press control+C to quit", True)
+                shown = text
+            else:
+                compatibility.rewrite_line(2, timestamp)
             time.sleep(interval)
     except KeyboardInterrupt:
         return
@@ -819,16 +914,10 @@ def follow_function(function, interval=5):
 def run_backup(data, backup_id):
     common.verify_token(data)
 
-    path = "/api/v1/backup/" + str(backup_id) + "/run"
-    baseurl = common.create_baseurl(data, path)
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    r = requests.post(baseurl, headers=headers, cookies=cookies, verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code != 200:
-        common.log_output("Error scheduling backup ", True, r.status_code)
-        return
+    try:
+        get_client(data).run(backup_id)
+    except client.DuplicatiError as error:
+        return report(error)
     common.log_output("Backup scheduled", True, 200)
 
 
@@ -836,16 +925,10 @@ def run_backup(data, backup_id):
 def abort_task(data, task_id):
     common.verify_token(data)
 
-    path = "/api/v1/task/" + str(task_id) + "/abort"
-    baseurl = common.create_baseurl(data, path)
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    r = requests.post(baseurl, headers=headers, cookies=cookies, verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code != 200:
-        common.log_output("Error aborting task ", True, r.status_code)
-        return
+    try:
+        get_client(data).abort(task_id)
+    except client.DuplicatiError as error:
+        return report(error)
     common.log_output("Task aborted", True, 200)
 
 
@@ -879,19 +962,12 @@ def delete_backup(data, backup_id, confirm=False, delete_db=False):
             common.log_output("Backup not deleted", True)
             return
 
-    baseurl = common.create_baseurl(data, "/api/v1/backup/" + str(backup_id))
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
     # We cannot delete remote files because the captcha is graphical
-    payload = {'delete-local-db': delete_db, 'delete-remote-files': False}
-
-    r = requests.delete(baseurl, headers=headers, cookies=cookies,
-                        params=payload, verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code != 200:
-        common.log_output("Error deleting backup", True, r.status_code)
-        return
+    try:
+        get_client(data).delete_backup(backup_id, delete_db)
+    except client.DuplicatiError as error:
+        return report(error)
+    index.remove(data, backup_id)
     common.log_output("Backup deleted", True, 200)
 
 
@@ -915,18 +991,10 @@ def delete_database(data, backup_id, confirm=False, recreate=False):
             common.log_output("Database not deleted", True)
             return
 
-    baseurl = common.create_baseurl(data, "/api/v1/backup/" +
-                                    str(backup_id) + "/deletedb")
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-
-    r = requests.post(baseurl, headers=headers, cookies=cookies,
-                      verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code != 200:
-        common.log_output("Error deleting database", True, r.status_code)
-        return
+    try:
+        get_client(data).delete_database(backup_id)
+    except client.DuplicatiError as error:
+        return report(error)
     common.log_output("Database deleted", True, 200)
     if recreate:
         repair_database(data, backup_id)
@@ -934,43 +1002,38 @@ def delete_database(data, backup_id, confirm=False, recreate=False):
 
 # Repair the database
 def repair_database(data, backup_id):
-    url = "/api/v1/backup/" + backup_id + "/repair"
     fail_message = "Failed to initialize database repair"
     success_message = "Initialized database repair"
-    call_backup_subcommand(data, url, fail_message, success_message)
+    call_backup_subcommand(data, backup_id, "repair", fail_message,
+                           success_message)
 
 
 # Verify the remote data files
 def verify_remote_files(data, backup_id):
-    url = "/api/v1/backup/" + backup_id + "/verify"
     fail_message = "Failed to initialize remote file verification"
     success_message = "Initialized remote file verification"
-    call_backup_subcommand(data, url, fail_message, success_message)
+    call_backup_subcommand(data, backup_id, "verify", fail_message,
+                           success_message)
 
 
 # Compact the remote data files
 def compact_remote_files(data, backup_id):
-    url = "/api/v1/backup/" + backup_id + "/compact"
     fail_message = "Failed to initialize remote data compaction"
     success_message = "Initialized remote file compaction"
-    call_backup_subcommand(data, url, fail_message, success_message)
+    call_backup_subcommand(data, backup_id, "compact", fail_message,
+                           success_message)
 
 
 # Method for calling various subcommands for backups
 # E.g. "/api/v1/backup/id/compact"
-def call_backup_subcommand(data, url, fail_message, success_message):
+def call_backup_subcommand(data, backup_id, command, fail_message,
+                           success_message):
     common.verify_token(data)
 
-    baseurl = common.create_baseurl(data, url)
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    r = requests.post(baseurl, headers=headers, cookies=cookies,
-                      verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code != 200:
-        common.log_output(fail_message, True, r.status_code)
-        return
+    try:
+        get_client(data).backup_command(backup_id, command, fail_message)
+    except client.DuplicatiError as error:
+        return report(error)
     common.log_output(success_message, True, 200)
 
 
@@ -978,44 +1041,21 @@ def call_backup_subcommand(data, url, fail_message, success_message):
 def delete_notification(data, notification_id):
     common.verify_token(data)
 
-    url = "/api/v1/notification/"
-    baseurl = common.create_baseurl(data, url + str(notification_id))
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    r = requests.delete(baseurl, headers=headers, cookies=cookies,
-                        verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code == 404:
-        common.log_output("Notification not found", True, r.status_code)
-        return
-    elif r.status_code != 200:
-        common.log_output("Error deleting notification", True, r.status_code)
-        return
+    try:
+        get_client(data).dismiss(notification_id)
+    except client.DuplicatiError as error:
+        return report(error)
     common.log_output("Notification deleted", True, 200)
 
 
 def update_backup(data, backup_id, backup_config, import_meta=True):
     common.verify_token(data)
 
-    # Strip metadata if requested
-    if import_meta is not None and not import_meta:
-        backup_config.get("Backup", {}).pop("Metadata", None)
-
-    baseurl = common.create_baseurl(data, "/api/v1/backup/" + str(backup_id))
-    cookies = common.create_cookies(data)
-    headers = common.create_headers(data)
-    verify = data.get("server", {}).get("verify", True)
-    payload = json.dumps(backup_config, default=str)
-    r = requests.put(baseurl, headers=headers, cookies=cookies,
-                     data=payload, verify=verify)
-    common.check_response(data, r.status_code)
-    if r.status_code == 404:
-        common.log_output("Backup not found", True, r.status_code)
-        return
-    elif r.status_code != 200:
-        common.log_output("Error updating backup", True, r.status_code)
-        return
+    try:
+        get_client(data).update_backup(backup_id, backup_config, import_meta)
+    except client.DuplicatiError as error:
+        return report(error)
+    index.update(data, backup_id, backup_config)
     common.log_output("Backup updated", True, 200)
 
 
@@ -1166,47 +1206,12 @@ def import_backup(data, import_file, backup_id=None, import_meta=None):
 
     common.verify_token(data)
 
-    # Strip metadata if requsted
-    if import_meta is None or import_meta is not True:
-        backup_config["Backup"]["Metadata"] = {}
-
-    # Prepare the imported JSON object as a string
-    backup_config = json.dumps(backup_config, default=str)
-
-    # Upload our JSON string as a file with requests
-    files = {
-        'config': ('backup_config.json', backup_config, 'application/json')
-    }
-
-    # Will eventually support passphrase encrypted configs, but we will
-    # need to decrypt them in the client in order to convert them
-    payload = {
-        'passphrase': '',
-        'import_metadata': import_meta,
-        'direct': True
-    }
-    cookies = common.create_cookies(data)
-    baseurl = common.create_baseurl(data, "/api/v1/backups/import", True)
-    verify = data.get("server", {}).get("verify", True)
-    r = requests.post(baseurl, files=files, cookies=cookies, data=payload,
-                      verify=verify)
-    common.check_response(data, r.status_code)
-    # Code for extracting error messages posted with inline javascript
-    # and with 200 OK http status code, preventing us from detecting
-    # the error otherwise.
     try:
-        text = r.text
-        start = text.index("if (rp) { rp('")+14
-        end = text.index(", line ")
-        error = text[start:end].replace("\\'", "'") + "."
-        common.log_output(error, True)
-        sys.exit(2)
-    except ValueError:
-        pass
-    if r.status_code != 200:
-        message = "Error importing backup configuration"
-        common.log_output(message, True, r.status_code)
-        sys.exit(2)
+        get_client(data).create_backup(backup_config, import_meta)
+    except client.DuplicatiError as error:
+        fail(error)
+    # The ID of the new backup is unknown, refresh the index on next use
+    index.invalidate(data)
     common.log_output("Backup job created", True, 200)
 
 
@@ -1214,44 +1219,109 @@ def import_backup(data, import_file, backup_id=None, import_meta=None):
 def export_resource(data, resource, resource_id, output=None,
                     path=None, all_ids=False, timestamp=False):
     if resource == "backup":
-        if all_ids:
-            # Get all backup configs
-            backups = fetch_backup_list(data)
-            for backup in backups:
-                export_backup(data, backup, output, path, timestamp)
-        else:
-            # Get backup config
-            result = fetch_backups(data, [resource_id], "describe")
-            if result is None or len(result) == 0:
-                common.log_output("Could not fetch backup", True)
-                return
-            backup = result[0]
-            create_backup_export(data, backup, output, path, timestamp)
+        ids = [] if resource_id is None else [resource_id]
+        export_backups(data, ids, output, path, all_ids, timestamp)
     if resource == "serversettings":
         result = fetch_resource_list(data, "serversettings")
         result = list_filter(result, resource)
         create_resource_export(data, result, "serversettings",
                                output, path, timestamp)
 
-# Export backup configuration to either YAML or JSON
-def create_backup_export(data, backup, output=None, path=None, timestamp=False):
-    # Strip Progress
-    backup.pop("Progress", None)
-
-    # Fetch server version
-    systeminfo = fetch_resource_list(data, "systeminfo")
 
-    if systeminfo.get("ServerVersion", None) is None:
+# Export backup configurations to YAML or JSON files
+# The configurations are fetched concurrently and the server version only
+# once. Files are named after the backups, and backups sharing a name get
+# their ID appended, so the same backups always end up in the same files.
+def export_backups(data, backup_ids, output=None, path=None, all_ids=False,
+                   timestamp=False):
+    common.verify_token(data)
+    duplicati = get_pooled_client(data, EXPORT_WORKERS)
+    try:
+        server_version = duplicati.system_info().get("ServerVersion", None)
+        if all_ids:
+            items = duplicati.list_resource("backups", True)
+            backup_ids = [models.Backup(item).id for item in items]
+    except client.DuplicatiError as error:
+        fail(error)
+    if server_version is None:
         common.log_output("Error exporting backup", True)
         sys.exit(2)
 
-    backup["CreatedByVersion"] = systeminfo["ServerVersion"]
-    create_resource_export(data, backup, backup['Backup']['Name'], output, path, timestamp)
+    def fetch(backup_id):
+        try:
+            return duplicati.export(backup_id, server_version)
+        except client.DuplicatiError as error:
+            return error
+
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        results = list(executor.map(fetch, backup_ids))
+
+    exports = []
+    failed = 0
+    for backup_id, result in zip(backup_ids, results):
+        if isinstance(result, client.DuplicatiError):
+            common.log_output(result.message, True, result.status_code)
+            failed += 1
+        else:
+            exports.append((backup_id, result))
+
+    # Number the exports of backups sharing a name by their ID
+    names = {}
+    for backup_id, backup in exports:
+        name = backup.get("Backup", {}).get("Name", "")
+        names[name] = names.get(name, 0) + 1
+    stamp = None
+    if timestamp:
+        stamp = datetime.datetime.now().strftime("%d.%m.%Y_%I.%M_%p")
+    files = []
+    for backup_id, backup in exports:
+        name = backup.get("Backup", {}).get("Name", "")
+        if names[name] > 1:
+            name += "_" + str(backup_id)
+        files.append((create_export_path(name, output, path, stamp), backup))
+
+    existing = [file_path for file_path, backup in files
+                if os.path.isfile(file_path)]
+    if len(existing) > 0:
+        message = str(len(existing)) + " of " + str(len(files))
+        message += ' files already exist, overwrite? [Y/n]:'
+        agree = input(message)
+        if agree not in ["Y", "y", "yes", "YES", ""]:
+            return
+
+    def write(item):
+        write_export(item[0], item[1], output)
+        return item[0]
+
+    if len(files) > 0:
+        create_export_directory(files[0][0])
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        for file_path in executor.map(write, files):
+            common.log_output("Created " + file_path, True, 200)
+
+    if failed > 0:
+        sys.exit(2)
 
 
 # Export resource configuration to either YAML or JSON
 def create_resource_export(data, resource, name="resource", output=None,
-                            path=None, timestamp=False):
+                           path=None, timestamp=False):
+    stamp = None
+    if timestamp:
+        stamp = datetime.datetime.now().strftime("%d.%m.%Y_%I.%M_%p")
+    path = create_export_path(name, output, path, stamp)
+
+    # Check if output file exists
+    if os.path.isfile(path) is True:
+        agree = input('File already exists, overwrite? [Y/n]:')
+        if agree not in ["Y", "y", "yes", "YES", ""]:
+            return
+    write_export(path, resource, output)
+    common.log_output("Created " + path, True, 200)
+
+
+# Path of an exported file, stamp is added to the name if given
+def create_export_path(name, output=None, path=None, stamp=None):
     # YAML or JSON?
     if output in ["JSON", "json"]:
         filetype = ".json"
@@ -1259,35 +1329,41 @@ def create_resource_export(data, resource, name="resource", output=None,
         filetype = ".yml"
 
     # Decide on where to output file
-    if timestamp:
-        stamp = datetime.datetime.now().strftime("%d.%m.%Y_%I.%M_%p")
+    if stamp is not None:
         file_name = name + "_" + str(stamp) + filetype
     else:
         file_name = name + filetype
 
     if path is None:
-        path = file_name
-    else:
-        path = common.ensure_trailing_slash(path)
-        path = os.path.dirname(expanduser(path)) + "/" + file_name
+        return file_name
+    path = common.ensure_trailing_slash(path)
+    return os.path.dirname(expanduser(path)) + "/" + file_name
+
 
-    # Check if output folder exists
+# Create the folder of an exported file if it doesn't exist
+def create_export_directory(path):
     directory = os.path.dirname(path)
     if directory != '' and not os.path.exists(directory):
-        message = "Created directory \"" + directory + "\""
-        common.log_output(message, True)
+        common.log_output("Created directory \"" + directory + "\"", True)
         os.makedirs(directory)
-    # Check if output file exists
-    if os.path.isfile(path) is True:
-        agree = input('File already exists, overwrite? [Y/n]:')
-        if agree not in ["Y", "y", "yes", "YES", ""]:
-            return
+
+
+# Write an exported resource, creating the output folder if needed
+def write_export(path, resource, output=None):
+    create_export_directory(path)
     with open(path, 'w') as file:
-        if filetype == ".json":
+        if output in ["JSON", "json"]:
             file.write(json.dumps(resource, indent=4, default=str))
         else:
             file.write(yaml.dump(resource, default_flow_style=False))
-    common.log_output("Created " + path, True, 200)
+
+
+# Default location of trace and profile files, without extension
+# The files are named after the time and the command
+def diagnostics_location(kind, method):
+    directory = os.path.dirname(compatibility.get_config_location())
+    name = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+    return os.path.join(directory, kind, name + "-" + str(method))
 
 
 # argparse argument logic
@@ -1301,4 +1377,23 @@ if __name__ == '__main__':
 
     # Construct parsers and initialize the main method
     args = parser.parse_args()
-    main(**vars(args))
+
+    # Record where the time of the command goes with --trace
+    if args.trace or args.trace_file is not None:
+        trace_file = args.trace_file
+        if trace_file is None:
+            trace_file = diagnostics_location("traces", args.method) + ".json"
+        tracing.enable(expanduser(trace_file))
+    # Profile the command with --profile cpu or --profile mem
+    if args.profile is not None:
+        profile_file = args.profile_file
+        if profile_file is None:
+            profile_file = diagnostics_location("profiles", args.method)
+            profile_file += "-" + args.profile
+        profiling.enable(args.profile, expanduser(profile_file))
+    try:
+        with tracing.span("duc " + str(args.method)):
+            main(**vars(args))
+    finally:
+        profiling.finish()
+        tracing.finish()
@@ -0,0 +1,475 @@
+# Module for the event stream of duc events
+# One watcher per server polls the server state and the progress state every
+# interval and turns the differences to the last poll into events: a task
+# started, a running task changed phase, a backup completed or failed, or a
+# notification was raised. The list of backups is only fetched again when the
+# server reports its data changed or a task ended, and the notifications only
+# when the server reports new ones, so an idle server costs two small
+# requests per interval.
+# Events are written to stdout as NDJSON and, if webhooks are configured,
+# posted to every webhook in batches. Each webhook has a queue of its own and
+# keeps its order; failed batches are retried with growing delays while new
+# events wait behind them.
+# Webhooks receive {"Events": [...]} with every event as printed, e.g.
+# {"id": "...", "time": "2024-05-01T10:00:00Z", "event": "completed",
+#  "server": "nas", "backup_id": "1", "backup": "Documents", ...}
+import async_client
+import asyncio
+import client
+import collections
+import common
+import datetime
+import functools
+import inventory
+import json
+import models
+import random
+import requests
+import requests_wrapper
+import signal
+import sys
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds between polls of every server
+INTERVAL = 5
+
+# Events in the order they happen to a backup
+EVENTS = ["started", "phase-changed", "completed", "failed",
+          "notification-raised"]
+
+# Seconds events wait for others to share their batch, and the most events
+# in one batch
+FLUSH_INTERVAL = 1
+BATCH_SIZE = 100
+
+# Seconds before the first retry of a failed delivery, doubled every retry
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+# Events kept per webhook while it can't be reached, the oldest are dropped
+MAX_QUEUED = 10000
+
+# Seconds to wait for webhooks to take the last events when stopping
+SHUTDOWN_TIMEOUT = 10
+
+# Status codes of deliveries worth retrying besides 5xx
+RETRY_STATUSES = [0, 408, 425, 429]
+
+
+# ISO 8601 time of now in UTC
+def now():
+    return datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+
+
+# ISO 8601 time of a parsed timestamp, None if unset
+def format_timestamp(value):
+    return None if value is None else value.isoformat()
+
+
+# Write a message about the watchers to stderr, keeping stdout NDJSON only
+def report(message):
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+
+# An event of a server, fields with None left out
+def create_event(kind, server_name, backup_id=None, backup_name=None,
+                 **fields):
+    event = collections.OrderedDict([
+        ("id", uuid.uuid4().hex),
+        ("time", now()),
+        ("event", kind),
+        ("server", server_name)
+    ])
+    if backup_id is not None:
+        event["backup_id"] = str(backup_id)
+        event["backup"] = backup_name
+    for key, value in fields.items():
+        if value is not None:
+            event[key] = value
+    return event
+
+
+# What a watcher knows about a backup after a poll
+class BackupState(object):
+    __slots__ = ("name", "finished", "error", "metadata")
+
+    def __init__(self, backup):
+        metadata = backup.metadata
+        self.name = backup.name
+        self.finished = metadata.raw.get("LastBackupFinished", None)
+        self.error = metadata.raw.get("LastErrorDate", None)
+        self.metadata = metadata
+
+
+# Whether a timestamp of the metadata moved on since the last poll
+def advanced(previous, current):
+    return current not in [None, "", "0", "0001-01-01T00:00:00Z"] and \
+        current != previous
+
+
+# Turns the state of one server into events
+class Watcher(object):
+    def __init__(self, name):
+        self.name = name
+        # Update counters of the server, data and notifications are only
+        # fetched again when they change
+        self.data_id = None
+        self.notification_id = None
+        # None until the first poll, which only sets the baseline
+        self.backups = None
+        self.notifications = None
+        self.task = None
+        self.error = None
+
+    def backup_name(self, backup_id):
+        backup = (self.backups or {}).get(str(backup_id), None)
+        return None if backup is None else backup.name
+
+    # Events of the running task, started or phase-changed
+    def progress_events(self, progress):
+        current = None
+        if progress is not None:
+            current = (progress.task_id, str(progress.backup_id),
+                       progress.phase)
+        previous = self.task
+        self.task = current
+        if current is None:
+            return []
+        task_id, backup_id, phase = current
+        name = self.backup_name(backup_id)
+        if previous is None or previous[0] != task_id:
+            return [create_event("started", self.name, backup_id, name,
+                                 task_id=task_id, phase=phase)]
+        if previous[2] != phase:
+            return [create_event("phase-changed", self.name, backup_id, name,
+                                 task_id=task_id, phase=phase,
+                                 previous_phase=previous[2])]
+        return []
+
+    # Events of backups that finished or failed since the last poll
+    def backup_events(self, items):
+        backups = {}
+        for item in items:
+            backup = models.Backup(item)
+            backups[str(backup.id)] = BackupState(backup)
+        previous = self.backups
+        self.backups = backups
+        if previous is None:
+            return []
+        events = []
+        for backup_id, state in backups.items():
+            known = previous.get(backup_id, None)
+            if known is None:
+                continue
+            metadata = state.metadata
+            if advanced(known.error, state.error):
+                events.append(create_event(
+                    "failed", self.name, backup_id, state.name,
+                    failed=format_timestamp(metadata.last_error),
+                    message=metadata.last_error_message))
+            elif advanced(known.finished, state.finished):
+                events.append(create_event(
+                    "completed", self.name, backup_id, state.name,
+                    started=format_timestamp(metadata.last_started),
+                    finished=format_timestamp(metadata.last_finished),
+                    duration=metadata.last_duration))
+        return events
+
+    # Events of notifications that were not there on the last poll
+    def notification_events(self, notifications):
+        previous = self.notifications
+        self.notifications = set(notification.id
+                                 for notification in notifications)
+        if previous is None:
+            return []
+        events = []
+        for notification in notifications:
+            if notification.id in previous:
+                continue
+            backup_id = notification.backup_id or None
+            events.append(create_event(
+                "notification-raised", self.name, backup_id,
+                None if backup_id is None else self.backup_name(backup_id),
+                notification_id=notification.id, type=notification.type,
+                title=notification.title, message=notification.message))
+        return events
+
+    # Poll the server, returning the events since the last poll
+    async def poll(self, duplicati):
+        try:
+            if not duplicati.logged_in():
+                await duplicati.login()
+            state, progress = await asyncio.gather(
+                duplicati.server_state(), duplicati.progress_state())
+            data_id = state.get("LastDataUpdateID", None)
+            notification_id = state.get("LastNotificationUpdateID", None)
+            # Metadata is written when a task ends, fetch it then as well
+            task_ended = self.task is not None and (
+                progress is None or progress.task_id != self.task[0])
+            fetch_backups = self.backups is None or data_id is None or \
+                data_id != self.data_id or task_ended
+            fetch_notifications = self.notifications is None or \
+                notification_id is None or \
+                notification_id != self.notification_id
+            items, notifications = await asyncio.gather(
+                self.fetch(duplicati.list_resource, "backups")
+                if fetch_backups else self.skip(),
+                self.fetch(duplicati.list_notifications)
+                if fetch_notifications else self.skip())
+        except client.DuplicatiError as error:
+            if self.error is None:
+                report(self.name + ": " + error.message +
+                       ", retrying every poll")
+            self.error = error.message
+            return []
+        if self.error is not None:
+            report(self.name + ": reachable again")
+            self.error = None
+
+        # The first poll only sets the baseline
+        baseline = self.backups is None
+        self.data_id = data_id
+        self.notification_id = notification_id
+        events = []
+        if items is not None:
+            events += self.backup_events(items)
+        events += self.progress_events(progress)
+        if notifications is not None:
+            events += self.notification_events(notifications)
+        return [] if baseline else events
+
+    # Fetch a list, empty if the server has none
+    async def fetch(self, function, *args):
+        try:
+            return await function(*args)
+        except client.NotFoundError:
+            # The server answers 404 for empty lists
+            return []
+
+    # Stands in for a list that didn't change
+    async def skip(self):
+        return None
+
+
+# Queue of events for one webhook, delivered in batches
+class Webhook(object):
+    def __init__(self, url, session, executor):
+        self.url = url
+        self.session = session
+        self.executor = executor
+        self.queue = collections.deque()
+        self.delivered = 0
+        self.dropped = 0
+        self.retries = 0
+        # The batch being posted
+        self.sending = []
+        # Created inside the event loop
+        self.waiting = None
+        self.closing = False
+
+    def add(self, event):
+        if len(self.queue) >= MAX_QUEUED:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(event)
+        self.waiting.set()
+
+    # Send the queued events in batches until cancelled
+    async def deliver_loop(self):
+        while True:
+            await self.waiting.wait()
+            if not self.closing:
+                # Give other events a moment to join the batch
+                await asyncio.sleep(FLUSH_INTERVAL)
+            self.waiting.clear()
+            while len(self.queue) > 0:
+                self.sending = [self.queue.popleft() for _ in
+                                range(min(BATCH_SIZE, len(self.queue)))]
+                await self.post(self.sending)
+                self.sending = []
+
+    # Post a batch until the webhook takes it or refuses it for good
+    async def post(self, batch):
+        payload = json.dumps({"Events": batch}, default=str)
+        headers = {"Content-Type": "application/json"}
+        call = functools.partial(
+            requests_wrapper.request, "post", self.url,
+            client_session=self.session, data=payload, headers=headers,
+            timeout=requests_wrapper.timeout_seconds)
+        loop = asyncio.get_running_loop()
+
+        delay = RETRY_DELAY
+        while True:
+            r = await loop.run_in_executor(self.executor, call)
+            if 200 <= r.status_code < 300:
+                self.delivered += len(batch)
+                return
+            if r.status_code < 500 and r.status_code not in RETRY_STATUSES:
+                message = self.url + " refused " + str(len(batch))
+                message += " events with status " + str(r.status_code)
+                report(message)
+                self.dropped += len(batch)
+                return
+
+            self.retries += 1
+            message = "Delivering " + str(len(batch)) + " events to "
+            message += self.url + " failed with status "
+            message += str(r.status_code) + ", retrying in "
+            message += str(delay) + "s"
+            report(message)
+            # Jitter keeps webhooks that failed together from retrying in
+            # lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    # Send what is queued without waiting for more
+    def flush(self):
+        self.closing = True
+        self.waiting.set()
+
+    def idle(self):
+        return len(self.queue) == 0 and len(self.sending) == 0 and \
+            not self.waiting.is_set()
+
+    # Events that were not delivered
+    def undelivered(self):
+        return len(self.queue) + len(self.sending) + self.dropped
+
+
+# Watches servers and emits their events
+class EventStream(object):
+    def __init__(self, servers, interval=INTERVAL, webhook_urls=None,
+                 kinds=None, host_limit=inventory.HOST_LIMIT):
+        self.servers = servers
+        self.interval = interval
+        self.kinds = kinds or EVENTS
+        self.host_limit = host_limit
+        self.watchers = [Watcher(server.name) for server in servers]
+        self.counts = dict((kind, 0) for kind in EVENTS)
+        webhook_urls = webhook_urls or []
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(len(webhook_urls), 1))
+        self.webhooks = [Webhook(url, self.session, self.executor)
+                         for url in webhook_urls]
+        self.stopping = None
+
+    # Print the events and queue them for the webhooks
+    def emit(self, events):
+        for event in events:
+            if event["event"] not in self.kinds:
+                continue
+            self.counts[event["event"]] += 1
+            # Flushed per event so pipes see events as they happen
+            sys.stdout.write(json.dumps(event) + "\n")
+            sys.stdout.flush()
+            for webhook in self.webhooks:
+                webhook.add(event)
+
+    # Poll a server every interval until stopped
+    async def watch(self, watcher, duplicati):
+        loop = asyncio.get_running_loop()
+        while not self.stopping.is_set():
+            started = loop.time()
+            self.emit(await watcher.poll(duplicati))
+            delay = max(0, self.interval - (loop.time() - started))
+            try:
+                await asyncio.wait_for(self.stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        self.stopping.set()
+
+    # Hand the last events to the webhooks, waiting at most timeout seconds
+    async def drain(self, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for webhook in self.webhooks:
+            webhook.flush()
+        while loop.time() < deadline:
+            if all(webhook.idle() for webhook in self.webhooks):
+                return
+            await asyncio.sleep(0.05)
+
+    # Watch all servers for duration seconds or until stopped
+    async def run(self, duration=None):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not supported on Windows, KeyboardInterrupt is used instead
+                pass
+
+        for webhook in self.webhooks:
+            webhook.waiting = asyncio.Event()
+        deliveries = [asyncio.ensure_future(webhook.deliver_loop())
+                      for webhook in self.webhooks]
+        clients = [async_client.AsyncDuplicatiClient(
+            server.data, server.password, self.host_limit)
+            for server in self.servers]
+        try:
+            watchers = [asyncio.ensure_future(self.watch(watcher, duplicati))
+                        for watcher, duplicati in zip(self.watchers, clients)]
+            if duration is not None:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), duration)
+                except asyncio.TimeoutError:
+                    self.stop()
+            await self.stopping.wait()
+            await asyncio.gather(*watchers)
+            await self.drain(SHUTDOWN_TIMEOUT)
+        finally:
+            for delivery in deliveries:
+                delivery.cancel()
+            for duplicati in clients:
+                duplicati.close()
+
+    def close(self):
+        self.session.close()
+        self.executor.shutdown(wait=False)
+
+    # Summary of the events emitted and delivered
+    def summary(self):
+        counted = ", ".join(str(self.counts[kind]) + " " + kind
+                            for kind in EVENTS if self.counts[kind] > 0)
+        lines = ["Events stopped, " + (counted or "no events")]
+        for webhook in self.webhooks:
+            message = webhook.url + ": " + str(webhook.delivered)
+            message += " delivered, " + str(webhook.retries) + " retries"
+            undelivered = webhook.undelivered()
+            if undelivered > 0:
+                message += ", " + str(undelivered) + " not delivered"
+            lines.append(message)
+        return "\n".join(lines)
+
+
+# Stream the events of the servers in the inventory until interrupted
+def run(data, inventory_path=None, interval=INTERVAL, webhook_urls=None,
+        kinds=None, duration=None):
+    for url in webhook_urls or []:
+        if not url.startswith("http://") and not url.startswith("https://"):
+            message = "Invalid webhook " + url + ", use an http:// or "
+            message += "https:// URL"
+            common.log_output(message, True)
+            sys.exit(2)
+    if interval <= 0:
+        common.log_output("The interval must be positive", True)
+        sys.exit(2)
+
+    servers = inventory.use_stored_password(
+        data, inventory.load(data, inventory_path))
+    stream = EventStream(servers, interval, webhook_urls, kinds)
+    try:
+        asyncio.run(stream.run(duration))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.close()
+    report(stream.summary())
+    return data
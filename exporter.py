@@ -0,0 +1,317 @@
+# Module for serving backup metrics to Prometheus
+# The exporter polls every server of the inventory on its own interval and
+# renders the metrics in the text exposition format once per poll. Scrapes
+# are answered from the last rendered page held in memory, plain or gzipped,
+# so however often and by however many scrapers the metrics are read, the
+# servers only see one list of backups and one list of notifications per
+# interval. A server that can't be reached reports duplicati_up 0 and no
+# backup metrics until it answers again.
+import async_client
+import asyncio
+import calendar
+import client
+import common
+import gzip
+import inventory
+import re
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+# Address the exporter listens on unless configured otherwise
+LISTEN = "127.0.0.1:9874"
+
+# Seconds between polls of the servers
+POLL_INTERVAL = 30
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Names, types and help texts of the metrics, in the order they are rendered
+METRICS = [
+    ("duplicati_up", "gauge",
+     "Whether the last poll of the server succeeded"),
+    ("duplicati_backup_last_started_timestamp_seconds", "gauge",
+     "Start of the last backup run"),
+    ("duplicati_backup_last_finished_timestamp_seconds", "gauge",
+     "End of the last backup run"),
+    ("duplicati_backup_last_duration_seconds", "gauge",
+     "Duration of the last backup run"),
+    ("duplicati_backup_versions", "gauge",
+     "Number of versions kept by the backup"),
+    ("duplicati_backup_source_size_bytes", "gauge",
+     "Size of the source files"),
+    ("duplicati_backup_target_size_bytes", "gauge",
+     "Size of the files on the backend"),
+    ("duplicati_backup_running", "gauge",
+     "Whether the backup is running"),
+    ("duplicati_backup_phase", "gauge",
+     "Phase of the running backup"),
+    ("duplicati_backup_progress_ratio", "gauge",
+     "Overall progress of the running backup"),
+    ("duplicati_notifications", "gauge",
+     "Notifications waiting on the server by type"),
+    ("duplicati_exporter_last_poll_timestamp_seconds", "gauge",
+     "End of the last poll"),
+    ("duplicati_exporter_poll_duration_seconds", "gauge",
+     "Time the last poll of all servers took")
+]
+
+# Durations as written by the server, [days.]hours:minutes:seconds
+DURATION = re.compile(r"^(?:(\d+)\.)?(\d+):(\d+):(\d+(?:\.\d+)?)$")
+
+
+# Host and port of a listen address such as 127.0.0.1:9874
+def parse_address(listen):
+    host, separator, port = listen.rpartition(":")
+    if separator == "" or not port.isdigit():
+        message = "Invalid listen address " + listen
+        message += ", use host:port such as " + LISTEN
+        common.log_output(message, True)
+        sys.exit(2)
+    return host.strip("[]") or "0.0.0.0", int(port)
+
+
+# Seconds of a duration written by the server, None if it can't be read
+def duration_seconds(text):
+    match = DURATION.match(str(text).strip())
+    if match is None:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    total = int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60
+    return total + float(seconds)
+
+
+# Seconds since the epoch of a parsed timestamp, naive ones are UTC
+def epoch_seconds(value):
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple())
+
+
+# Escape a label value as the exposition format requires
+def escape_label(value):
+    value = str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+    return value.replace("\n", "\\n")
+
+
+# Format a sample value, integers without a fraction
+def format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+# Samples of a server as (metric, labels, value)
+# backups are models.Backup with the progress attached, notifications
+# models.Notification
+def collect(server_name, backups, notifications):
+    samples = [("duplicati_up", [("server", server_name)], 1)]
+    for backup in backups:
+        labels = [("server", server_name), ("backup_id", backup.id),
+                  ("backup", backup.name)]
+        metadata = backup.metadata
+        values = [
+            ("duplicati_backup_last_started_timestamp_seconds",
+             epoch_seconds(metadata.last_started)),
+            ("duplicati_backup_last_finished_timestamp_seconds",
+             epoch_seconds(metadata.last_finished)),
+            ("duplicati_backup_last_duration_seconds",
+             duration_seconds(metadata.last_duration)),
+            ("duplicati_backup_versions", metadata.versions),
+            ("duplicati_backup_source_size_bytes", metadata.source_size),
+            ("duplicati_backup_target_size_bytes", metadata.target_size)
+        ]
+        progress = backup.progress
+        values.append(("duplicati_backup_running", progress is not None))
+        for metric, value in values:
+            if value is not None:
+                samples.append((metric, labels, value))
+        if progress is None:
+            continue
+        phase_labels = labels + [("phase", progress.phase or "")]
+        samples.append(("duplicati_backup_phase", phase_labels, 1))
+        ratio = min(max(float(progress.overall_progress), 0.0), 1.0)
+        samples.append(("duplicati_backup_progress_ratio", labels, ratio))
+
+    counts = {}
+    for notification in notifications:
+        kind = notification.type or "Unknown"
+        counts[kind] = counts.get(kind, 0) + 1
+    for kind in sorted(counts):
+        labels = [("server", server_name), ("type", kind)]
+        samples.append(("duplicati_notifications", labels, counts[kind]))
+    return samples
+
+
+# Render samples in the text exposition format, grouped by metric
+def render(samples):
+    grouped = {}
+    for metric, labels, value in samples:
+        grouped.setdefault(metric, []).append((labels, value))
+    lines = []
+    for metric, kind, help_text in METRICS:
+        if metric not in grouped:
+            continue
+        lines.append("# HELP " + metric + " " + help_text)
+        lines.append("# TYPE " + metric + " " + kind)
+        for labels, value in grouped[metric]:
+            pairs = [name + "=\"" + escape_label(label) + "\""
+                     for name, label in labels]
+            label_text = "{" + ",".join(pairs) + "}" if pairs else ""
+            lines.append(metric + label_text + " " + format_value(value))
+    return "\n".join(lines) + "\n"
+
+
+# A rendered page with its gzipped copy
+class Page(object):
+    __slots__ = ("content", "compressed")
+
+    def __init__(self, text):
+        self.content = text.encode("utf-8")
+        self.compressed = gzip.compress(self.content)
+
+
+# Answers scrapes from the page of the exporter
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        page = self.server.exporter.page
+        body = page.content
+        accepted = self.headers.get("Accept-Encoding", "") or ""
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        if "gzip" in accepted:
+            body = page.compressed
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are logged in verbose mode only
+    def log_message(self, format, *args):
+        common.log_output(self.address_string() + " " + (format % args),
+                          False)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Polls the servers and keeps the last rendered page
+class Exporter(object):
+    def __init__(self, servers, interval=POLL_INTERVAL,
+                 host_limit=inventory.HOST_LIMIT):
+        self.servers = servers
+        self.interval = interval
+        self.host_limit = host_limit
+        self.stopping = threading.Event()
+        self.polls = 0
+        # Replaced as a whole, so scrapes never see half a poll
+        self.page = Page(render([]))
+
+    # Poll a single server, returning its samples
+    async def poll_server(self, server, duplicati):
+        try:
+            if not duplicati.logged_in():
+                await duplicati.login()
+            backups, notifications = await asyncio.gather(
+                duplicati.list_backups(), duplicati.list_notifications())
+        except client.DuplicatiError as error:
+            message = server.name + ": " + error.message
+            common.log_output(message, False, error.status_code)
+            return [("duplicati_up", [("server", server.name)], 0)]
+        except Exception as exc:
+            # Such as a login page of a proxy instead of JSON, the server
+            # is down as far as the metrics go
+            message = server.name + ": polling failed, " + repr(exc)
+            common.log_output(message, True)
+            return [("duplicati_up", [("server", server.name)], 0)]
+        return collect(server.name, backups, notifications)
+
+    # Poll all servers at the same time and replace the page
+    async def poll(self, clients):
+        started = time.time()
+        results = await asyncio.gather(*[
+            self.poll_server(server, duplicati)
+            for server, duplicati in zip(self.servers, clients)])
+        finished = time.time()
+        samples = [sample for result in results for sample in result]
+        samples.append(("duplicati_exporter_last_poll_timestamp_seconds", [],
+                        finished))
+        samples.append(("duplicati_exporter_poll_duration_seconds", [],
+                        finished - started))
+        self.page = Page(render(samples))
+        self.polls += 1
+
+    # Poll on a fixed cadence until stopped
+    async def poll_loop(self):
+        # The clients live as long as the exporter so logins are reused
+        clients = [async_client.AsyncDuplicatiClient(
+            server.data, server.password, self.host_limit)
+            for server in self.servers]
+        loop = asyncio.get_running_loop()
+        try:
+            while not self.stopping.is_set():
+                started = time.time()
+                try:
+                    await self.poll(clients)
+                except Exception as exc:
+                    # The thread must keep polling, or scrapes would get
+                    # the last page forever
+                    common.log_output("Polling failed: " + repr(exc), True)
+                delay = max(0, self.interval - (time.time() - started))
+                await loop.run_in_executor(None, self.stopping.wait, delay)
+        finally:
+            for duplicati in clients:
+                duplicati.close()
+
+    # Start polling in a thread of its own
+    def start(self):
+        thread = threading.Thread(target=asyncio.run,
+                                  args=(self.poll_loop(),))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopping.set()
+
+
+# Serve the metrics of the servers in the inventory until interrupted
+def run(data, listen=LISTEN, interval=POLL_INTERVAL, inventory_path=None):
+    servers = inventory.use_stored_password(
+        data, inventory.load(data, inventory_path))
+
+    host, port = parse_address(listen)
+    try:
+        http_server = MetricsServer((host, port), MetricsHandler)
+    except (IOError, OSError) as exc:
+        common.log_output("Can't listen on " + listen + ": " + str(exc), True)
+        sys.exit(2)
+    exporter = Exporter(servers, max(1, interval))
+    http_server.exporter = exporter
+    thread = exporter.start()
+
+    message = "Serving metrics of " + str(len(servers)) + " servers on http://"
+    message += listen + "/metrics, polling every " + str(interval) + "s"
+    common.log_output(message, True)
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.stop()
+        http_server.server_close()
+        thread.join(5)
+    common.log_output("Exporter stopped after " + str(exporter.polls) +
+                      " polls", True)
+    return data
@@ -1,13 +1,20 @@
 # Module for small helper functions that are mostly generic
 import common
 import datetime
+import profiling
 
 from dateutil import parser as dateparser
 from dateutil import tz
 
 
 # Helper function for formatting timestamps for humans
+@profiling.section("format_time")
 def format_time(time_string, precise=False):
+    return format_datetime(parse_time(time_string), precise)
+
+
+# Helper function for parsing timestamps into datetime objects
+def parse_time(time_string):
     # Ensure it's a string
     time_string = str(time_string)
 
@@ -17,11 +24,18 @@ def format_time(time_string, precise=False):
 
     # We want to fail silently if we're not provided a parsable time_string.
     try:
-        datetime_object = dateparser.parse(time_string)
+        return dateparser.parse(time_string)
     except Exception as exc:
         common.log_output(exc, False)
         return None
 
+
+# Helper function for formatting datetime objects for humans
+@profiling.section("format_datetime")
+def format_datetime(datetime_object, precise=False):
+    if datetime_object is None:
+        return None
+
     # Print a precise, but human readable string if precise is true
     if precise:
         return datetime_object.strftime("%I:%M:%S %p %d/%m/%Y")
@@ -0,0 +1,277 @@
+# Module for the locally cached index of backups on the server
+# The index maps backup names, tags and database paths to ID's so commands
+# can accept names, globs, tags and ID ranges without listing all backups on
+# every call. It is refreshed when it goes stale or when a selector misses,
+# and kept up to date when backups are created, updated or deleted.
+import common
+import config
+import fnmatch
+import json
+import os
+import re
+import sys
+import time
+
+from requests_wrapper import requests_wrapper as requests
+
+# Seconds before the index is considered stale and refreshed
+INDEX_TTL = 300
+
+# Selector prefixes, anything else is matched against the backup name
+TAG_PREFIX = "tag:"
+NAME_PREFIX = "name:"
+DBPATH_PREFIX = "dbpath:"
+
+RANGE_PATTERN = re.compile(r"^(\d+)-(\d+)$")
+
+
+# Location of the index file, next to the config file
+def get_index_location():
+    directory = os.path.dirname(config.CONFIG_FILE)
+    return os.path.join(directory, "index.json")
+
+
+# Key identifying the server in the index file
+def server_key(data):
+    return common.create_baseurl(data)
+
+
+# Read the index file for all servers
+def read_index():
+    try:
+        with open(get_index_location(), 'r') as file_handle:
+            return json.load(file_handle)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+# Write the index file atomically so concurrent readers never see half
+def write_index(index):
+    path = get_index_location()
+    directory = os.path.dirname(path)
+    if directory != '' and not os.path.exists(directory):
+        os.makedirs(directory)
+    temporary = path + ".tmp" + str(os.getpid())
+    with open(temporary, 'w') as file_handle:
+        json.dump(index, file_handle)
+    # os.replace overwrites an existing file on Windows too
+    os.replace(temporary, path)
+
+
+# Get the index entry for the current server, refreshing it when stale
+def load(data, max_age=INDEX_TTL):
+    entry = read_index().get(server_key(data), None)
+    if entry is None or time.time() - entry.get("updated", 0) > max_age:
+        entry = refresh(data)
+    return entry
+
+
+# Fetch the backup list from the server and rebuild the index
+def refresh(data):
+    common.verify_token(data)
+    common.log_output("Refreshing backup index...", False)
+
+    baseurl = common.create_baseurl(data, "/api/v1/backups")
+    cookies = common.create_cookies(data)
+    headers = common.create_headers(data)
+    verify = data.get("server", {}).get("verify", True)
+    r = requests.get(baseurl, headers=headers, cookies=cookies, verify=verify)
+    common.check_response(data, r.status_code)
+    if r.status_code != 200:
+        common.log_output("Error refreshing backup index", True,
+                          r.status_code)
+        sys.exit(2)
+
+    backups = {}
+    for item in r.json():
+        backup = item.get("Backup", {})
+        backups[str(backup.get("ID", ""))] = create_record(backup)
+
+    index = read_index()
+    entry = index.get(server_key(data), {})
+    entry["updated"] = time.time()
+    entry["backups"] = backups
+    index[server_key(data)] = entry
+    write_index(index)
+    # Only in memory, a selector missing this entry won't refresh it again
+    entry["fresh"] = True
+    return entry
+
+
+# Fetch the notification list from the server and store it in the index
+def refresh_notifications(data):
+    common.verify_token(data)
+
+    baseurl = common.create_baseurl(data, "/api/v1/notifications")
+    cookies = common.create_cookies(data)
+    headers = common.create_headers(data)
+    verify = data.get("server", {}).get("verify", True)
+    r = requests.get(baseurl, headers=headers, cookies=cookies, verify=verify)
+    common.check_response(data, r.status_code)
+    if r.status_code != 200:
+        return
+
+    notifications = []
+    for item in r.json():
+        notifications.append({
+            "ID": item.get("ID", ""),
+            "Title": item.get("Title", "")
+        })
+
+    index = read_index()
+    entry = index.get(server_key(data), None)
+    if entry is None:
+        return
+    entry["notifications"] = notifications
+    write_index(index)
+
+
+# The fields of a backup kept in the index
+def create_record(backup):
+    return {
+        "Name": backup.get("Name", ""),
+        "Tags": backup.get("Tags", None) or [],
+        "DBPath": backup.get("DBPath", "")
+    }
+
+
+# Update a single backup in the index after it was changed on the server
+def update(data, backup_id, backup_config):
+    index = read_index()
+    entry = index.get(server_key(data), None)
+    if entry is None:
+        return
+    backup = backup_config.get("Backup", {})
+    entry["backups"][str(backup_id)] = create_record(backup)
+    write_index(index)
+
+
+# Remove a single backup from the index after it was deleted
+def remove(data, backup_id):
+    index = read_index()
+    entry = index.get(server_key(data), None)
+    if entry is None:
+        return
+    entry["backups"].pop(str(backup_id), None)
+    write_index(index)
+
+
+# Drop the index of the current server, forcing a refresh on next use
+def invalidate(data):
+    index = read_index()
+    if index.pop(server_key(data), None) is not None:
+        write_index(index)
+
+
+# Expand plain ID's and ID ranges without consulting the index
+# Used for resources that are not in the index, such as notifications
+def parse_ids(selectors):
+    ids = []
+    for selector in selectors:
+        selector = str(selector)
+        match = RANGE_PATTERN.match(selector)
+        if selector.isdigit():
+            ids.append(int(selector))
+        elif match:
+            first, last = int(match.group(1)), int(match.group(2))
+            ids.extend(range(min(first, last), max(first, last) + 1))
+        else:
+            common.log_output("Invalid id: " + selector, True)
+            sys.exit(2)
+    return unique(ids)
+
+
+# Resolve backup selectors to a list of backup ID's
+# Supported selectors:
+#   12            a backup ID, used as is without consulting the index
+#   1-200         every indexed backup with an ID in the range
+#   db-*          backups with a name matching the glob
+#   name:db-1     backups with a name matching, for names that look like ID's
+#   tag:prod      backups with a tag matching the glob
+#   dbpath:/x/*   backups with a local database path matching the glob
+def resolve(data, selectors):
+    if not isinstance(selectors, list):
+        selectors = [selectors]
+
+    ids = []
+    entry = None
+    for selector in selectors:
+        selector = str(selector)
+        if selector.isdigit():
+            ids.append(int(selector))
+            continue
+
+        if entry is None:
+            entry = load(data)
+        matches = match(entry, selector)
+        # The index may be outdated, refresh it once and try again
+        if len(matches) == 0 and not entry.get("fresh", False):
+            entry = refresh(data)
+            matches = match(entry, selector)
+        if len(matches) == 0:
+            message = "No backups match \"" + selector + "\""
+            common.log_output(message, True)
+            sys.exit(2)
+        ids.extend(matches)
+
+    return unique(ids)
+
+
+# Resolve backup selectors that must match exactly one backup
+def resolve_one(data, selector):
+    ids = resolve(data, selector)
+    if len(ids) > 1:
+        message = "\"" + str(selector) + "\" matches " + str(len(ids))
+        message += " backups, specify a single backup"
+        common.log_output(message, True)
+        sys.exit(2)
+    return ids[0]
+
+
+# Find the ID's of backups in an index entry matching a selector
+def match(entry, selector):
+    backups = entry.get("backups", {})
+    range_match = RANGE_PATTERN.match(selector)
+    if range_match:
+        first, last = int(range_match.group(1)), int(range_match.group(2))
+        first, last = min(first, last), max(first, last)
+        ids = [int(backup_id) for backup_id in backups
+               if backup_id.isdigit() and first <= int(backup_id) <= last]
+        return sorted(ids)
+
+    if selector.startswith(TAG_PREFIX):
+        pattern = selector[len(TAG_PREFIX):]
+        field = "Tags"
+    elif selector.startswith(DBPATH_PREFIX):
+        pattern = selector[len(DBPATH_PREFIX):]
+        field = "DBPath"
+    elif selector.startswith(NAME_PREFIX):
+        pattern = selector[len(NAME_PREFIX):]
+        field = "Name"
+    else:
+        pattern = selector
+        field = "Name"
+
+    ids = []
+    for backup_id, record in backups.items():
+        if not backup_id.isdigit():
+            continue
+        values = record.get(field, "")
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if fnmatch.fnmatchcase(value, pattern):
+                ids.append(int(backup_id))
+                break
+    return sorted(ids)
+
+
+# Remove duplicates while keeping the order
+def unique(ids):
+    seen = set()
+    result = []
+    for item in ids:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
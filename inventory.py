@@ -0,0 +1,149 @@
+# Module for the inventory of servers that fleet commands work on
+# The inventory is a YAML file naming every server with its address and,
+# for password protected servers, the password. A server may instead point
+# at a config file of this client and reuse its login. Commands run against
+# all servers at once on one event loop with the asyncio client, each server
+# limited to a few requests in flight.
+# example:
+# servers:
+#   nas:
+#     url: https://nas.example.com:8200
+#     password: secret
+#     verify: false
+#   office:
+#     config: ~/office-client.yml
+import async_client
+import asyncio
+import client
+import common
+import config
+import os
+import sys
+import yaml
+
+from os.path import expanduser
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# Requests in flight per server
+HOST_LIMIT = 2
+
+
+# A server of the inventory
+class Server(object):
+    __slots__ = ("name", "data", "password")
+
+    def __init__(self, name, data, password=None):
+        self.name = name
+        self.data = data
+        self.password = password
+
+
+# Default location of the inventory, next to the config file
+def get_inventory_location():
+    directory = os.path.dirname(config.CONFIG_FILE)
+    return os.path.join(directory, "inventory.yml")
+
+
+# Client configuration for a server entry of the inventory
+def server_config(name, entry):
+    if "config" in entry:
+        with open(expanduser(entry["config"]), 'r') as file_handle:
+            data = yaml.safe_load(file_handle)
+        if not isinstance(data, dict) or "server" not in data:
+            raise ValueError(name + ": " + entry["config"] +
+                             " is not a client configuration")
+        return data
+
+    address = urlparse(str(entry.get("url", "")))
+    if address.scheme not in ["http", "https"] or not address.hostname:
+        raise ValueError(name + ": url must look like http://host:8200")
+    port = address.port
+    if port is None:
+        port = 443 if address.scheme == "https" else 8200
+    authorization = entry.get("authorization", "")
+    return {
+        "server": {
+            "protocol": address.scheme,
+            "url": address.hostname,
+            "port": str(port),
+            "verify": entry.get("verify", True)
+        },
+        "token": None,
+        "token_expires": None,
+        "authorization": authorization
+    }
+
+
+# Load the servers of an inventory file, the current server if there is none
+def load(data, path=None):
+    explicit = path is not None
+    if path is None:
+        path = get_inventory_location()
+    if not explicit and not os.path.isfile(path):
+        common.verify_token(data)
+        return [Server(common.create_baseurl(data), data)]
+
+    try:
+        with open(path, 'r') as file_handle:
+            document = yaml.safe_load(file_handle)
+        entries = document["servers"]
+        servers = []
+        for name in sorted(entries):
+            entry = entries[name] or {}
+            servers.append(Server(str(name), server_config(name, entry),
+                                  entry.get("password", None)))
+    except (IOError, OSError, yaml.YAMLError, ValueError, KeyError,
+            TypeError, AttributeError) as exc:
+        common.log_output("Invalid inventory " + path + ": " + str(exc), True)
+        sys.exit(2)
+    if len(servers) == 0:
+        common.log_output("The inventory " + path + " has no servers", True)
+        sys.exit(2)
+    return servers
+
+
+# Let the current server log in again with the password of the parameters
+# file, for commands running longer than a token lasts
+def use_stored_password(data, servers):
+    password = common.load_parameters(data, {}).get("password", None)
+    for server in servers:
+        if server.data is data and server.password is None:
+            server.password = password
+    return servers
+
+
+# Run a coroutine function for every server at the same time
+# function is called with the server and its AsyncDuplicatiClient. Returns
+# the result and the error of every server, in the order of servers.
+def gather(servers, function, host_limit=HOST_LIMIT):
+    async def run_one(server):
+        duplicati = async_client.AsyncDuplicatiClient(
+            server.data, server.password, host_limit)
+        try:
+            if not duplicati.logged_in():
+                await duplicati.login()
+            return await function(server, duplicati), None
+        except client.DuplicatiError as error:
+            return None, error
+        finally:
+            duplicati.close()
+
+    async def run_all():
+        return await asyncio.gather(*[run_one(server) for server in servers])
+
+    return asyncio.run(run_all())
+
+
+# Log the servers that failed, returning the number of failures
+def report_errors(servers, results):
+    failed = 0
+    for server, (result, error) in zip(servers, results):
+        if error is not None:
+            failed += 1
+            message = server.name + ": " + error.message
+            common.log_output(message, True, error.status_code)
+    return failed
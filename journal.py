@@ -0,0 +1,202 @@
+# Module for the crash-safe task journal of the daemon
+# Every state change of a task is appended to the journal as one JSON line.
+# A writer thread commits records in groups: all records arriving while a
+# commit is in progress share the next write and fsync, so the number of
+# fsyncs stays low under load while each caller still learns when its record
+# is durable. Once enough records have been written, the journal is
+# compacted into a snapshot of the unfinished tasks. On startup the journal
+# is replayed and only unfinished tasks are returned.
+import config
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+
+# Task states recorded in the journal
+RECEIVED = "received"
+RESULT = "result"
+DELIVERED = "delivered"
+
+# Seconds a commit waits for more records to share its fsync
+COMMIT_DELAY = 0.002
+
+# Records in a single commit at most
+MAX_BATCH = 1000
+
+# Records written before the journal is compacted
+COMPACT_THRESHOLD = 10000
+
+
+# Default location of the journal, next to the config file
+def get_journal_location():
+    directory = os.path.dirname(config.CONFIG_FILE)
+    return os.path.join(directory, "task-journal.jsonl")
+
+
+# Read the journal and return the latest state of every unfinished task
+# Lines that can't be parsed, e.g. the last one after a crash, are skipped
+def replay(path):
+    tasks = {}
+    order = []
+    try:
+        file_handle = open(path, 'r')
+    except (IOError, OSError):
+        return []
+    with file_handle:
+        for line in file_handle:
+            try:
+                record = json.loads(line)
+                task_id = record["ID"]
+                state = record["State"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            key = json.dumps(task_id)
+            if state == DELIVERED:
+                tasks.pop(key, None)
+                continue
+            if key not in tasks:
+                tasks[key] = {"ID": task_id}
+                order.append(key)
+            tasks[key].update(record)
+    return [tasks[key] for key in order if key in tasks]
+
+
+# Append-only journal with group commit
+class Journal(object):
+    def __init__(self, path=None, commit_delay=COMMIT_DELAY,
+                 compact_threshold=COMPACT_THRESHOLD, max_batch=MAX_BATCH):
+        self.path = path or get_journal_location()
+        self.commit_delay = commit_delay
+        self.max_batch = max_batch
+        self.compact_threshold = compact_threshold
+        self.condition = threading.Condition()
+        self.queue = []
+        self.closed = False
+        self.file_handle = None
+        self.thread = None
+        # Latest record of every unfinished task, written out on compaction
+        self.unfinished = {}
+        self.written = 0
+        self.commits = 0
+
+    # Replay the journal, compact it and start the writer
+    # Returns the unfinished tasks in the order they were received
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        recovered = replay(self.path)
+        for record in recovered:
+            self.unfinished[json.dumps(record["ID"])] = record
+        self.compact()
+
+        self.thread = threading.Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return recovered
+
+    # Queue a record, the returned future completes once it is durable
+    def record(self, task_id, state, **fields):
+        record = {"ID": task_id, "State": state}
+        record.update(fields)
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise ValueError("Journal is closed")
+            self.queue.append((record, future))
+            self.condition.notify()
+        return future
+
+    # Commit the remaining records and stop the writer
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if self.file_handle is not None:
+            self.file_handle.close()
+            self.file_handle = None
+
+    # Commit queued records in groups until closed
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.queue) == 0 and self.closed:
+                    return
+
+            # Give concurrent writers a moment to join this commit
+            if self.commit_delay > 0:
+                time.sleep(self.commit_delay)
+
+            with self.condition:
+                batch = self.queue[:self.max_batch]
+                del self.queue[:self.max_batch]
+
+            try:
+                self.commit([record for record, future in batch])
+            except Exception as exc:
+                for record, future in batch:
+                    future.set_exception(exc)
+                continue
+            for record, future in batch:
+                future.set_result(True)
+
+            if self.written >= self.compact_threshold:
+                self.compact()
+
+    # Append records and fsync them together
+    def commit(self, records):
+        lines = []
+        for record in records:
+            lines.append(json.dumps(record, default=str) + "\n")
+            key = json.dumps(record["ID"])
+            if record["State"] == DELIVERED:
+                self.unfinished.pop(key, None)
+            else:
+                current = self.unfinished.get(key, {})
+                current.update(record)
+                self.unfinished[key] = current
+
+        self.file_handle.write("".join(lines))
+        self.file_handle.flush()
+        os.fsync(self.file_handle.fileno())
+        self.written += len(records)
+        self.commits += 1
+
+    # Replace the journal with a snapshot of the unfinished tasks
+    def compact(self):
+        if self.file_handle is not None:
+            self.file_handle.close()
+
+        temporary = self.path + ".tmp"
+        with open(temporary, 'w') as file_handle:
+            for record in self.unfinished.values():
+                file_handle.write(json.dumps(record, default=str) + "\n")
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        os.replace(temporary, self.path)
+        sync_directory(self.path)
+
+        self.file_handle = open(self.path, 'a')
+        self.written = 0
+
+
+# Make a rename durable by syncing its directory, where supported
+def sync_directory(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except (OSError, AttributeError):
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
@@ -0,0 +1,356 @@
+# Module for lightweight models wrapping the JSON returned by the API
+# The models keep a reference to the raw dictionaries and only read fields
+# when they are accessed. Timestamps are parsed once and cached. All classes
+# use __slots__ so thousands of them can be held in caches cheaply.
+import datetime
+import json
+import helper
+
+# Sentinel for cached fields that have not been computed yet
+_UNSET = object()
+
+# Number of message and exception lines displayed without --all
+MAX_LOG_LINES = 15
+
+
+# Read a timestamp field once and cache the parsed datetime in a slot
+def _cached_time(model, slot, key):
+    value = getattr(model, slot)
+    if value is _UNSET:
+        value = helper.parse_time(model.raw.get(key, ""))
+        setattr(model, slot, value)
+    return value
+
+
+# Convert a field to an integer, tolerating strings and missing values
+def _integer(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# Calculate a percentage, avoiding 0 division
+def _percentage(current, total):
+    if current > 0 and total > 0:
+        return current / float(total) * 100
+    return None
+
+
+# Split multi-line text and hide lines beyond the limit unless show_all
+def _split_lines(text, show_all=False):
+    if text is None:
+        return None
+    lines = text.split("\n")
+    length = len(lines)
+    if length > MAX_LOG_LINES and not show_all:
+        lines = lines[:MAX_LOG_LINES]
+        hidden = str(length - MAX_LOG_LINES)
+        lines.append(hidden + " hidden lines (show with --all)")
+    return lines
+
+
+# Backup job as returned by /api/v1/backups and /api/v1/backup/<id>
+class Backup(object):
+    __slots__ = ("raw", "_metadata", "_schedule", "_progress")
+
+    def __init__(self, raw):
+        self.raw = raw if raw is not None else {}
+        self._metadata = _UNSET
+        self._schedule = _UNSET
+        self._progress = _UNSET
+
+    @property
+    def backup(self):
+        return self.raw.get("Backup", None) or {}
+
+    @property
+    def id(self):
+        return self.backup.get("ID", "")
+
+    @property
+    def name(self):
+        return self.backup.get("Name", "")
+
+    @property
+    def description(self):
+        return self.backup.get("Description", "")
+
+    @property
+    def tags(self):
+        return self.backup.get("Tags", None) or []
+
+    @property
+    def db_path(self):
+        return self.backup.get("DBPath", "")
+
+    @property
+    def metadata(self):
+        if self._metadata is _UNSET:
+            self._metadata = Metadata(self.backup.get("Metadata", None))
+        return self._metadata
+
+    @property
+    def schedule(self):
+        if self._schedule is _UNSET:
+            raw = self.raw.get("Schedule", None)
+            self._schedule = Schedule(raw) if raw is not None else None
+        return self._schedule
+
+    @property
+    def progress(self):
+        if self._progress is _UNSET:
+            raw = self.raw.get("Progress", None)
+            self._progress = ProgressState(raw) if raw is not None else None
+        return self._progress
+
+    # The job configuration without client side additions such as Progress
+    def config(self):
+        config = dict(self.raw)
+        config.pop("Progress", None)
+        return config
+
+
+# Metadata of a backup job, i.e. statistics from the last run
+class Metadata(object):
+    __slots__ = ("raw", "_last_started", "_last_finished", "_last_error")
+
+    def __init__(self, raw):
+        self.raw = raw if raw is not None else {}
+        self._last_started = _UNSET
+        self._last_finished = _UNSET
+        self._last_error = _UNSET
+
+    @property
+    def last_started(self):
+        return _cached_time(self, "_last_started", "LastBackupStarted")
+
+    @property
+    def last_finished(self):
+        return _cached_time(self, "_last_finished", "LastBackupFinished")
+
+    @property
+    def last_duration(self):
+        return self.raw.get("LastBackupDuration", "0")
+
+    @property
+    def last_error(self):
+        return _cached_time(self, "_last_error", "LastErrorDate")
+
+    @property
+    def last_error_message(self):
+        return self.raw.get("LastErrorMessage", "")
+
+    @property
+    def versions(self):
+        return _integer(self.raw.get("BackupListCount", 0))
+
+    @property
+    def source_size(self):
+        return _integer(self.raw.get("SourceFilesSize", 0))
+
+    @property
+    def target_size(self):
+        return _integer(self.raw.get("TargetFilesSize", 0))
+
+    @property
+    def source_size_string(self):
+        return self.raw.get("SourceSizeString", None)
+
+    @property
+    def target_size_string(self):
+        return self.raw.get("TargetSizeString", None)
+
+
+# Schedule of a backup job
+class Schedule(object):
+    __slots__ = ("raw", "_next_run", "_last_run")
+
+    def __init__(self, raw):
+        self.raw = raw if raw is not None else {}
+        self._next_run = _UNSET
+        self._last_run = _UNSET
+
+    @property
+    def id(self):
+        return self.raw.get("ID", None)
+
+    @property
+    def repeat(self):
+        return self.raw.get("Repeat", None)
+
+    @property
+    def next_run(self):
+        return _cached_time(self, "_next_run", "Time")
+
+    @property
+    def last_run(self):
+        return _cached_time(self, "_last_run", "LastRun")
+
+    # The schedule fields that are of interest to humans
+    def summary(self):
+        summary = {}
+        hidden = ["AllowedDays", "ID", "Rule", "Tags", "Time", "LastRun"]
+        for key, value in self.raw.items():
+            if key not in hidden:
+                summary[key] = value
+        next_run = helper.format_datetime(self.next_run)
+        if next_run is not None:
+            summary["Next run"] = next_run
+        last_run = helper.format_datetime(self.last_run)
+        if last_run is not None:
+            summary["Last run"] = last_run
+        return summary
+
+
+# Progress state of the task currently running on the server
+class ProgressState(object):
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw if raw is not None else {}
+
+    @property
+    def backup_id(self):
+        return self.raw.get("BackupID", -1)
+
+    @property
+    def task_id(self):
+        return self.raw.get("TaskID", -1)
+
+    @property
+    def phase(self):
+        return self.raw.get("Phase", None)
+
+    @property
+    def overall_progress(self):
+        return self.raw.get("OverallProgress", 1)
+
+    @property
+    def still_counting(self):
+        return self.raw.get("StillCounting", False)
+
+    @property
+    def processed_file_count(self):
+        return self.raw.get("ProcessedFileCount", 0)
+
+    @property
+    def total_file_count(self):
+        return self.raw.get("TotalFileCount", 0)
+
+    @property
+    def processed_file_size(self):
+        return self.raw.get("ProcessedFileSize", 0)
+
+    @property
+    def total_file_size(self):
+        return self.raw.get("TotalFileSize", 0)
+
+    @property
+    def backend_action(self):
+        return self.raw.get("BackendAction", 0)
+
+    @property
+    def backend_speed(self):
+        return self.raw.get("BackendSpeed", 0)
+
+    @property
+    def processing_files(self):
+        return self.phase == "Backup_ProcessingFiles"
+
+    @property
+    def finished(self):
+        return self.phase in ["Backup_Complete", "Error"]
+
+    @property
+    def file_percentage(self):
+        return _percentage(self.processed_file_count, self.total_file_count)
+
+    @property
+    def size_percentage(self):
+        return _percentage(self.processed_file_size, self.total_file_size)
+
+    @property
+    def backend_percentage(self):
+        current = self.raw.get("BackendFileProgress", 0)
+        total = self.raw.get("BackendFileSize", 0)
+        return _percentage(current, total)
+
+
+# Notification raised by the server
+class Notification(object):
+    __slots__ = ("raw", "_timestamp")
+
+    def __init__(self, raw):
+        self.raw = raw if raw is not None else {}
+        self._timestamp = _UNSET
+
+    @property
+    def id(self):
+        return self.raw.get("ID", -1)
+
+    @property
+    def title(self):
+        return self.raw.get("Title", "Notification")
+
+    @property
+    def message(self):
+        return self.raw.get("Message", "")
+
+    @property
+    def type(self):
+        return self.raw.get("Type", "")
+
+    @property
+    def backup_id(self):
+        return self.raw.get("BackupID", "")
+
+    @property
+    def timestamp(self):
+        return _cached_time(self, "_timestamp", "Timestamp")
+
+
+# Entry from the backup, remote, stored, or live logs
+# Backup logs carry an epoch Timestamp, live logs a When timestamp string
+class LogEntry(object):
+    __slots__ = ("raw", "_timestamp", "_data")
+
+    def __init__(self, raw):
+        self.raw = raw if raw is not None else {}
+        self._timestamp = _UNSET
+        self._data = _UNSET
+
+    @property
+    def id(self):
+        return self.raw.get("ID", None)
+
+    @property
+    def operation(self):
+        return self.raw.get("Operation", "")
+
+    @property
+    def timestamp(self):
+        if self._timestamp is not _UNSET:
+            return self._timestamp
+        if "Timestamp" in self.raw:
+            epoch = _integer(self.raw.get("Timestamp", 0))
+            self._timestamp = datetime.datetime.fromtimestamp(epoch)
+        else:
+            self._timestamp = helper.parse_time(self.raw.get("When", ""))
+        return self._timestamp
+
+    # Decoded remote log data, the list operation is too large to display
+    @property
+    def data(self):
+        if self._data is _UNSET:
+            if self.operation == "list":
+                self._data = "Expunged"
+            else:
+                self._data = json.loads(self.raw.get("Data", None) or "{}")
+        return self._data
+
+    def message_lines(self, show_all=False):
+        return _split_lines(self.raw.get("Message", None), show_all)
+
+    def exception_lines(self, show_all=False):
+        return _split_lines(self.raw.get("Exception", None), show_all)
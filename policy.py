@@ -0,0 +1,256 @@
+# Module for the policy deciding which tasks the daemon accepts
+# The policy is a YAML file listing the operations a task server may order,
+# optionally limited to resource types, ID ranges, a rate and time windows.
+# It is compiled once into matchers, so checking a task costs a few set
+# lookups and a binary search per resource. Operations the policy doesn't
+# list are refused.
+# example:
+# operations:
+#   get: {}
+#   list:
+#     types: [backups, notifications]
+#   run:
+#     types: [backup]
+#     ids: ["1-100", 200]
+#     rate: 30/hour
+#     windows: ["Mon-Fri 08:00-18:00", "Sat 10:00-12:00"]
+import bisect
+import common
+import config
+import datetime
+import os
+import re
+import sys
+import threading
+import time
+import yaml
+
+# Policy used when no policy file exists: every operation except delete
+DEFAULT_POLICY = {
+    "operations": {
+        "list": {}, "get": {}, "describe": {}, "run": {}, "abort": {},
+        "repair": {}, "verify": {}, "compact": {}, "dismiss": {},
+        "logs": {}, "export": {}
+    }
+}
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+RATE_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+RANGE_PATTERN = re.compile(r"^(\d+)-(\d+)$")
+RATE_PATTERN = re.compile(r"^(\d+)\s*/\s*(second|minute|hour|day)$")
+WINDOW_PATTERN = re.compile(
+    r"^(?:(\w{3})(?:-(\w{3}))?\s+)?(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+
+# Raised for policy files that can't be compiled
+class PolicyError(ValueError):
+    pass
+
+
+# Default location of the policy file, next to the config file
+def get_policy_location():
+    directory = os.path.dirname(config.CONFIG_FILE)
+    return os.path.join(directory, "daemon-policy.yml")
+
+
+# Load and compile a policy file, the default policy if it doesn't exist
+def load(path=None):
+    explicit = path is not None
+    if path is None:
+        path = get_policy_location()
+    if not explicit and not os.path.isfile(path):
+        return Policy(DEFAULT_POLICY)
+
+    try:
+        with open(path, 'r') as file_handle:
+            return Policy(yaml.safe_load(file_handle))
+    except (IOError, OSError, yaml.YAMLError, PolicyError) as exc:
+        common.log_output("Invalid policy " + path + ": " + str(exc), True)
+        sys.exit(2)
+
+
+# Sorted, merged ID ranges from a list of ID's and "first-last" strings
+def compile_ids(items):
+    ranges = []
+    for item in items:
+        item = str(item).strip()
+        match = RANGE_PATTERN.match(item)
+        if item.isdigit():
+            ranges.append((int(item), int(item)))
+        elif match:
+            first, last = int(match.group(1)), int(match.group(2))
+            ranges.append((min(first, last), max(first, last)))
+        else:
+            raise PolicyError("Invalid ID or range: " + item)
+
+    merged = []
+    for first, last in sorted(ranges):
+        if len(merged) > 0 and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+# Time window as a set of weekdays and start and end minutes of the day
+def compile_window(text):
+    match = WINDOW_PATTERN.match(str(text).strip())
+    if not match:
+        raise PolicyError("Invalid time window: " + str(text))
+    first_day, last_day, start_h, start_m, end_h, end_m = match.groups()
+
+    days = set(range(7))
+    if first_day is not None:
+        try:
+            first = DAYS.index(first_day.lower())
+            last = DAYS.index((last_day or first_day).lower())
+        except ValueError:
+            raise PolicyError("Invalid day in time window: " + str(text))
+        days = set()
+        day = first
+        while True:
+            days.add(day)
+            if day == last:
+                break
+            day = (day + 1) % 7
+
+    start = int(start_h) * 60 + int(start_m)
+    end = int(end_h) * 60 + int(end_m)
+    if start >= 24 * 60 or end > 24 * 60:
+        raise PolicyError("Invalid time in time window: " + str(text))
+    return days, start, end
+
+
+# Token bucket allowing count tasks per period
+class RateLimit(object):
+    def __init__(self, count, period):
+        self.capacity = float(count)
+        self.per_second = count / float(period)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take a token if one is left
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated) * self.per_second)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+# A field of a rule that must be a list, None if it isn't set
+def list_field(operation, rule, key):
+    value = rule.get(key, None)
+    if value is not None and not isinstance(value, list):
+        raise PolicyError("Invalid " + key + " for " + str(operation) +
+                          ", expected a list: " + str(value))
+    return value
+
+
+# Compiled rule of a single operation
+class Rule(object):
+    __slots__ = ("types", "ranges", "starts", "rate", "windows")
+
+    def __init__(self, operation, rule):
+        if rule is None or rule is True:
+            rule = {}
+        if not isinstance(rule, dict):
+            raise PolicyError("Invalid rule for " + operation)
+
+        types = list_field(operation, rule, "types")
+        self.types = None if types is None else frozenset(types)
+        ids = list_field(operation, rule, "ids")
+        self.ranges = None if ids is None else compile_ids(ids)
+        self.starts = None
+        if self.ranges is not None:
+            self.starts = [first for first, last in self.ranges]
+
+        self.rate = None
+        if rule.get("rate", None) is not None:
+            match = RATE_PATTERN.match(str(rule["rate"]).strip())
+            if not match:
+                raise PolicyError("Invalid rate for " + operation + ": " +
+                                  str(rule["rate"]))
+            self.rate = RateLimit(int(match.group(1)),
+                                  RATE_PERIODS[match.group(2)])
+
+        self.windows = None
+        windows = list_field(operation, rule, "windows")
+        if windows is not None:
+            self.windows = [compile_window(window) for window in windows]
+
+    # Whether an ID is in one of the ranges
+    def allows_id(self, resource_id):
+        if self.ranges is None:
+            return True
+        try:
+            resource_id = int(resource_id)
+        except (TypeError, ValueError):
+            return False
+        position = bisect.bisect_right(self.starts, resource_id) - 1
+        return position >= 0 and resource_id <= self.ranges[position][1]
+
+    # Whether a local time is inside one of the windows
+    def allows_time(self, now):
+        if self.windows is None:
+            return True
+        minute = now.hour * 60 + now.minute
+        weekday = now.weekday()
+        for days, start, end in self.windows:
+            if start <= end:
+                if weekday in days and start <= minute < end:
+                    return True
+            # Windows past midnight belong to the day they start on
+            elif weekday in days and minute >= start:
+                return True
+            elif (weekday - 1) % 7 in days and minute < end:
+                return True
+        return False
+
+
+# Compiled policy
+class Policy(object):
+    def __init__(self, document):
+        if not isinstance(document, dict) or \
+                not isinstance(document.get("operations", None), dict):
+            raise PolicyError("The policy must contain operations")
+        self.rules = {}
+        for operation, rule in document["operations"].items():
+            if rule is False:
+                continue
+            self.rules[operation] = Rule(operation, rule)
+
+    # Reason for refusing a task, None if the policy allows it
+    # The task must have been validated with daemon.validate_task
+    def check(self, task, now=None):
+        operation = task["Operation"]
+        rule = self.rules.get(operation, None)
+        if rule is None:
+            return "Operation not allowed by policy: " + operation
+
+        for resource in task["Resources"]:
+            if rule.types is not None and resource["Type"] not in rule.types:
+                return "Resource type not allowed by policy for " + \
+                    operation + ": " + resource["Type"]
+            if "ID" in resource and not rule.allows_id(resource["ID"]):
+                return "Resource ID not allowed by policy for " + \
+                    operation + ": " + str(resource["ID"])
+
+        if rule.windows is not None:
+            if now is None:
+                now = datetime.datetime.now()
+            if not rule.allows_time(now):
+                return "Outside the time windows of the policy for " + \
+                    operation
+
+        # The rate is only spent on tasks that pass everything else
+        if rule.rate is not None and not rule.rate.take():
+            return "Rate limit of the policy exceeded for " + operation
+        return None
@@ -0,0 +1,362 @@
+# Module for probing the latency of the Duplicati API
+# The probe sends small GET requests to a few endpoints of every server of
+# the inventory at a fixed rate and keeps a latency histogram per server and
+# endpoint. Every interval it reports the request count, error rate and the
+# 50th, 95th and 99th percentile over a rolling window, as a table and as one
+# NDJSON record per server and endpoint for trending.
+# Requests are sent on a fixed schedule whether or not earlier ones have
+# answered, and latency is measured from the time a request was due. A
+# server that stalls therefore shows up as high latency rather than as fewer,
+# fast requests.
+# The histograms are HDR style: values are kept in buckets that are linear
+# within each power of two, so any latency is recorded with less than 1%
+# error in constant time and memory, and histograms of several intervals are
+# merged by adding their buckets.
+import async_client
+import asyncio
+import client
+import collections
+import common
+import datetime
+import inventory
+import json
+import math
+import signal
+import sys
+
+# Endpoints probed, with the path and parameters of their request
+ENDPOINTS = collections.OrderedDict([
+    ("systeminfo", ("/api/v1/systeminfo", None)),
+    ("progressstate", ("/api/v1/progressstate", None)),
+    ("backups", ("/api/v1/backups", None)),
+    ("log", ("/api/v1/logdata/log", {"pagesize": 1}))
+])
+
+# Requests per second to every endpoint of every server
+RATE = 1.0
+
+# Seconds between reports, and the seconds of requests a report covers
+INTERVAL = 10
+WINDOW = 60
+
+# Bits of every value kept by the histograms, 8 bits keep latencies to
+# within 1 in 128
+SIGNIFICANT_BITS = 8
+
+# Seconds to wait for requests in flight when stopping
+SHUTDOWN_TIMEOUT = 10
+
+PERCENTILES = [50, 95, 99]
+
+
+# Bucket of a value, values below 2^SIGNIFICANT_BITS have their own bucket
+def bucket_index(value):
+    if value < (1 << SIGNIFICANT_BITS):
+        return value
+    shift = value.bit_length() - SIGNIFICANT_BITS
+    return (shift << (SIGNIFICANT_BITS - 1)) + (value >> shift)
+
+
+# Highest value that falls into a bucket
+def bucket_value(index):
+    if index < (1 << SIGNIFICANT_BITS):
+        return index
+    shift = (index >> (SIGNIFICANT_BITS - 1)) - 1
+    top = index - (shift << (SIGNIFICANT_BITS - 1))
+    return ((top + 1) << shift) - 1
+
+
+# Latency histogram in microseconds, with the number of failed requests
+class Histogram(object):
+    __slots__ = ("counts", "count", "errors", "maximum")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.errors = 0
+        self.maximum = 0
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        index = bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.maximum = max(self.maximum, value)
+
+    def record_error(self):
+        self.errors += 1
+
+    # Add the values of another histogram
+    def add(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.errors += other.errors
+        self.maximum = max(self.maximum, other.maximum)
+
+    # Latency in microseconds below which percentile percent of values fall
+    def percentile(self, percentile):
+        if self.count == 0:
+            return None
+        rank = max(int(math.ceil(percentile / 100.0 * self.count)), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucket_value(index), self.maximum)
+        return self.maximum
+
+    @property
+    def error_rate(self):
+        total = self.count + self.errors
+        return self.errors / float(total) if total > 0 else 0.0
+
+
+# Milliseconds of a value in microseconds
+def milliseconds(value):
+    return None if value is None else round(value / 1000.0, 3)
+
+
+# Probes servers and reports their latency
+class Probe(object):
+    def __init__(self, servers, endpoints=None, rate=RATE, interval=INTERVAL,
+                 window=WINDOW, output=None, slo_p99=None, slo_errors=None,
+                 host_limit=inventory.HOST_LIMIT):
+        self.servers = servers
+        self.endpoints = endpoints or list(ENDPOINTS)
+        self.rate = rate
+        self.interval = interval
+        self.window = max(window, interval)
+        self.output = output
+        self.slo_p99 = slo_p99
+        self.slo_errors = slo_errors
+        self.host_limit = host_limit
+        # Histograms of the current interval and of the intervals of the
+        # window, keyed by server name and endpoint
+        slices = int(math.ceil(self.window / float(interval)))
+        self.current = {}
+        self.history = {}
+        for server in servers:
+            for endpoint in self.endpoints:
+                key = (server.name, endpoint)
+                self.current[key] = Histogram()
+                self.history[key] = collections.deque(maxlen=slices)
+        self.in_flight = set()
+        self.breaches = 0
+        self.stopping = None
+
+    # Make one request and record its latency from the time it was due
+    async def measure(self, server_name, duplicati, endpoint, due):
+        path, params = ENDPOINTS[endpoint]
+        loop = asyncio.get_running_loop()
+        try:
+            r = await duplicati.call("request", "get", path, params)
+            failed = r.status_code != 200
+        except client.DuplicatiError:
+            failed = True
+        histogram = self.current[(server_name, endpoint)]
+        if failed:
+            histogram.record_error()
+        else:
+            histogram.record(loop.time() - due)
+
+    # Send requests to an endpoint on a fixed schedule until stopped
+    async def probe_endpoint(self, server_name, duplicati, endpoint):
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.rate
+        due = loop.time()
+        while not self.stopping.is_set():
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            future = asyncio.ensure_future(
+                self.measure(server_name, duplicati, endpoint, due))
+            self.in_flight.add(future)
+            future.add_done_callback(self.in_flight.discard)
+            due += period
+
+    # Records of the window ending now, moving the current interval into it
+    def rotate(self):
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        records = []
+        for key in sorted(self.current):
+            self.history[key].append(self.current[key])
+            self.current[key] = Histogram()
+            merged = Histogram()
+            for histogram in self.history[key]:
+                merged.add(histogram)
+            records.append(self.record(now, key, merged))
+        return records
+
+    # Report record of a server and endpoint
+    def record(self, now, key, histogram):
+        server_name, endpoint = key
+        record = collections.OrderedDict([
+            ("time", now.isoformat() + "Z"),
+            ("server", server_name),
+            ("endpoint", endpoint),
+            ("window_s", self.window),
+            ("requests", histogram.count + histogram.errors),
+            ("errors", histogram.errors),
+            ("error_rate", round(histogram.error_rate, 4))
+        ])
+        for percentile in PERCENTILES:
+            value = histogram.percentile(percentile)
+            record["p" + str(percentile) + "_ms"] = milliseconds(value)
+        record["max_ms"] = milliseconds(histogram.maximum or None)
+        if self.slo_p99 is not None or self.slo_errors is not None:
+            record["slo_ok"] = self.meets_slo(record)
+        return record
+
+    # Whether a record meets the latency and error objectives
+    def meets_slo(self, record):
+        p99 = record["p99_ms"]
+        if self.slo_p99 is not None and p99 is not None and \
+                p99 > self.slo_p99:
+            return False
+        if self.slo_errors is not None and \
+                record["error_rate"] > self.slo_errors:
+            return False
+        return True
+
+    # Write the records as NDJSON and print them as a table
+    def report(self, records):
+        self.breaches += len([record for record in records
+                              if record.get("slo_ok", True) is False])
+        lines = [json.dumps(record) for record in records]
+        if self.output == "-":
+            common.log_output("\n".join(lines), True)
+            return
+        if self.output is not None:
+            with open(self.output, 'a') as file_handle:
+                file_handle.write("\n".join(lines) + "\n")
+        display_table(records)
+
+    # Report every interval until stopped
+    async def report_loop(self):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                self.report(self.rotate())
+
+    # Log in to a server, returning the error if it failed
+    async def connect(self, server, duplicati):
+        try:
+            if not duplicati.logged_in():
+                await duplicati.login()
+        except client.DuplicatiError as error:
+            return error
+        return None
+
+    def stop(self):
+        self.stopping.set()
+
+    # Probe all servers for duration seconds or until stopped
+    async def run(self, duration=None):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not supported on Windows, KeyboardInterrupt is used instead
+                pass
+
+        clients = [async_client.AsyncDuplicatiClient(
+            server.data, server.password, self.host_limit)
+            for server in self.servers]
+        try:
+            errors = await asyncio.gather(*[
+                self.connect(server, duplicati)
+                for server, duplicati in zip(self.servers, clients)])
+            workers = []
+            for server, duplicati, error in zip(self.servers, clients,
+                                                errors):
+                if error is not None:
+                    message = server.name + ": " + error.message
+                    common.log_output(message, True, error.status_code)
+                    continue
+                for endpoint in self.endpoints:
+                    workers.append(asyncio.ensure_future(self.probe_endpoint(
+                        server.name, duplicati, endpoint)))
+            reporter = asyncio.ensure_future(self.report_loop())
+
+            if duration is not None:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), duration)
+                except asyncio.TimeoutError:
+                    self.stop()
+            await self.stopping.wait()
+            for worker in workers:
+                worker.cancel()
+            await reporter
+            if len(self.in_flight) > 0:
+                await asyncio.wait(list(self.in_flight),
+                                   timeout=SHUTDOWN_TIMEOUT)
+            self.report(self.rotate())
+        finally:
+            for duplicati in clients:
+                duplicati.close()
+        return len([error for error in errors if error is not None])
+
+
+# Print the records of a report as a table
+def display_table(records):
+    if len(records) == 0:
+        return
+    header = ["SERVER", "ENDPOINT", "REQUESTS", "ERRORS", "P50 ms", "P95 ms",
+              "P99 ms", "MAX ms"]
+    rows = [header]
+    for record in records:
+        row = [record["server"], record["endpoint"], str(record["requests"]),
+               "{0:.1f}%".format(record["error_rate"] * 100)]
+        for field in ["p50_ms", "p95_ms", "p99_ms", "max_ms"]:
+            value = record[field]
+            row.append("-" if value is None else "{0:.1f}".format(value))
+        if record.get("slo_ok", True) is False:
+            row.append("SLO")
+        rows.append(row)
+    widths = [max(len(row[column]) for row in rows if len(row) > column)
+              for column in range(len(header))]
+    message = "Last " + str(records[0]["window_s"]) + "s at "
+    message += records[0]["time"]
+    common.log_output(message, True)
+    for row in rows:
+        cells = [row[0].ljust(widths[0]), row[1].ljust(widths[1])]
+        cells += [cell.rjust(width) for cell, width in zip(row[2:],
+                                                           widths[2:])]
+        cells += row[len(header):]
+        common.log_output("  ".join(cells).rstrip(), True)
+
+
+# Probe the servers of the inventory and report their latency
+def run(data, inventory_path=None, endpoints=None, rate=RATE,
+        interval=INTERVAL, window=WINDOW, duration=None, output=None,
+        slo_p99=None, slo_errors=None):
+    for endpoint in endpoints or []:
+        if endpoint not in ENDPOINTS:
+            message = "Unknown endpoint " + endpoint + ", use "
+            message += ", ".join(ENDPOINTS)
+            common.log_output(message, True)
+            sys.exit(2)
+    if rate <= 0 or interval <= 0:
+        common.log_output("The rate and interval must be positive", True)
+        sys.exit(2)
+
+    servers = inventory.use_stored_password(
+        data, inventory.load(data, inventory_path))
+    probe = Probe(servers, endpoints, rate, interval, window, output,
+                  slo_p99, slo_errors)
+    try:
+        failed = asyncio.run(probe.run(duration))
+    except KeyboardInterrupt:
+        failed = 0
+    if output not in [None, "-"]:
+        common.log_output("Results appended to " + output, True)
+    if probe.breaches > 0:
+        message = str(probe.breaches) + " reports missed the objectives"
+        common.log_output(message, True)
+    if failed > 0 or probe.breaches > 0:
+        sys.exit(2)
+    return data
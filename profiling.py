@@ -0,0 +1,317 @@
+# Module for profiling commands with --profile cpu or --profile mem
+# The CPU profile runs the command under cProfile and the memory profile
+# under tracemalloc. Both write a report sorted by cost and the stacks in
+# the collapsed format that flamegraph.pl, speedscope and inferno read, CPU
+# profiles also the raw pstats file for snakeviz and the like.
+# Known hot paths such as the list filters, timestamp formatting, YAML dumping
+# and the log loops are tagged as sections. Tagged functions run inside a
+# frame named after the section, e.g. <section backup_filter>, so they stand
+# out in profiles and flame graphs, and the report starts with the calls,
+# time and memory of every section. While profiling is off a section costs
+# a single check of a module variable.
+# usage:
+# @profiling.section("backup_filter")
+# def backup_filter(json_input):
+import cProfile
+import functools
+import inspect
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# The profile of this process, None while profiling is off
+profiler = None
+
+# Options whose values are left out of reports and traces
+SECRET_OPTIONS = ["--password", "--basic-pass"]
+
+# Frames kept for every allocation in memory profiles
+MEMORY_FRAMES = 32
+
+# Lines of the report for each ordering
+REPORT_LINES = 40
+
+# Deepest call stacks written to collapsed stacks of CPU profiles, and the
+# least time in seconds a stack needs to be followed further
+MAX_DEPTH = 64
+MIN_STACK_TIME = 0.000001
+
+
+# Records a CPU or memory profile and the calls of the sections
+class Profiler(object):
+    def __init__(self, mode, path):
+        self.mode = mode
+        self.path = path
+        self.started = time.perf_counter()
+        self.sections = {}
+        self.lock = threading.Lock()
+        self.profile = None
+
+    def start(self):
+        if self.mode == "mem":
+            tracemalloc.start(MEMORY_FRAMES)
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+
+    # Count a call of a section with its time and the memory it kept
+    def add(self, name, seconds, allocated):
+        with self.lock:
+            calls, total, memory = self.sections.get(name, (0, 0.0, 0))
+            self.sections[name] = (calls + 1, total + seconds,
+                                   memory + allocated)
+
+
+# Give a function a name of its own in profiles
+# Decorators share the code of their wrapper between all functions they
+# decorate, which would merge the calls of all of them into one entry of the
+# profile and one frame of the flame graph
+def named(function, label):
+    try:
+        code = function.__code__.replace(co_name=label)
+        if hasattr(code, "co_qualname"):
+            code = code.replace(co_qualname=label)
+        function.__code__ = code
+    except (AttributeError, TypeError, ValueError):
+        # Pythons without CodeType.replace keep the shared name
+        pass
+    return function
+
+
+# Command line of this process with the values of secret options hidden,
+# reports and traces are meant to be shared
+def command_line(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    words = []
+    hide_next = False
+    for word in argv:
+        option, separator, value = word.partition("=")
+        if hide_next:
+            word = "***"
+            hide_next = False
+        elif option in SECRET_OPTIONS:
+            if separator != "":
+                word = option + "=***"
+            else:
+                hide_next = True
+        words.append(word)
+    return " ".join(words)
+
+
+# Memory traced by tracemalloc right now, 0 unless profiling memory
+def traced_memory():
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+
+# Decorator tagging a function as a section of the profile
+def section(name):
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            def wrapper(*args, **kwargs):
+                current = profiler
+                if current is None:
+                    return (yield from function(*args, **kwargs))
+                start = time.perf_counter()
+                memory = traced_memory()
+                try:
+                    return (yield from function(*args, **kwargs))
+                finally:
+                    current.add(name, time.perf_counter() - start,
+                                traced_memory() - memory)
+        else:
+            def wrapper(*args, **kwargs):
+                current = profiler
+                if current is None:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                memory = traced_memory()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    current.add(name, time.perf_counter() - start,
+                                traced_memory() - memory)
+        named(wrapper, "<section " + name + ">")
+        return functools.wraps(function)(wrapper)
+    return decorator
+
+
+# Whether profiling is on
+def enabled():
+    return profiler is not None
+
+
+# Start profiling, path is the report file without extension
+def enable(mode, path):
+    global profiler
+    profiler = Profiler(mode, path)
+    profiler.start()
+    return profiler
+
+
+# Readable size of a number of bytes, negative for memory released
+def format_size(size):
+    sign = "-" if size < 0 else ""
+    size = abs(size)
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return sign + "{0:.1f}".format(size) + " " + unit
+        size /= 1024.0
+    return sign + "{0:.1f}".format(size) + " GiB"
+
+
+# Table of the sections, most expensive first
+def sections_table(sections, mode):
+    if len(sections) == 0:
+        return "No tagged sections ran"
+    rows = [["SECTION", "CALLS", "TOTAL ms", "MEAN ms"]]
+    if mode == "mem":
+        rows[0].append("KEPT")
+    for name in sorted(sections, key=lambda item: -sections[item][1]):
+        calls, total, memory = sections[name]
+        row = [name, str(calls), "{0:.1f}".format(total * 1000),
+               "{0:.3f}".format(total * 1000 / calls)]
+        if mode == "mem":
+            row.append(format_size(memory))
+        rows.append(row)
+    widths = [max(len(row[column]) for row in rows)
+              for column in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        cells = [row[0].ljust(widths[0])]
+        cells += [cell.rjust(width) for cell, width in zip(row[1:],
+                                                           widths[1:])]
+        lines.append("  ".join(cells).rstrip())
+    return "\n".join(lines)
+
+
+# Label of a function in pstats for collapsed stacks
+def function_label(function):
+    filename, lineno, name = function
+    if filename == "~":
+        # Built in functions
+        return name
+    return name + " (" + os.path.basename(filename) + ":" + str(lineno) + ")"
+
+
+# Collapsed stacks of a CPU profile
+# cProfile keeps callers rather than whole stacks, so the stacks are rebuilt
+# from the call graph and the time of a function shared among its callers
+# in proportion to the time each of them spent in it
+def collapsed_cpu_stacks(stats):
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge[3]))
+    roots = [function for function, entry in stats.items()
+             if len(entry[4]) == 0]
+
+    totals = {}
+
+    def walk(function, stack, share, depth):
+        cumulative = stats[function][3]
+        if cumulative * share < MIN_STACK_TIME or depth > MAX_DEPTH:
+            return
+        stack = stack + [function_label(function)]
+        key = ";".join(stack)
+        totals[key] = totals.get(key, 0) + stats[function][2] * share
+        for callee, edge_time in callees.get(function, []):
+            if function_label(callee) in stack:
+                # Recursion is folded into the frame already on the stack
+                continue
+            walk(callee, stack, share * edge_time / cumulative, depth + 1)
+
+    for root in roots:
+        walk(root, [], 1.0, 0)
+    # Collapsed stacks count integer samples, here microseconds
+    return [stack + " " + str(int(round(seconds * 1000000)))
+            for stack, seconds in sorted(totals.items())
+            if seconds * 1000000 >= 1]
+
+
+# Collapsed stacks of a memory snapshot, counting bytes
+def collapsed_memory_stacks(snapshot):
+    lines = []
+    for statistic in snapshot.statistics("traceback"):
+        frames = [os.path.basename(frame.filename) + ":" + str(frame.lineno)
+                  for frame in statistic.traceback]
+        # tracemalloc lists the most recent frame first
+        lines.append(";".join(reversed(frames)) + " " + str(statistic.size))
+    return lines
+
+
+# Sorted report and collapsed stacks of a CPU profile
+def cpu_report(current):
+    output = io.StringIO()
+    stats = pstats.Stats(current.profile, stream=output)
+    stats.strip_dirs()
+    output.write("Sorted by cumulative time\n")
+    stats.sort_stats("cumulative").print_stats(REPORT_LINES)
+    output.write("Sorted by own time\n")
+    stats.sort_stats("tottime").print_stats(REPORT_LINES)
+    # The stacks keep the directories apart
+    stats = pstats.Stats(current.profile)
+    stats.dump_stats(current.path + ".prof")
+    return output.getvalue(), collapsed_cpu_stacks(stats.stats)
+
+
+# Sorted report and collapsed stacks of a memory profile
+def memory_report():
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__)
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    lines = ["Memory in use " + format_size(current) + ", peak " +
+             format_size(peak), "", "Largest allocations by line"]
+    for statistic in snapshot.statistics("lineno")[:REPORT_LINES]:
+        frame = statistic.traceback[0]
+        lines.append(format_size(statistic.size).rjust(12) + "  " +
+                     str(statistic.count).rjust(8) + " blocks  " +
+                     frame.filename + ":" + str(frame.lineno))
+    return "\n".join(lines) + "\n", collapsed_memory_stacks(snapshot)
+
+
+# Stop profiling and write the report and the collapsed stacks
+def finish():
+    global profiler
+    current = profiler
+    if current is None:
+        return None
+    profiler = None
+    current.stop()
+    elapsed = time.perf_counter() - current.started
+
+    report_path = current.path + ".txt"
+    stacks_path = current.path + ".folded"
+    try:
+        directory = os.path.dirname(report_path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        if current.mode == "mem":
+            report, stacks = memory_report()
+        else:
+            report, stacks = cpu_report(current)
+        table = sections_table(current.sections, current.mode)
+        header = "Profile of " + command_line() + ", "
+        header += "{0:.1f}".format(elapsed * 1000) + " ms\n\n"
+        with open(report_path, 'w') as file_handle:
+            file_handle.write(header + table + "\n\n" + report)
+        with open(stacks_path, 'w') as file_handle:
+            file_handle.write("\n".join(stacks) + "\n")
+        written = "Profile written to " + report_path + " and " + stacks_path
+    except (IOError, OSError) as exc:
+        table = sections_table(current.sections, current.mode)
+        written = "Failed to write profile " + report_path + ": " + str(exc)
+    sys.stderr.write(table + "\n" + written + "\n")
+    return report_path, stacks_path
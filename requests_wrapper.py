@@ -5,7 +5,15 @@
 # import the library instead of requests
 # from requests_wrapper import requests_wrapper as requests
 # use it like the requests library
+#
+# Long running processes, such as the shell, can enable a pooled session to
+# reuse connections between requests and a cache for GET responses.
+# Embedded clients use a session_wrapper instead, which holds its own session
+# and cache rather than the module wide ones.
 import requests
+import threading
+import time
+import tracing
 import urllib3
 
 # Disable invalid SSL warnings when explicitly asking to not check
@@ -14,12 +22,89 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # To avoid hanging forever on requests
 timeout_seconds=5
 
+# Pooled session shared by all requests once enabled with use_session()
+session = None
+
+# Cache of successful GET responses once enabled with enable_cache()
+cache = None
+cache_lock = threading.Lock()
+
+
 # Dummy return object for when exceptions are thrown
 class Dummy():
     status_code = 503
     url = ""
 
 
+# Route all requests through a pooled session
+def use_session(new_session=None):
+    global session
+    if new_session is None:
+        new_session = requests.Session()
+    session = new_session
+    return session
+
+
+# Cache GET responses until clear_cache() or a modifying request
+def enable_cache():
+    global cache
+    cache = {}
+
+
+# Drop all cached responses
+def clear_cache():
+    if cache is None:
+        return
+    with cache_lock:
+        cache.clear()
+
+
+# Key identifying a cached GET request
+def cache_key(baseurl, params):
+    if params is None:
+        return baseurl
+    return baseurl + "?" + repr(sorted(params.items()))
+
+
+# Make a request, translating exceptions into HTTP status codes
+# Uses client_session if given, else the module wide session if enabled.
+# With --trace the request is recorded as a span.
+def request(method, baseurl, client_session=None, **kwargs):
+    if client_session is not None:
+        function = getattr(client_session, method)
+    elif session is not None:
+        function = getattr(session, method)
+    else:
+        function = getattr(requests, method)
+    stream = kwargs.get("stream", False)
+    return tracing.request(method, baseurl, stream,
+                           lambda: send(function, baseurl, kwargs))
+
+
+# Send a request, translating exceptions into HTTP status codes
+def send(function, baseurl, kwargs):
+    try:
+        return function(baseurl, **kwargs)
+    except requests.exceptions.SSLError:
+        dummy = Dummy()
+        dummy.status_code = 526
+        return dummy
+    except requests.exceptions.ConnectionError:
+        dummy = Dummy()
+        return dummy
+    except requests.exceptions.Timeout:
+        dummy = Dummy()
+        dummy.status_code = 408
+        return dummy
+    except OSError:
+        dummy = Dummy()
+        dummy.status_code = 495
+        return dummy
+    except Exception:
+        dummy = Dummy()
+        return dummy
+
+
 # Requests wrapper class
 class requests_wrapper():
     def get(baseurl,
@@ -28,36 +113,33 @@ class requests_wrapper():
             params=None,
             allow_redirects=True,
             verify=True,
-            timeout=timeout_seconds
+            timeout=timeout_seconds,
+            stream=False
            ):
-        try:
-            r = requests.get(baseurl,
-                             headers=headers,
-                             cookies=cookies,
-                             params=params,
-                             allow_redirects=allow_redirects,
-                             verify=verify,
-                             timeout=timeout_seconds
-                            )
-            return r
-        except requests.exceptions.SSLError:
-            dummy = Dummy()
-            dummy.status_code = 526
-            return dummy
-        except requests.exceptions.ConnectionError:
-            dummy = Dummy()
-            return dummy
-        except requests.exceptions.Timeout:
-            dummy = Dummy()
-            dummy.status_code = 408
-            return dummy
-        except OSError as ex:
-            dummy = Dummy()
-            dummy.status_code = 495
-            return dummy
-        except Exception:
-            dummy = Dummy()
-            return dummy
+        # Cached responses must have their body read
+        if cache is not None:
+            key = cache_key(baseurl, params)
+            with cache_lock:
+                cached = cache.get(key, None)
+            if cached is not None:
+                return cached
+            stream = False
+
+        r = request("get",
+                    baseurl,
+                    headers=headers,
+                    cookies=cookies,
+                    params=params,
+                    allow_redirects=allow_redirects,
+                    verify=verify,
+                    timeout=timeout_seconds,
+                    stream=stream
+                   )
+
+        if cache is not None and r.status_code == 200:
+            with cache_lock:
+                cache[key] = r
+        return r
 
     def delete(baseurl,
                headers=None,
@@ -67,30 +149,16 @@ class requests_wrapper():
                verify=True,
                timeout=timeout_seconds
               ):
-        try:
-            r = requests.delete(baseurl,
-                                headers=headers,
-                                cookies=cookies,
-                                params=params,
-                                allow_redirects=allow_redirects,
-                                verify=verify,
-                                timeout=timeout_seconds
-                                )
-            return r
-        except requests.exceptions.SSLError:
-            dummy = Dummy()
-            dummy.status_code = 526
-            return dummy
-        except requests.exceptions.ConnectionError:
-            dummy = Dummy()
-            return dummy
-        except OSError:
-            dummy = Dummy()
-            dummy.status_code = 495
-            return dummy
-        except Exception:
-            dummy = Dummy()
-            return dummy
+        clear_cache()
+        return request("delete",
+                       baseurl,
+                       headers=headers,
+                       cookies=cookies,
+                       params=params,
+                       allow_redirects=allow_redirects,
+                       verify=verify,
+                       timeout=timeout_seconds
+                      )
 
     def post(baseurl,
              headers=None,
@@ -102,32 +170,18 @@ class requests_wrapper():
              verify=True,
              timeout=timeout_seconds
             ):
-        try:
-            r = requests.post(baseurl,
-                              headers=headers,
-                              cookies=cookies,
-                              params=params,
-                              data=data,
-                              files=files,
-                              allow_redirects=allow_redirects,
-                              verify=verify,
-                              timeout=timeout_seconds
-                             )
-            return r
-        except requests.exceptions.SSLError:
-            dummy = Dummy()
-            dummy.status_code = 526
-            return dummy
-        except requests.exceptions.ConnectionError:
-            dummy = Dummy()
-            return dummy
-        except OSError:
-            dummy = Dummy()
-            dummy.status_code = 495
-            return dummy
-        except Exception:
-            dummy = Dummy()
-            return dummy
+        clear_cache()
+        return request("post",
+                       baseurl,
+                       headers=headers,
+                       cookies=cookies,
+                       params=params,
+                       data=data,
+                       files=files,
+                       allow_redirects=allow_redirects,
+                       verify=verify,
+                       timeout=timeout_seconds
+                      )
 
     def put(baseurl,
             headers=None,
@@ -139,32 +193,18 @@ class requests_wrapper():
             verify=True,
             timeout=timeout_seconds
            ):
-        try:
-            r = requests.put(baseurl,
-                             headers=headers,
-                             cookies=cookies,
-                             params=params,
-                             data=data,
-                             files=files,
-                             allow_redirects=allow_redirects,
-                             verify=verify,
-                             timeout=timeout_seconds
-                            )
-            return r
-        except requests.exceptions.SSLError:
-            dummy = Dummy()
-            dummy.status_code = 526
-            return dummy
-        except requests.exceptions.ConnectionError:
-            dummy = Dummy()
-            return dummy
-        except OSError:
-            dummy = Dummy()
-            dummy.status_code = 495
-            return dummy
-        except Exception:
-            dummy = Dummy()
-            return dummy
+        clear_cache()
+        return request("put",
+                       baseurl,
+                       headers=headers,
+                       cookies=cookies,
+                       params=params,
+                       data=data,
+                       files=files,
+                       allow_redirects=allow_redirects,
+                       verify=verify,
+                       timeout=timeout_seconds
+                      )
 
     def patch(baseurl,
               headers=None,
@@ -176,29 +216,69 @@ class requests_wrapper():
               verify=True,
               timeout=timeout_seconds
              ):
-        try:
-            r = requests.patch(baseurl,
-                               headers=headers,
-                               cookies=cookies,
-                               params=params,
-                               data=data,
-                               files=files,
-                               allow_redirects=allow_redirects,
-                               verify=verify,
-                               timeout=timeout_seconds
-                              )
-            return r
-        except requests.exceptions.SSLError:
-            dummy = Dummy()
-            dummy.status_code = 526
-            return dummy
-        except requests.exceptions.ConnectionError:
-            dummy = Dummy()
-            return dummy
-        except OSError:
-            dummy = Dummy()
-            dummy.status_code = 495
-            return dummy
-        except Exception:
-            dummy = Dummy()
-            return dummy
+        clear_cache()
+        return request("patch",
+                       baseurl,
+                       headers=headers,
+                       cookies=cookies,
+                       params=params,
+                       data=data,
+                       files=files,
+                       allow_redirects=allow_redirects,
+                       verify=verify,
+                       timeout=timeout_seconds
+                      )
+
+
+# Wrapper with its own pooled session and GET cache, used by DuplicatiClient
+# Cached responses expire after cache_ttl seconds, 0 disables the cache
+class session_wrapper():
+    def __init__(self, new_session=None, cache_ttl=0):
+        self.session = new_session or requests.Session()
+        self.cache_ttl = cache_ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+    def get(self, baseurl, headers=None, cookies=None, params=None,
+            allow_redirects=True, verify=True, timeout=timeout_seconds,
+            stream=False):
+        key = cache_key(baseurl, params)
+        if self.cache_ttl > 0:
+            with self.lock:
+                cached = self.cache.get(key, None)
+            if cached is not None and time.time() - cached[0] < self.cache_ttl:
+                return cached[1]
+            stream = False
+
+        r = request("get", baseurl, client_session=self.session,
+                    headers=headers, cookies=cookies, params=params,
+                    allow_redirects=allow_redirects, verify=verify,
+                    timeout=timeout, stream=stream)
+
+        if self.cache_ttl > 0 and r.status_code == 200:
+            with self.lock:
+                self.cache[key] = (time.time(), r)
+        return r
+
+    # Modifying requests invalidate all cached responses
+    def send(self, method, baseurl, kwargs):
+        self.clear_cache()
+        kwargs.setdefault("timeout", timeout_seconds)
+        return request(method, baseurl, client_session=self.session,
+                       **kwargs)
+
+    def delete(self, baseurl, **kwargs):
+        return self.send("delete", baseurl, kwargs)
+
+    def post(self, baseurl, **kwargs):
+        return self.send("post", baseurl, kwargs)
+
+    def put(self, baseurl, **kwargs):
+        return self.send("put", baseurl, kwargs)
+
+    def patch(self, baseurl, **kwargs):
+        return self.send("patch", baseurl, kwargs)
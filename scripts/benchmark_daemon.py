@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Benchmark of the sustained task throughput of the daemon's task handling.
+# Policy checks of a queue of fetched tasks are measured first. Then
+# simulated tasks run concurrently, pass validation and the policy, and
+# record their states like the daemon does: received and result are waited
+# for, delivered is not. The journal with group commit is compared with one
+# fsync per record and with rewriting a YAML task list on every state
+# change.
+# usage:
+# python3 benchmark_daemon.py --tasks 5000 --concurrency 64
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import timeit
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import daemon  # noqa: E402
+import journal  # noqa: E402
+import policy  # noqa: E402
+
+# Policy using every kind of matcher, with a rate that is never reached
+BENCHMARK_POLICY = {
+    "operations": {
+        "get": {"types": ["backup", "notification"],
+                "ids": ["1-1000", "2000-3000", 5000]},
+        "run": {"types": ["backup"], "ids": ["1-100"],
+                "rate": "1000000/second", "windows": ["00:00-24:00"]},
+        "list": {}
+    }
+}
+
+
+# A task like the ones fetched from the task server
+def create_task(task_id):
+    return {"ID": task_id, "Operation": "get",
+            "Resources": [{"Type": "backup", "ID": task_id % 1000 + 1}]}
+
+
+# Validate a task and check it against the policy like the daemon does
+def check_task(task_policy, task):
+    reason = daemon.validate_task(task)
+    if reason is None:
+        reason = task_policy.check(task)
+    return reason
+
+
+# Task list rewritten as a whole on every state change
+class YamlTaskList(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.commits = 0
+
+    def record(self, task_id, state, **fields):
+        with self.lock:
+            if state == journal.DELIVERED:
+                self.tasks.pop(task_id, None)
+            else:
+                self.tasks.setdefault(task_id, {}).update(fields, State=state)
+            with open(self.path, 'w') as file_handle:
+                yaml.safe_dump(self.tasks, file_handle)
+                file_handle.flush()
+                os.fsync(file_handle.fileno())
+            self.commits += 1
+
+
+# Record the states of one task, waiting like the daemon does
+def run_task(store, task_id, task_policy):
+    task = create_task(task_id)
+    if check_task(task_policy, task) is not None:
+        raise ValueError("Task refused by the benchmark policy")
+    result = {"Results": [{"Type": "backup", "ID": 1, "Result": "ok"}]}
+    if isinstance(store, YamlTaskList):
+        store.record(task_id, journal.RECEIVED, Task=task)
+        store.record(task_id, journal.RESULT, Status="completed", Data=result)
+        store.record(task_id, journal.DELIVERED)
+        return
+    store.record(task_id, journal.RECEIVED, Task=task).result()
+    store.record(task_id, journal.RESULT, Status="completed",
+                 Data=result).result()
+    store.record(task_id, journal.DELIVERED)
+
+
+# Validate and check a queue of tasks, returns tasks per second
+def measure_policy(tasks):
+    task_policy = policy.Policy(BENCHMARK_POLICY)
+    queue = [create_task(task_id) for task_id in range(tasks)]
+    start = timeit.default_timer()
+    for task in queue:
+        check_task(task_policy, task)
+    return tasks / (timeit.default_timer() - start)
+
+
+# Run the tasks against a store and return tasks per second and commits
+def measure(store, tasks, concurrency):
+    task_policy = policy.Policy(BENCHMARK_POLICY)
+    start = timeit.default_timer()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(run_task, store, task_id,
+                                       task_policy)
+                       for task_id in range(tasks)]:
+            future.result()
+    if isinstance(store, journal.Journal):
+        store.close()
+    duration = timeit.default_timer() - start
+    return tasks / duration, store.commits
+
+
+def report(name, tasks, rate, commits=None):
+    line = name.ljust(24) + str(tasks).rjust(8) + " tasks" + \
+        str(round(rate, 1)).rjust(12) + " tasks/s"
+    if commits is not None:
+        line += str(commits).rjust(10) + " fsyncs"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Daemon task benchmark")
+    parser.add_argument('--tasks', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help="tasks in flight at the same time")
+    parser.add_argument('--yaml-tasks', type=int, default=500,
+                        help="tasks for the YAML task list, 0 to skip")
+    parser.add_argument('--directory', help="directory for the files, "
+                        "the benchmark measures its disk")
+    args = parser.parse_args()
+
+    report("policy check", args.tasks * 10, measure_policy(args.tasks * 10))
+
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        path = os.path.join(directory, "task-journal.jsonl")
+        store = journal.Journal(path)
+        store.open()
+        rate, commits = measure(store, args.tasks, args.concurrency)
+        report("group commit", args.tasks, rate, commits)
+
+        os.remove(path)
+        store = journal.Journal(path, commit_delay=0, max_batch=1)
+        store.open()
+        rate, commits = measure(store, args.tasks, args.concurrency)
+        report("fsync per record", args.tasks, rate, commits)
+
+        if args.yaml_tasks > 0:
+            store = YamlTaskList(os.path.join(directory, "task-list.yml"))
+            rate, commits = measure(store, args.yaml_tasks, args.concurrency)
+            report("yaml rewrite", args.yaml_tasks, rate, commits)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
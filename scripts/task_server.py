@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# Local stand-in for a task server, for testing and load testing daemon mode
+# offline. It implements the task server API from the README: tasks/status
+# answers 303 while tasks wait to be accepted or refused, tasks lists them,
+# and tasks/<id>/result records the results posted by the daemon. With
+# --batch-results the task list advertises batches and tasks/results
+# accepts many results in one request.
+# usage:
+# python3 task_server.py --generate 1000 --operation get --resource backup:1
+# duc daemon http://localhost:8300 --jobs 8
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import yaml
+
+from http.server import BaseHTTPRequestHandler
+
+# ThreadingHTTPServer was added in Python 3.7
+try:
+    from http.server import ThreadingHTTPServer as HTTPServer
+except ImportError:
+    from http.server import HTTPServer
+
+# Statuses that end a task
+FINAL_STATUSES = ["refused", "completed", "error"]
+
+
+# Tasks and results shared by the request handlers
+class TaskStore(object):
+    def __init__(self, batch_size=100, fail_rate=0.0, batch_results=False):
+        self.lock = threading.Lock()
+        self.batch_results = batch_results
+        self.result_requests = 0
+        self.tasks = {}
+        self.pending = []
+        self.batch_size = batch_size
+        self.fail_rate = fail_rate
+        self.next_id = 1
+        self.started = None
+        self.finished = None
+        self.statuses = {}
+        self.latencies = []
+        self.failed_posts = 0
+
+    # Add a task, assigning an ID unless it has one
+    def add(self, task):
+        with self.lock:
+            if task.get("ID", None) is None:
+                task["ID"] = self.next_id
+            self.next_id = max(self.next_id, int(task["ID"])) + 1
+            self.tasks[task["ID"]] = {
+                "task": task,
+                "status": None,
+                "created": time.time()
+            }
+            self.pending.append(task["ID"])
+
+    # Whether tasks are waiting to be accepted or refused
+    def has_pending(self):
+        with self.lock:
+            return len(self.pending) > 0
+
+    # Tasks waiting to be accepted or refused, at most batch_size
+    def list_pending(self):
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            ids = self.pending[:self.batch_size]
+            tasks = [self.tasks[task_id]["task"] for task_id in ids]
+        if self.batch_results:
+            return {"Tasks": tasks, "Batch": True}
+        return tasks
+
+    # Record a result, returns the HTTP status code of the response
+    def post_result(self, task_id, result):
+        with self.lock:
+            self.result_requests += 1
+        if random.random() < self.fail_rate:
+            with self.lock:
+                self.failed_posts += 1
+            return 500
+        with self.lock:
+            return self.record(task_id, result)
+
+    # Record a batch of results, all or none of them
+    def post_results(self, results):
+        with self.lock:
+            self.result_requests += 1
+        if random.random() < self.fail_rate:
+            with self.lock:
+                self.failed_posts += 1
+            return 500
+        with self.lock:
+            for result in results:
+                self.record(result.get("ID", None), result)
+            return 200
+
+    # Record a result while holding the lock, deduplicated by task ID
+    def record(self, task_id, result):
+        entry = self.tasks.get(task_id, None)
+        if entry is None:
+            return 404
+        status = result.get("Status", None)
+        if entry["status"] in FINAL_STATUSES:
+            # Repeated posts of a final result are accepted
+            return 200
+        entry["status"] = status
+        entry["result"] = result.get("Data", None)
+        if task_id in self.pending:
+            self.pending.remove(task_id)
+        if status in FINAL_STATUSES:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.latencies.append(time.time() - entry["created"])
+            if self.done():
+                self.finished = time.time()
+        return 200
+
+    # Whether all tasks have a final status
+    def done(self):
+        return all(entry["status"] in FINAL_STATUSES
+                   for entry in self.tasks.values())
+
+    # Throughput and latency of the tasks finished so far
+    def summary(self):
+        with self.lock:
+            count = len(self.latencies)
+            latencies = sorted(self.latencies)
+            end = self.finished or time.time()
+            duration = end - (self.started or end)
+        summary = {
+            "tasks": len(self.tasks),
+            "finished": count,
+            "statuses": dict(self.statuses),
+            "result requests": self.result_requests,
+            "failed result posts": self.failed_posts,
+            "seconds": round(duration, 3),
+        }
+        if count > 0 and duration > 0:
+            summary["tasks per second"] = round(count / duration, 1)
+        for percentile in [50, 90, 99]:
+            if count > 0:
+                position = min(count - 1, int(count * percentile / 100.0))
+                key = "latency p" + str(percentile)
+                summary[key] = round(latencies[position], 4)
+        return summary
+
+
+# Request handler implementing the task server API
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def reply(self, code, content=None):
+        body = b""
+        if content is not None:
+            body = json.dumps(content).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/api/tasks/status":
+            return self.reply(303 if self.store.has_pending() else 304)
+        if path == "/api/tasks":
+            return self.reply(200, self.store.list_pending())
+        if path == "/api/summary":
+            return self.reply(200, self.store.summary())
+        return self.reply(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = self.rfile.read(length) if length > 0 else b""
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["api", "tasks", "results"] and self.store.batch_results:
+            try:
+                content = json.loads(body.decode("utf-8"))
+                results = content["Results"]
+            except (ValueError, KeyError, TypeError):
+                return self.reply(400)
+            return self.reply(self.store.post_results(results))
+        if len(parts) == 4 and parts[:2] == ["api", "tasks"] and \
+                parts[3] == "result":
+            try:
+                result = json.loads(body.decode("utf-8"))
+            except ValueError:
+                return self.reply(400)
+            task_id = result.get("ID", parts[2])
+            return self.reply(self.store.post_result(task_id, result))
+        if parts == ["api", "tasks"]:
+            try:
+                self.store.add(json.loads(body.decode("utf-8")))
+            except (ValueError, AttributeError):
+                return self.reply(400)
+            return self.reply(200)
+        return self.reply(404)
+
+    def log_message(self, *args):
+        pass
+
+
+# Tasks created from the command line options
+def generate_tasks(count, operation, resources):
+    parsed = []
+    for resource in resources:
+        resource_type, _, resource_id = resource.partition(":")
+        item = {"Type": resource_type}
+        if resource_id != "":
+            item["ID"] = int(resource_id) if resource_id.isdigit() \
+                else resource_id
+        parsed.append(item)
+    return [{"Operation": operation, "Resources": parsed}
+            for _ in range(count)]
+
+
+# Tasks from a YAML or JSON file containing a list of tasks
+def load_tasks(path):
+    with open(path, 'r') as file_handle:
+        tasks = yaml.safe_load(file_handle)
+    if isinstance(tasks, dict):
+        tasks = tasks.get("Tasks", [tasks])
+    return tasks or []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in task server")
+    parser.add_argument('--port', type=int, default=8300)
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--tasks', help="YAML or JSON file with tasks")
+    parser.add_argument('--generate', type=int, default=0,
+                        help="number of tasks to generate")
+    parser.add_argument('--operation', default="get")
+    parser.add_argument('--resource', action='append',
+                        help="resource as type:id, e.g. backup:1")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="tasks per second added while running")
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help="tasks returned per task list")
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help="share of result posts answered with 500")
+    parser.add_argument('--batch-results', action='store_true',
+                        help="accept results in batches")
+    parser.add_argument('--exit-when-done', action='store_true')
+    args = parser.parse_args()
+
+    store = TaskStore(args.batch_size, args.fail_rate, args.batch_results)
+    resources = args.resource or ["backup:1"]
+    if args.tasks is not None:
+        for task in load_tasks(args.tasks):
+            store.add(task)
+    for task in generate_tasks(args.generate, args.operation, resources):
+        store.add(task)
+
+    Handler.store = store
+    server = HTTPServer((args.host, args.port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print("Task server listening on http://" + args.host + ":" +
+          str(args.port) + " with " + str(len(store.tasks)) + " tasks")
+
+    try:
+        while True:
+            if args.rate > 0:
+                time.sleep(1.0 / args.rate)
+                for task in generate_tasks(1, args.operation, resources):
+                    store.add(task)
+            else:
+                time.sleep(0.2)
+            if args.exit_when_done and len(store.tasks) > 0 and store.done():
+                break
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    print(yaml.safe_dump(store.summary(), default_flow_style=False))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Local stand-in for a webhook receiving the events of duc events, for
+# testing offline. It accepts {"Events": [...]} posted to any path, prints
+# every event as NDJSON, and keeps a count of batches, events and
+# duplicates. With --fail-rate a share of the posts is answered with 500 to
+# exercise the retries of the dispatcher.
+# usage:
+# python3 webhook_receiver.py --port 8400 --fail-rate 0.2
+# duc events --webhook http://localhost:8400/hook
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import yaml
+
+from http.server import BaseHTTPRequestHandler
+
+# ThreadingHTTPServer was added in Python 3.7
+try:
+    from http.server import ThreadingHTTPServer as HTTPServer
+except ImportError:
+    from http.server import HTTPServer
+
+
+# Events received, shared by the request handlers
+class EventStore(object):
+    def __init__(self, fail_rate=0.0, output=None):
+        self.lock = threading.Lock()
+        self.fail_rate = fail_rate
+        self.output = output
+        self.posts = 0
+        self.failed_posts = 0
+        self.batches = 0
+        self.events = []
+        self.ids = set()
+        self.duplicates = 0
+        self.kinds = {}
+        self.started = time.time()
+
+    # Record a batch, returns the HTTP status code of the response
+    def post(self, events):
+        with self.lock:
+            self.posts += 1
+            if random.random() < self.fail_rate:
+                self.failed_posts += 1
+                return 500
+            self.batches += 1
+            for event in events:
+                # Retried batches may repeat events that already arrived
+                event_id = event.get("id", None)
+                if event_id is not None and event_id in self.ids:
+                    self.duplicates += 1
+                    continue
+                self.ids.add(event_id)
+                self.events.append(event)
+                kind = event.get("event", "unknown")
+                self.kinds[kind] = self.kinds.get(kind, 0) + 1
+                self.write(event)
+            return 200
+
+    # Print an event, and append it to the output file if there is one
+    def write(self, event):
+        line = json.dumps(event)
+        print(line)
+        sys.stdout.flush()
+        if self.output is not None:
+            with open(self.output, 'a') as file_handle:
+                file_handle.write(line + "\n")
+
+    # Counts of the posts and events received so far
+    def summary(self):
+        with self.lock:
+            return {
+                "posts": self.posts,
+                "failed posts": self.failed_posts,
+                "batches": self.batches,
+                "events": len(self.events),
+                "duplicates": self.duplicates,
+                "events by type": dict(self.kinds),
+                "seconds": round(time.time() - self.started, 3)
+            }
+
+
+# Request handler accepting batches of events
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def reply(self, code, content=None):
+        body = b""
+        if content is not None:
+            body = json.dumps(content).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/summary":
+            return self.reply(200, self.store.summary())
+        if path == "/events":
+            with self.store.lock:
+                events = list(self.store.events)
+            return self.reply(200, {"Events": events})
+        return self.reply(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = self.rfile.read(length) if length > 0 else b""
+        try:
+            content = json.loads(body.decode("utf-8"))
+            events = content["Events"]
+            if not isinstance(events, list):
+                raise TypeError("Events must be a list")
+        except (ValueError, KeyError, TypeError):
+            return self.reply(400)
+        return self.reply(self.store.post(events))
+
+    def log_message(self, *args):
+        pass
+
+
+# Start a receiver in a thread of its own, returns the server
+def serve(store, host="127.0.0.1", port=8400):
+    Handler.store = store
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in webhook receiver")
+    parser.add_argument('--port', type=int, default=8400)
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help="share of posts answered with 500")
+    parser.add_argument('--output', help="file the events are appended to")
+    parser.add_argument('--expect', type=int, default=0,
+                        help="exit once this many events arrived")
+    args = parser.parse_args()
+
+    store = EventStore(args.fail_rate, args.output)
+    server = serve(store, args.host, args.port)
+    sys.stderr.write("Webhook receiver listening on http://" + args.host +
+                     ":" + str(args.port) + "\n")
+
+    try:
+        while args.expect <= 0 or len(store.events) < args.expect:
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    sys.stderr.write(yaml.safe_dump(store.summary(),
+                                    default_flow_style=False))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# Module for the server settings
+# The settings of one or many servers are brought in line with a file by
+# sending each server a single PATCH with only the settings that differ.
+import archive
+import common
+import inventory
+import sys
+import yaml
+
+# Server settings that are internal to Duplicati and never displayed
+HIDDEN_SETTINGS = [
+    "update-check-latest",
+    "last-update-check",
+    "is-first-run",
+    "update-check-interval",
+    "server-passphrase",
+    "server-passphrase-salt",
+    "server-passphrase-trayicon",
+    "server-passphrase-trayicon-hash",
+    "unacked-error",
+    "unacked-warning",
+    "has-fixed-invalid-backup-id",
+]
+
+
+# Server settings without the internal ones
+def visible(settings):
+    return dict((key, value) for key, value in settings.items()
+                if key not in HIDDEN_SETTINGS)
+
+
+# Flat settings of the list export serversettings writes, which holds one
+# {name: {"value": value}} entry per setting
+def unwrap_export(document):
+    settings = {}
+    for entry in document:
+        if not isinstance(entry, dict) or len(entry) != 1:
+            return None
+        key, setting = list(entry.items())[0]
+        if not isinstance(setting, dict) or "value" not in setting:
+            return None
+        settings[key] = setting["value"]
+    return settings
+
+
+# Load the desired settings from a YAML or JSON file, the file written by
+# export serversettings, or the server settings stored in an archive made
+# by export --archive
+def load_file(path):
+    if archive.is_archive(path):
+        document = archive.read_settings(path)
+        if document is None:
+            raise ValueError(path + " has no server settings")
+    else:
+        with open(path, 'r') as file_handle:
+            document = yaml.safe_load(file_handle)
+    if isinstance(document, list):
+        document = unwrap_export(document)
+    if not isinstance(document, dict) or len(document) == 0:
+        raise ValueError(path + " must map setting names to values")
+    hidden = sorted(key for key in document if key in HIDDEN_SETTINGS)
+    if len(hidden) > 0:
+        raise ValueError(path + " sets internal settings: " +
+                         ", ".join(hidden))
+    return dict((str(key), setting_value(value))
+                for key, value in document.items())
+
+
+# Settings are stored as strings, booleans in lower case
+def setting_value(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+# Whether a current value already matches the desired one
+def same_value(current, desired):
+    if current is None or desired is None:
+        return current is desired
+    current = str(current)
+    if desired in ["true", "false"]:
+        return current.lower() == desired
+    return current == desired
+
+
+# Settings of desired that differ from the current settings
+def delta(current, desired):
+    return dict((key, value) for key, value in desired.items()
+                if not same_value(current.get(key, None), value))
+
+
+# Bring the server settings of every server in line with a file
+# Each server gets at most one PATCH with only the settings that differ
+def apply_file(data, path, inventory_path=None, dry_run=False):
+    try:
+        desired = load_file(path)
+    except (IOError, OSError, yaml.YAMLError, ValueError) as exc:
+        common.log_output(str(exc), True)
+        sys.exit(2)
+    servers = inventory.load(data, inventory_path)
+
+    async def apply_server(server, duplicati):
+        changes = delta(await duplicati.server_settings(), desired)
+        if len(changes) > 0 and not dry_run:
+            await duplicati.update_server_settings(changes)
+        return changes
+
+    results = inventory.gather(servers, apply_server)
+
+    rows = [("SERVER", "STATUS", "SETTINGS")]
+    failed = 0
+    for server, (changes, error) in zip(servers, results):
+        if error is not None:
+            failed += 1
+            rows.append((server.name, "failed", error.message))
+        elif len(changes) == 0:
+            rows.append((server.name, "unchanged", ""))
+        else:
+            status = "would change" if dry_run else "changed"
+            rows.append((server.name, status, ", ".join(sorted(changes))))
+    display_table(rows)
+    if failed > 0:
+        sys.exit(2)
+    return results
+
+
+# Print rows in aligned columns
+def display_table(rows):
+    widths = [max(len(row[column]) for row in rows)
+              for column in range(len(rows[0]) - 1)]
+    for row in rows:
+        cells = [cell.ljust(width) for cell, width in zip(row, widths)]
+        common.log_output("  ".join(cells + [row[-1]]).rstrip(), True)
@@ -0,0 +1,218 @@
+# Module for the interactive shell
+# The shell parses commands with the regular argument parser and keeps the
+# configuration, a pooled session and a cache of GET responses alive between
+# commands. Repeated reads are answered from the cache until "!refresh" is
+# used or a command modifies something on the server.
+import arg_parser
+import common
+import completion
+import config
+import index
+import os
+import requests_wrapper
+import shlex
+
+# readline is not available on all platforms, e.g. Windows
+try:
+    import readline
+except ImportError:
+    readline = None
+
+PROMPT = "duc> "
+HISTORY_LENGTH = 1000
+
+# Commands handled by the shell itself
+SHELL_COMMANDS = ["exit", "quit", "help", "!refresh"]
+
+# Commands that change the session and must not be answered from the cache
+SESSION_COMMANDS = ["login", "logout", "config", "params"]
+
+
+# Run the shell until exit, quit, or end of input
+def run(data, run_command):
+    requests_wrapper.use_session()
+    requests_wrapper.enable_cache()
+    setup_readline(data)
+
+    message = "Duplicati client shell, type help for commands or exit to quit"
+    common.log_output(message, True)
+    try:
+        while True:
+            try:
+                line = input(PROMPT)
+            except EOFError:
+                common.log_output("", True)
+                break
+            except KeyboardInterrupt:
+                common.log_output("", True)
+                continue
+
+            data, running = execute(data, line, run_command)
+            if not running:
+                break
+    finally:
+        save_history()
+    return data
+
+
+# Execute a line entered in the shell
+# Returns the possibly updated config and whether the shell keeps running
+def execute(data, line, run_command):
+    try:
+        words = shlex.split(line)
+    except ValueError as exc:
+        common.log_output(exc, True)
+        return data, True
+
+    if len(words) == 0:
+        return data, True
+
+    if words[0] in ["exit", "quit"]:
+        return data, False
+
+    if words[0] == "help":
+        arg_parser.parser.print_help()
+        return data, True
+
+    if words[0] == "!refresh":
+        requests_wrapper.clear_cache()
+        index.invalidate(data)
+        common.log_output("Cleared cached responses", False)
+        words = words[1:]
+        if len(words) == 0:
+            return data, True
+
+    try:
+        args = vars(arg_parser.parser.parse_args(words))
+    except SystemExit:
+        # argparse has already printed the error or help
+        return data, True
+
+    method = args.get("method", None)
+    if method is None:
+        return data, True
+    if method == "shell":
+        common.log_output("Already running a shell", True)
+        return data, True
+    if method in ["batch", "daemon", "exporter", "probe", "top",
+                  "events"]:
+        common.log_output("Command not supported in the shell", True)
+        return data, True
+    if method in SESSION_COMMANDS:
+        requests_wrapper.clear_cache()
+
+    try:
+        result = run_command(data, method, args)
+        if isinstance(result, dict):
+            data = result
+    except SystemExit:
+        # Commands exit on errors after printing a message
+        pass
+    except KeyboardInterrupt:
+        common.log_output("", True)
+
+    return data, True
+
+
+# Location of the shell history file, next to the config file
+def get_history_location():
+    return os.path.join(os.path.dirname(config.CONFIG_FILE), "shell_history")
+
+
+# Enable history and tab completion if readline is available
+def setup_readline(data):
+    if readline is None:
+        return
+
+    try:
+        readline.read_history_file(get_history_location())
+    except (IOError, OSError):
+        pass
+    readline.set_history_length(HISTORY_LENGTH)
+
+    commands = completion.describe_commands()
+
+    def completer(text, state):
+        if state == 0:
+            buffer = readline.get_line_buffer()[:readline.get_begidx()]
+            try:
+                words = shlex.split(buffer)
+            except ValueError:
+                words = buffer.split()
+            entry = index.read_index().get(index.server_key(data), {})
+            completer.matches = complete_line(commands, entry, words, text)
+        if state < len(completer.matches):
+            return completer.matches[state]
+        return None
+
+    completer.matches = []
+    readline.set_completer(completer)
+    readline.set_completer_delims(" \t\n")
+    if "libedit" in (readline.__doc__ or ""):
+        readline.parse_and_bind("bind ^I rl_complete")
+    else:
+        readline.parse_and_bind("tab: complete")
+
+
+# Write the shell history to disk
+def save_history():
+    if readline is None:
+        return
+    try:
+        readline.write_history_file(get_history_location())
+    except (IOError, OSError):
+        pass
+
+
+# Candidates for the word being completed given the preceding words
+def complete_line(commands, entry, words, text):
+    if len(words) > 0 and words[0] == "!refresh":
+        words = words[1:]
+
+    commands = dict((command["name"], command) for command in commands)
+    if len(words) == 0:
+        candidates = sorted(commands.keys()) + SHELL_COMMANDS
+        return [word for word in candidates if word.startswith(text)]
+
+    command = commands.get(words[0], None)
+    if command is None:
+        return []
+
+    value_options = command["value_options"]
+    if words[-1] in value_options:
+        if words[-1] == "--id":
+            candidates = completion.cached_values(entry, "backups")
+        else:
+            candidates = value_options[words[-1]]
+        return [word for word in candidates if word.startswith(text)]
+
+    if text.startswith("-"):
+        return [word for word in command["options"] if word.startswith(text)]
+
+    # Count the positional arguments before the current word
+    positionals = []
+    skip = False
+    for word in words[1:]:
+        if skip:
+            skip = False
+        elif word in value_options:
+            skip = True
+        elif not word.startswith("-"):
+            positionals.append(word)
+
+    position = len(positionals)
+    if position == 0 and len(command["choices"]) > 0:
+        candidates = command["choices"]
+    elif command["id_position"] >= 0 and (
+            position == command["id_position"] or
+            (command["id_many"] and position > command["id_position"])):
+        kind = command["id_kind"]
+        if kind == "typed":
+            if len(positionals) > 0 and positionals[0] == "notification":
+                kind = "notifications"
+            else:
+                kind = "backups"
+        candidates = completion.cached_values(entry, kind)
+    else:
+        candidates = []
+    return [word for word in candidates if word.startswith(text)]
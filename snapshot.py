@@ -0,0 +1,265 @@
+# Module for content-addressed snapshots of the backup configurations
+# Every backup configuration is normalized, i.e. stripped of fields that
+# change on their own such as the metadata, progress and schedule times, and
+# stored under the SHA-256 of its normalized JSON. A run writes only the
+# configurations that aren't in the store yet, plus a manifest mapping each
+# backup to the hash of its configuration, so nightly snapshots of unchanged
+# servers cost one small manifest. Comparing two runs compares two manifests.
+# Layout of the store:
+#   objects/ab/abcdef...json   normalized configuration
+#   manifests/<server>/<run>.json  backups of a server at the time of a run
+import client
+import common
+import config
+import datetime
+import hashlib
+import json
+import models
+import os
+import sys
+
+from requests_wrapper import requests_wrapper as requests
+
+# Fields that change without the configuration changing
+VOLATILE_FIELDS = {
+    "Backup": ["Metadata"],
+    "Schedule": ["LastRun", "Time"]
+}
+VOLATILE_ITEMS = ["Progress"]
+
+# Format of run names, they sort in the order the runs were taken
+RUN_FORMAT = "%Y-%m-%dT%H-%M-%S"
+
+
+# Default location of the snapshot store, next to the config file
+def get_store_location():
+    directory = os.path.dirname(config.CONFIG_FILE)
+    return os.path.join(directory, "snapshots")
+
+
+# Configuration of a backup without the volatile fields
+def normalize(item):
+    normalized = {}
+    for key, value in models.Backup(item).config().items():
+        if key in VOLATILE_ITEMS:
+            continue
+        if key in VOLATILE_FIELDS and isinstance(value, dict):
+            value = dict((field, field_value)
+                         for field, field_value in value.items()
+                         if field not in VOLATILE_FIELDS[key])
+        normalized[key] = value
+    return normalized
+
+
+# Canonical JSON of a normalized configuration and its hash
+def serialize(normalized):
+    content = json.dumps(normalized, sort_keys=True, separators=(",", ":"),
+                         default=str)
+    return content, hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+# Location of an object in the store
+def object_path(store, digest):
+    return os.path.join(store, "objects", digest[:2], digest + ".json")
+
+
+# Write a file atomically so readers never see half of it
+def write_atomic(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    temporary = path + ".tmp" + str(os.getpid())
+    with open(temporary, 'w') as file_handle:
+        file_handle.write(content)
+    # os.replace overwrites an existing file on Windows too
+    os.replace(temporary, path)
+
+
+# Location of the manifest of a run, manifests are kept apart per server
+def manifest_path(store, server, run):
+    key = hashlib.sha256(server.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(store, "manifests", key, run + ".json")
+
+
+# Names of the runs of a server, oldest first
+def list_runs(store, server):
+    directory = os.path.dirname(manifest_path(store, server, ""))
+    try:
+        names = os.listdir(directory)
+    except (IOError, OSError):
+        return []
+    return sorted(name[:-len(".json")] for name in names
+                  if name.endswith(".json"))
+
+
+# Read the manifest of a run, None if it is missing or damaged
+def read_manifest(store, server, run):
+    path = manifest_path(store, server, run)
+    try:
+        with open(path, 'r') as file_handle:
+            manifest = json.load(file_handle)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or "Backups" not in manifest:
+        return None
+    return manifest
+
+
+# Read a stored configuration
+def read_object(store, digest):
+    with open(object_path(store, digest), 'r') as file_handle:
+        return json.load(file_handle)
+
+
+# Find the run a name or time prefix refers to
+# A prefix such as 2024-05-01 selects the last run starting with it, any
+# other value the last run taken before it.
+def resolve_run(runs, name):
+    if name in runs:
+        return name
+    matches = [run for run in runs if run.startswith(name)]
+    if len(matches) == 0:
+        matches = [run for run in runs if run <= name]
+    if len(matches) == 0:
+        return None
+    return matches[-1]
+
+
+# Take a snapshot of the backup configurations on the server
+def take(data, store=None):
+    if store is None:
+        store = get_store_location()
+    server = common.create_baseurl(data)
+    common.verify_token(data)
+    common.log_output("Fetching backups list from API...", False)
+    duplicati = client.DuplicatiClient(data, http=requests, persist=True,
+                                       relogin=False)
+    now = datetime.datetime.utcnow()
+    backups = []
+    written = 0
+    try:
+        for item in duplicati.list_resource("backups", True):
+            backup = models.Backup(item)
+            content, digest = serialize(normalize(item))
+            path = object_path(store, digest)
+            if not os.path.isfile(path):
+                write_atomic(path, content)
+                written += 1
+            backups.append({"ID": backup.id, "Name": backup.name,
+                            "Hash": digest})
+    except client.DuplicatiError as error:
+        common.log_output(error.message, True, error.status_code)
+        sys.exit(2)
+
+    runs = list_runs(store, server)
+    run = now.strftime(RUN_FORMAT)
+    # Runs taken within the same second get a counter
+    counter = 1
+    while run in runs:
+        counter += 1
+        run = now.strftime(RUN_FORMAT) + "." + str(counter).zfill(3)
+    manifest = {
+        "Run": run,
+        "Server": server,
+        "Created": now.isoformat() + "Z",
+        "Backups": backups
+    }
+    write_atomic(manifest_path(store, server, run),
+                 json.dumps(manifest, indent=2, sort_keys=True))
+
+    changed = len(backups)
+    previous = None
+    if len(runs) > 0:
+        previous = read_manifest(store, server, runs[-1])
+    if previous is not None:
+        changes = compare(previous, manifest)
+        changed = len(changes["Added"]) + len(changes["Changed"])
+    message = "Snapshot " + run + ": " + str(len(backups)) + " backups, "
+    message += str(changed) + " changed, " + str(written) + " stored"
+    common.log_output(message, True, 200)
+    return manifest
+
+
+# Backups added, removed and changed between two manifests
+def compare(old, new):
+    old_backups = dict((item["ID"], item) for item in old["Backups"])
+    new_backups = dict((item["ID"], item) for item in new["Backups"])
+    changes = {"Added": [], "Removed": [], "Changed": []}
+    for backup_id, item in new_backups.items():
+        previous = old_backups.get(backup_id, None)
+        if previous is None:
+            changes["Added"].append(item)
+        elif previous["Hash"] != item["Hash"]:
+            changes["Changed"].append(item)
+    for backup_id, item in old_backups.items():
+        if backup_id not in new_backups:
+            changes["Removed"].append(item)
+    return changes
+
+
+# Names of the top level fields that differ between two configurations
+def changed_fields(old, new):
+    fields = []
+    for key in sorted(set(old) | set(new)):
+        if not isinstance(old.get(key, None), dict) or \
+                not isinstance(new.get(key, None), dict):
+            if old.get(key, None) != new.get(key, None):
+                fields.append(key)
+            continue
+        for field in sorted(set(old[key]) | set(new[key])):
+            if old[key].get(field, None) != new[key].get(field, None):
+                fields.append(key + "." + field)
+    return fields
+
+
+# Display the runs of the server
+def display_runs(data, store=None):
+    if store is None:
+        store = get_store_location()
+    server = common.create_baseurl(data)
+    runs = list_runs(store, server)
+    if len(runs) == 0:
+        common.log_output("No snapshots found", True)
+        sys.exit(2)
+    for run in runs:
+        manifest = read_manifest(store, server, run)
+        if manifest is None:
+            continue
+        message = run + "  " + str(len(manifest["Backups"])) + " backups"
+        common.log_output(message, True)
+    common.log_output("", True, 200)
+
+
+# Display what changed between a run and the latest run
+def display_changes(data, since, store=None):
+    if store is None:
+        store = get_store_location()
+    server = common.create_baseurl(data)
+    runs = list_runs(store, server)
+    run = resolve_run(runs, since)
+    if run is None:
+        common.log_output("No snapshot found for " + since, True)
+        sys.exit(2)
+    old = read_manifest(store, server, run)
+    new = read_manifest(store, server, runs[-1])
+    if old is None or new is None:
+        common.log_output("Damaged snapshot manifest", True)
+        sys.exit(2)
+    changes = compare(old, new)
+
+    message = "Changes from " + run + " to " + runs[-1]
+    common.log_output(message, True)
+    for item in changes["Added"]:
+        common.log_output("+ " + item["ID"] + " " + item["Name"], True)
+    for item in changes["Removed"]:
+        common.log_output("- " + item["ID"] + " " + item["Name"], True)
+    previous = dict((item["ID"], item) for item in old["Backups"])
+    for item in changes["Changed"]:
+        fields = changed_fields(
+            read_object(store, previous[item["ID"]]["Hash"]),
+            read_object(store, item["Hash"]))
+        message = "~ " + item["ID"] + " " + item["Name"]
+        common.log_output(message + ": " + ", ".join(fields), True)
+    if sum(len(items) for items in changes.values()) == 0:
+        common.log_output("No changes", True)
+    common.log_output("", True, 200)
@@ -0,0 +1,57 @@
+# Module for incrementally decoding large JSON responses from the API
+# ijson is an optional dependency. When it is installed list responses are
+# decoded one item at a time straight from the socket, otherwise the whole
+# response is decoded at once like before.
+import collections
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Whether responses should be requested as streams
+def available():
+    return ijson is not None
+
+
+# Iterate over the items of a JSON response one at a time
+# The prefix follows the ijson syntax, e.g. "item" for the elements of a
+# top level list or "data.item" for the elements of a nested list
+def iterate(response, prefix="item"):
+    # Fall back to decoding everything if the body was already read
+    if ijson is None or getattr(response, "_content", False) is not False:
+        return iter(select(response.json(), prefix))
+
+    return _iterate_stream(response, prefix)
+
+
+# Generator reading items from the raw response stream
+def _iterate_stream(response, prefix):
+    # Let urllib3 take care of gzip/deflate encoded bodies
+    response.raw.decode_content = True
+    try:
+        for item in ijson.items(response.raw, prefix, use_float=True):
+            yield item
+    finally:
+        response.close()
+
+
+# Select the list described by an ijson prefix from a decoded document
+def select(document, prefix="item"):
+    for key in prefix.split("."):
+        if key == "item":
+            continue
+        if not isinstance(document, dict):
+            return []
+        document = document.get(key, [])
+    if document is None:
+        return []
+    return document
+
+
+# Keep only the last count items of an iterable without holding the rest
+def tail(iterable, count):
+    if count is None or count <= 0:
+        return list(iterable)
+    return list(collections.deque(iterable, maxlen=count))
@@ -1,8 +1,46 @@
 import unittest
 from mock import patch
 from auth import login
+from concurrent.futures import ThreadPoolExecutor
+import apply
+import archive
+import async_client
+import asyncio
+import auth
+import batch
+import client
 import common
+import completion
+import daemon
+import datetime
+import drift
+import events
+import duplicati_client
+import exporter
+import index
+import inventory
+import io
+import journal
+import json
+import models
+import os
+import policy
+import probe
+import profiling
+import settings
+import shell
+import snapshot
+import streaming
 import requests
+import requests_wrapper
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import top
+import tracing
+import yaml
 
 
 class TestLogin(unittest.TestCase):
@@ -278,3 +316,1702 @@ class TestResponse200(unittest.TestCase):
             'authorization': ''
             }
         common.check_response(data, 200)
+
+
+class TestStreaming(unittest.TestCase):
+    class MockResponse:
+        def __init__(self, json_raw):
+            self.json_raw = json_raw
+            self._content = b"loaded"
+
+        def json(self):
+            return self.json_raw
+
+    def test_iterate_loaded_response(self):
+        response = self.MockResponse({"data": [{"ID": 1}, {"ID": 2}]})
+        items = list(streaming.iterate(response, "data.item"))
+        self.assertEqual(items, [{"ID": 1}, {"ID": 2}])
+
+    @unittest.skipIf(not streaming.available(), "ijson is not installed")
+    def test_iterate_stream(self):
+        class StreamResponse:
+            _content = False
+
+            def __init__(self, body):
+                self.raw = io.BytesIO(body)
+                self.closed = False
+
+            def json(self):
+                raise AssertionError("The body must not be loaded")
+
+            def close(self):
+                self.closed = True
+
+        body = b'{"data": [{"ID": 1, "Size": 1.5}, {"ID": 2}], "other": 3}'
+        response = StreamResponse(body)
+        items = streaming.iterate(response, "data.item")
+        self.assertEqual(next(items), {"ID": 1, "Size": 1.5})
+        self.assertFalse(response.closed)
+        self.assertEqual(list(items), [{"ID": 2}])
+        self.assertTrue(response.raw.decode_content)
+        self.assertTrue(response.closed)
+
+    def test_select_missing_prefix(self):
+        self.assertEqual(streaming.select({"other": []}, "data.item"), [])
+
+    def test_tail(self):
+        self.assertEqual(streaming.tail(iter(range(10)), 3), [7, 8, 9])
+        self.assertEqual(streaming.tail(iter(range(3)), 0), [0, 1, 2])
+
+
+class TestModels(unittest.TestCase):
+    def test_backup_fields(self):
+        backup = models.Backup({
+            "Backup": {
+                "ID": "3",
+                "Name": "Documents",
+                "Metadata": {"BackupListCount": "12"}
+            },
+            "Progress": {"Phase": "Backup_ProcessingFiles"}
+        })
+        self.assertEqual(backup.id, "3")
+        self.assertEqual(backup.name, "Documents")
+        self.assertEqual(backup.metadata.versions, 12)
+        self.assertIsNone(backup.schedule)
+        self.assertTrue(backup.progress.processing_files)
+        self.assertNotIn("Progress", backup.config())
+
+    def test_timestamp_parsed_once(self):
+        schedule = models.Schedule({"Time": "2018-06-13T18:28:32Z"})
+        self.assertIs(schedule.next_run, schedule.next_run)
+        self.assertIsNone(schedule.last_run)
+
+    def test_progress_percentage(self):
+        progress = models.ProgressState({
+            "ProcessedFileCount": 25,
+            "TotalFileCount": 100,
+            "TotalFileSize": 0
+        })
+        self.assertEqual(progress.file_percentage, 25.0)
+        self.assertIsNone(progress.size_percentage)
+
+    def test_log_entry_lines(self):
+        entry = models.LogEntry({"Message": "\n".join(["x"] * 20)})
+        lines = entry.message_lines()
+        self.assertEqual(len(lines), 16)
+        self.assertEqual(lines[-1], "5 hidden lines (show with --all)")
+        self.assertEqual(len(entry.message_lines(True)), 20)
+        self.assertIsNone(entry.exception_lines())
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.entry = {
+            "updated": 0,
+            "backups": {
+                "1": {"Name": "db-main", "Tags": ["prod"], "DBPath": "/a"},
+                "2": {"Name": "web", "Tags": [], "DBPath": "/b"},
+                "12": {"Name": "db-test", "Tags": ["test"], "DBPath": "/c"},
+            }
+        }
+
+    def test_match_selectors(self):
+        self.assertEqual(index.match(self.entry, "db-*"), [1, 12])
+        self.assertEqual(index.match(self.entry, "1-10"), [1, 2])
+        self.assertEqual(index.match(self.entry, "tag:prod"), [1])
+        self.assertEqual(index.match(self.entry, "dbpath:/c"), [12])
+        self.assertEqual(index.match(self.entry, "name:web"), [2])
+        self.assertEqual(index.match(self.entry, "missing"), [])
+
+    def test_numeric_selectors_skip_index(self):
+        with patch('index.load') as load:
+            self.assertEqual(index.resolve({}, ["3", "3", "1"]), [3, 1])
+            self.assertFalse(load.called)
+
+    def test_stale_index_refreshed_once(self):
+        data = client_config()
+        stale = {index.server_key(data): self.entry}
+        backups = [{"Backup": {"ID": "2", "Name": "web"}}]
+        response = TestClient.MockResponse(200, backups)
+        with patch('index.read_index', return_value=stale), \
+                patch('index.write_index'), \
+                patch('common.verify_token'), \
+                patch('common.write_config'), \
+                patch('index.requests.get', return_value=response) as get:
+            with self.assertRaises(SystemExit):
+                index.resolve(data, ["db-*"])
+        # Refreshing the stale index counts as refreshing after the miss
+        self.assertEqual(get.call_count, 1)
+
+    def test_parse_ids(self):
+        self.assertEqual(index.parse_ids(["5-3", "9"]), [3, 4, 5, 9])
+        with self.assertRaises(SystemExit):
+            index.parse_ids(["abc"])
+
+
+class TestCompletion(unittest.TestCase):
+    def test_describe_commands(self):
+        commands = completion.describe_commands()
+        commands = dict((command["name"], command) for command in commands)
+        self.assertNotIn("complete", commands)
+        self.assertEqual(commands["get"]["choices"],
+                         ["backup", "notification"])
+        self.assertEqual(commands["get"]["id_kind"], "typed")
+        self.assertEqual(commands["run"]["id_kind"], "backups")
+        self.assertEqual(commands["dismiss"]["id_kind"], "notifications")
+        self.assertIn("--id", commands["logs"]["value_options"])
+
+    def test_generate_scripts(self):
+        for shell in ["bash", "zsh", "fish"]:
+            script = completion.generate(shell)
+            self.assertIn("complete", script)
+            self.assertIn("describe", script)
+
+    def test_serve_time_budget(self):
+        def load_config(data):
+            return data
+
+        def slow_load_config(data):
+            time.sleep(1)
+            return data
+
+        with patch('completion.complete', return_value=["1", "db"]), \
+                patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            completion.serve(slow_load_config, {}, "backups", timeout=0.05)
+            self.assertEqual(stdout.getvalue(), "")
+            completion.serve(load_config, {}, "backups", timeout=1)
+            self.assertEqual(stdout.getvalue(), "1\ndb\n")
+
+    def test_cached_values(self):
+        entry = {
+            "backups": {
+                "10": {"Name": "web"},
+                "2": {"Name": "db"}
+            },
+            "notifications": [{"ID": 7}]
+        }
+        self.assertEqual(completion.cached_values(entry, "backups"),
+                         ["2", "10", "db", "web"])
+        self.assertEqual(completion.cached_values(entry, "notifications"),
+                         ["7"])
+
+
+class TestShell(unittest.TestCase):
+    def setUp(self):
+        self.commands = completion.describe_commands()
+        self.entry = {"backups": {"1": {"Name": "db"}}}
+
+    def test_complete_line(self):
+        complete = shell.complete_line
+        self.assertIn("get", complete(self.commands, self.entry, [], "g"))
+        self.assertEqual(complete(self.commands, self.entry, ["get"], "b"),
+                         ["backup"])
+        self.assertEqual(complete(self.commands, self.entry,
+                                  ["get", "backup"], ""), ["1", "db"])
+        self.assertEqual(complete(self.commands, self.entry,
+                                  ["logs", "--id"], "d"), ["db"])
+
+    def test_execute(self):
+        calls = []
+
+        def run_command(data, method, args):
+            calls.append((method, args.get("id")))
+            if method == "run":
+                sys.exit(2)
+            return {"updated": True}
+
+        data, running = shell.execute({}, "get backup 1 db", run_command)
+        self.assertEqual(data, {"updated": True})
+        self.assertTrue(running)
+        data, running = shell.execute(data, "run 1", run_command)
+        self.assertTrue(running)
+        data, running = shell.execute(data, "exit", run_command)
+        self.assertFalse(running)
+        self.assertEqual(calls, [("get", ["1", "db"]), ("run", ["1"])])
+
+
+class TestFollow(unittest.TestCase):
+    def test_follow_skips_cache(self):
+        response = TestClient.MockResponse(200, [])
+
+        def fetch():
+            requests_wrapper.requests_wrapper.get("http://localhost/api")
+
+        with patch.object(requests_wrapper, "cache", {}), \
+                patch('requests_wrapper.request',
+                      return_value=response) as request, \
+                patch('compatibility.clear_prompt'), \
+                patch('common.log_output'), \
+                patch('time.sleep', side_effect=[None, KeyboardInterrupt]):
+            duplicati_client.follow_function(fetch)
+        self.assertEqual(request.call_count, 2)
+
+    def test_follow_redraws_changes_only(self):
+        outputs = iter(["a", "a", "b"])
+
+        def show():
+            common.log_output(next(outputs), True)
+
+        with patch('compatibility.clear_prompt') as clear_prompt, \
+                patch('compatibility.rewrite_line') as rewrite_line, \
+                patch('builtins.print'), \
+                patch('time.sleep',
+                      side_effect=[None, None, KeyboardInterrupt]):
+            duplicati_client.follow_function(show)
+        self.assertEqual(clear_prompt.call_count, 2)
+        self.assertEqual(rewrite_line.call_count, 1)
+
+
+class TestBatch(unittest.TestCase):
+    def test_read_commands(self):
+        lines = [
+            "# comment",
+            "duc get backup 1",
+            '{"id": "a", "args": ["run", "2"]}',
+            "---",
+            '{"command": "list backups", "wait": true}',
+            "shell",
+            "get nothing"
+        ]
+        groups = batch.read_commands(lines)
+        self.assertEqual([len(group) for group in groups], [2, 1, 2])
+        self.assertEqual(groups[0][0].args["method"], "get")
+        self.assertEqual(groups[0][1].id, "a")
+        self.assertEqual(groups[0][1].args["id"], ["2"])
+        self.assertIsNotNone(groups[2][0].error)
+        self.assertIsNotNone(groups[2][1].error)
+
+    def test_execute(self):
+        def run_command(data, method, args):
+            common.log_output("output of " + method, True)
+            if method == "run":
+                common.log_output("failed", True, 404)
+                sys.exit(2)
+            return data
+
+        groups = batch.read_commands(["get backup 1", "run 1"])
+        ok = batch.execute({}, groups[0][0], run_command)
+        self.assertEqual(ok["status"], "ok")
+        self.assertEqual(ok["output"], "output of get")
+        failed = batch.execute({}, groups[0][1], run_command)
+        self.assertEqual(failed["status"], "error")
+        self.assertEqual(failed["code"], 2)
+        self.assertEqual(failed["http_status"], 404)
+
+    def test_parallel_commands_login_once(self):
+        data = client_config()
+        data["token_expires"] = datetime.datetime.now()
+        logins = []
+
+        def login(data, password=None, verify=True):
+            logins.append(password)
+            time.sleep(0.05)
+            expires = datetime.datetime.now() + datetime.timedelta(0, 600)
+            data["token_expires"] = expires
+            return data
+
+        with patch('auth.login', side_effect=login), \
+                patch('common.load_parameters', return_value={}), \
+                patch('common.log_output'):
+            threads = [threading.Thread(target=common.verify_token,
+                                        args=(data,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(logins), 1)
+
+
+# Configuration of a client that is logged in
+def client_config():
+    return {
+        "server": {"protocol": "http", "url": "localhost",
+                   "port": "8200", "verify": True},
+        "token": "token",
+        "token_expires": datetime.datetime.now() + datetime.timedelta(0, 600),
+        "authorization": ""
+    }
+
+
+class TestClient(unittest.TestCase):
+    class MockResponse:
+        def __init__(self, status_code, json_data=None):
+            self.status_code = status_code
+            self.json_data = json_data
+            self.text = ""
+
+        def json(self):
+            return self.json_data
+
+    class MockHttp:
+        def __init__(self, responses):
+            self.responses = responses
+            self.calls = []
+
+        def get(self, baseurl, **kwargs):
+            self.calls.append(("get", baseurl))
+            path = baseurl.split(":8200")[1]
+            return self.responses.get(path, TestClient.MockResponse(404))
+
+        def post(self, baseurl, **kwargs):
+            self.calls.append(("post", baseurl))
+            return TestClient.MockResponse(503)
+
+    def setUp(self):
+        self.data = client_config()
+
+    def test_get_backup(self):
+        backup = {"Backup": {"ID": "1", "Name": "db"}}
+        http = self.MockHttp({
+            "/api/v1/backup/1": self.MockResponse(200, {"data": backup}),
+            "/api/v1/progressstate": self.MockResponse(200, {
+                "BackupID": "1", "Phase": "Backup_ProcessingFiles",
+                "OverallProgress": 0.5})
+        })
+        duplicati = client.DuplicatiClient(self.data, http=http)
+        result = duplicati.get_backups(["1"])
+        self.assertEqual(result[0].name, "db")
+        self.assertEqual(result[0].progress.phase, "Backup_ProcessingFiles")
+        with self.assertRaises(client.NotFoundError):
+            duplicati.get_backup(2)
+
+    def test_errors(self):
+        duplicati = client.DuplicatiClient(self.data, http=self.MockHttp({}))
+        with self.assertRaises(client.DuplicatiError) as context:
+            duplicati.run(1)
+        self.assertEqual(context.exception.status_code, 503)
+
+        self.data["token"] = None
+        with self.assertRaises(client.AuthenticationError):
+            duplicati.list_backups()
+
+    def test_hash_password(self):
+        # sha256(nonce + sha256(password + salt)) of the decoded values
+        hashed = auth.hash_password("password", "c2FsdA==", "bm9uY2U=")
+        self.assertEqual(hashed,
+                         "lsHoVAQ3uzTLq3xBTGEkfRjMG3aCURCkPkAstZYuG3o=")
+
+    def test_login_handshake(self):
+        class LoginResponse(TestClient.MockResponse):
+            def __init__(self, url, cookies, json_data=None):
+                TestClient.MockResponse.__init__(self, 200, json_data)
+                self.url = url
+                self.headers = {}
+                self.cookies = cookies
+
+        class LoginHttp:
+            def __init__(self):
+                self.posts = []
+
+            def get(self, baseurl, **kwargs):
+                return LoginResponse(baseurl + "/login.html",
+                                     {"xsrf-token": "first%3D"})
+
+            def post(self, baseurl, **kwargs):
+                self.posts.append(kwargs["data"])
+                cookies = {"xsrf-token": "second%3D",
+                           "session-auth": "auth%3D"}
+                nonce = {"Salt": "c2FsdA==", "Nonce": "bm9uY2U%3D"}
+                return LoginResponse(baseurl, cookies, nonce)
+
+        http = LoginHttp()
+        duplicati = client.DuplicatiClient(self.data, http=http)
+        with self.assertRaises(client.AuthenticationError):
+            duplicati.login()
+        duplicati.login("password")
+        self.assertEqual(self.data["token"], "second=")
+        self.assertEqual(self.data["nonce"], "bm9uY2U=")
+        self.assertEqual(self.data["session-auth"], "auth=")
+        self.assertEqual(http.posts[-1]["password"],
+                         "lsHoVAQ3uzTLq3xBTGEkfRjMG3aCURCkPkAstZYuG3o=")
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch("streaming.available", return_value=False)
+    @patch("common.verify_token")
+    def test_export_all(self, verify_token, available):
+        responses = {
+            "/api/v1/systeminfo": TestClient.MockResponse(
+                200, {"ServerVersion": "2.0.0"}),
+            "/api/v1/backups": TestClient.MockResponse(200, [
+                {"Backup": {"ID": "1"}}, {"Backup": {"ID": "2"}},
+                {"Backup": {"ID": "3"}}, {"Backup": {"ID": "4"}}])
+        }
+        for backup_id, name in [("1", "db"), ("2", "db"), ("3", "web")]:
+            backup = {"Backup": {"ID": backup_id, "Name": name}}
+            responses["/api/v1/backup/" + backup_id] = \
+                TestClient.MockResponse(200, {"data": backup})
+        http = TestClient.MockHttp(responses)
+        duplicati = client.DuplicatiClient(client_config(), http=http)
+
+        with patch("duplicati_client.get_pooled_client",
+                   return_value=duplicati):
+            with self.assertRaises(SystemExit):
+                duplicati_client.export_backups(
+                    client_config(), [], "json", self.directory, True)
+
+        files = sorted(os.listdir(self.directory))
+        self.assertEqual(files, ["db_1.json", "db_2.json", "web.json"])
+        with open(os.path.join(self.directory, "web.json")) as file_handle:
+            exported = json.load(file_handle)
+        self.assertEqual(exported["CreatedByVersion"], "2.0.0")
+        systeminfo = [call for call in http.calls
+                      if call[1].endswith("/api/v1/systeminfo")]
+        self.assertEqual(len(systeminfo), 1)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+        self.backups = [
+            {"Backup": {"ID": "1", "Name": "db", "Metadata": {"Size": 1}},
+             "Schedule": {"Repeat": "1D", "LastRun": "yesterday"}},
+            {"Backup": {"ID": "2", "Name": "web", "Sources": ["/var"]}}
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def take(self):
+        http = TestClient.MockHttp({
+            "/api/v1/backups": TestClient.MockResponse(200, self.backups)
+        })
+        duplicati = client.DuplicatiClient(client_config(), http=http)
+        with patch("client.DuplicatiClient", return_value=duplicati), \
+                patch("streaming.available", return_value=False), \
+                patch("common.verify_token"):
+            return snapshot.take(client_config(), self.store)
+
+    def test_normalize(self):
+        first = snapshot.serialize(snapshot.normalize(self.backups[0]))
+        self.backups[0]["Backup"]["Metadata"] = {"Size": 2}
+        self.backups[0]["Schedule"]["LastRun"] = "today"
+        self.backups[0]["Progress"] = {"Phase": "Backup_Begin"}
+        second = snapshot.serialize(snapshot.normalize(self.backups[0]))
+        self.assertEqual(first, second)
+        self.assertNotIn("Metadata", json.loads(first[0])["Backup"])
+
+    def test_incremental_runs(self):
+        first = self.take()
+        objects = os.path.join(self.store, "objects")
+        count = sum(len(files) for path, dirs, files in os.walk(objects))
+        self.assertEqual(count, 2)
+
+        # Unchanged configurations are not stored again
+        self.backups[0]["Backup"]["Metadata"] = {"Size": 2}
+        self.take()
+        count = sum(len(files) for path, dirs, files in os.walk(objects))
+        self.assertEqual(count, 2)
+
+        self.backups[1]["Backup"]["Sources"] = ["/var", "/srv"]
+        del self.backups[0]
+        self.backups.append({"Backup": {"ID": "3", "Name": "mail"}})
+        latest = self.take()
+        changes = snapshot.compare(first, latest)
+        self.assertEqual([item["ID"] for item in changes["Added"]], ["3"])
+        self.assertEqual([item["ID"] for item in changes["Removed"]], ["1"])
+        self.assertEqual([item["ID"] for item in changes["Changed"]], ["2"])
+        old = snapshot.read_object(self.store, first["Backups"][1]["Hash"])
+        new = snapshot.read_object(self.store, changes["Changed"][0]["Hash"])
+        self.assertEqual(snapshot.changed_fields(old, new),
+                         ["Backup.Sources"])
+
+        server = common.create_baseurl(client_config())
+        runs = snapshot.list_runs(self.store, server)
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(runs[-1], latest["Run"])
+        self.assertEqual(snapshot.resolve_run(runs, runs[0]), runs[0])
+        self.assertEqual(snapshot.resolve_run(runs, "9999"), runs[-1])
+        self.assertIsNone(snapshot.resolve_run(runs, "1999"))
+
+
+class TestApply(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, definition):
+        with open(os.path.join(self.directory, name), 'w') as file_handle:
+            if name.endswith(".json"):
+                file_handle.write(json.dumps(definition))
+            else:
+                file_handle.write(yaml.dump(definition))
+
+    def test_plan(self):
+        live = [
+            {"Backup": {"ID": "1", "Name": "db", "DBPath": "/a.sqlite",
+                        "Sources": ["/var"], "Metadata": {"Size": 1}},
+             "Schedule": {"Repeat": "1D", "Time": "now"}},
+            {"Backup": {"ID": "2", "Name": "web", "Sources": ["/srv"]}},
+            {"Backup": {"ID": "3", "Name": "old", "Sources": ["/tmp"]}}
+        ]
+        # Server specific and volatile fields are not compared
+        self.write("db.yml", {
+            "Backup": {"ID": "9", "Name": "db", "Sources": ["/var"],
+                       "Metadata": {"Size": 5}},
+            "Schedule": {"Repeat": "1D", "Time": "later"},
+            "CreatedByVersion": "2.0.0"})
+        self.write("web.yml", {"Backup": {"Name": "web",
+                                          "Sources": ["/srv", "/home"]}})
+        self.write("mail.json", {"Backup": {"Name": "mail",
+                                            "TargetURL": "file:///mail",
+                                            "Sources": ["/mail"]}})
+        self.write("notes.txt", {"Backup": {"Name": "ignored"}})
+
+        definitions, errors = apply.load_definitions(self.directory)
+        self.assertEqual(errors, [])
+        changes, errors = apply.plan(definitions, live)
+        self.assertEqual([(change.action, change.name) for change in changes],
+                         [("create", "mail"), ("update", "web")])
+        self.assertEqual(changes[1].fields, ["Backup.Sources"])
+        self.assertEqual(changes[1].config["Backup"]["ID"], "2")
+
+        changes, errors = apply.plan(definitions, live, delete=True)
+        self.assertEqual(changes[-1].action, "delete")
+        self.assertEqual(changes[-1].backup_id, "3")
+
+    def test_parse_in_process_pool(self):
+        for number in range(4):
+            self.write(str(number) + ".yml",
+                       {"Backup": {"Name": "job-" + str(number)}})
+        with patch("apply.PARSE_PROCESS_THRESHOLD", 2):
+            definitions, errors = apply.load_definitions(self.directory)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(definitions), ["job-0", "job-1", "job-2",
+                                               "job-3"])
+
+    @patch("common.verify_token")
+    def test_create_reports_all_errors(self, verify_token):
+        class MockClient:
+            def __init__(self):
+                self.created = []
+
+            def create_backup(self, backup_config, import_meta=None):
+                if backup_config["Backup"]["Name"].startswith("bad"):
+                    raise client.DuplicatiError("Bad config")
+                self.created.append(backup_config["Backup"]["Name"])
+
+        for name in ["bad-1", "bad-2", "good"]:
+            self.write(name + ".yml", {"Backup": {
+                "Name": name, "TargetURL": "file:///" + name,
+                "Sources": ["/"]}})
+        duplicati = MockClient()
+        output = io.StringIO()
+        with patch("client.pooled_client", return_value=duplicati), \
+                patch("index.invalidate"), patch("sys.stdout", output):
+            with self.assertRaises(SystemExit):
+                apply.create(client_config(), self.directory)
+        self.assertEqual(duplicati.created, ["good"])
+        self.assertIn("bad-1.yml: Bad config", output.getvalue())
+        self.assertIn("bad-2.yml: Bad config", output.getvalue())
+        self.assertIn("Created 1 of 3 backups", output.getvalue())
+
+        # Invalid files stop the run before anything is created
+        self.write("incomplete.yml", {"Backup": {"Name": "incomplete"}})
+        duplicati.created = []
+        with patch("client.pooled_client", return_value=duplicati), \
+                patch("sys.stdout", output):
+            with self.assertRaises(SystemExit):
+                apply.create(client_config(), self.directory)
+        self.assertEqual(duplicati.created, [])
+
+    def test_invalid_definitions(self):
+        self.write("a.yml", {"Backup": {"Name": "db"}})
+        self.write("b.yml", {"Backup": {"Name": "db"}})
+        self.write("c.yml", {"Schedule": {}})
+        with open(os.path.join(self.directory, "d.json"), 'w') as handle:
+            handle.write("{")
+        definitions, errors = apply.load_definitions(self.directory)
+        self.assertEqual(list(definitions), ["db"])
+        self.assertEqual(len(errors), 3)
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch("streaming.available", return_value=False)
+    @patch("common.verify_token")
+    def export(self, name, verify_token, available):
+        backups = [
+            {"Backup": {"ID": "1", "Name": "db/main", "TargetURL": "file:///a",
+                        "Sources": ["/var"]}, "Progress": {}},
+            {"Backup": {"ID": "2", "Name": "web", "TargetURL": "file:///b",
+                        "Sources": ["/srv"]}}
+        ]
+        http = TestClient.MockHttp({
+            "/api/v1/systeminfo": TestClient.MockResponse(
+                200, {"ServerVersion": "2.0.0"}),
+            "/api/v1/backups": TestClient.MockResponse(200, backups),
+            "/api/v1/serversettings": TestClient.MockResponse(
+                200, {"startup-delay": "0s", "unacked-error": "True"})
+        })
+        duplicati = client.DuplicatiClient(client_config(), http=http)
+        path = os.path.join(self.directory, name)
+        with patch("client.DuplicatiClient", return_value=duplicati):
+            archive.export(client_config(), path, all_ids=True)
+        return path
+
+    def test_round_trip(self):
+        for name in ["servers.tar.gz", "servers.zip", "servers.tar"]:
+            path = self.export(name)
+            members = dict(archive.read_members(path))
+            self.assertEqual(sorted(members), [
+                "backups/db_main_1.yml", "backups/web_2.yml",
+                "manifest.json", "serversettings.yml"])
+            manifest = json.loads(members["manifest.json"])
+            self.assertEqual(manifest["ServerVersion"], "2.0.0")
+            self.assertEqual([item["Name"] for item in manifest["Backups"]],
+                             ["db/main", "web"])
+            settings = yaml.safe_load(members["serversettings.yml"])
+            self.assertEqual(settings, {"startup-delay": "0s"})
+
+            definitions, errors = archive.load_definitions(path)
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted(definitions), ["db/main", "web"])
+            backup = definitions["web"][1]
+            self.assertEqual(backup["CreatedByVersion"], "2.0.0")
+            self.assertNotIn("Progress", definitions["db/main"][1])
+
+    def test_damaged_archive(self):
+        path = os.path.join(self.directory, "damaged.tar.gz")
+        with open(path, 'w') as file_handle:
+            file_handle.write("not an archive")
+        definitions, errors = archive.load_definitions(path)
+        self.assertEqual(definitions, {})
+        self.assertEqual(len(errors), 1)
+
+
+class TestDrift(unittest.TestCase):
+    class MockServer:
+        def __init__(self, items, update_id=1):
+            self.items = items
+            self.update_id = update_id
+            self.lists = 0
+
+        async def server_state(self):
+            return {"LastDataUpdateID": self.update_id}
+
+        async def list_resource(self, resource):
+            self.lists += 1
+            return self.items
+
+        async def server_settings(self):
+            return {"startup-delay": "0s", "last-update-check": "now"}
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def scan(self, server, cached=None):
+        return asyncio.run(drift.scan(None, server, cached, self.store))
+
+    def backup(self, backup_id, block_size="50mb"):
+        return {"Backup": {"ID": backup_id, "Name": "db",
+                           "DBPath": "/db/" + backup_id + ".sqlite",
+                           "Settings": [{"Name": "dblock-size",
+                                         "Value": block_size}],
+                           "Metadata": {"Size": backup_id}},
+                "Schedule": {"ID": int(backup_id),
+                             "Tags": ["ID=" + backup_id]}}
+
+    def test_scan_skips_unchanged_servers(self):
+        server = self.MockServer([self.backup("1")], update_id=7)
+        first, fetched = self.scan(server)
+        self.assertTrue(fetched)
+        second, fetched = self.scan(server, first)
+        self.assertFalse(fetched)
+        self.assertEqual(server.lists, 1)
+
+        server.update_id = 8
+        third, fetched = self.scan(server, first)
+        self.assertTrue(fetched)
+        self.assertEqual(third["Hashes"], first["Hashes"])
+
+    def test_clusters_and_fields(self):
+        scans = {}
+        servers = {
+            "alpha": [self.backup("1")],
+            "beta": [self.backup("4")],
+            "gamma": [self.backup("2", "100mb")],
+            "delta": []
+        }
+        for name, items in servers.items():
+            scans[name] = self.scan(self.MockServer(items))[0]
+
+        report = drift.compare(scans, self.store)
+        self.assertEqual(len(report), 1)
+        name, groups, missing = report[0]
+        self.assertEqual(name, "db")
+        self.assertEqual(groups[0][1], ["alpha", "beta"])
+        self.assertEqual(groups[1][1], ["gamma"])
+        self.assertEqual(groups[1][2], ["Backup.Settings.dblock-size"])
+        self.assertEqual(missing, ["delta"])
+
+    def test_inventory(self):
+        path = os.path.join(self.store, "inventory.yml")
+        with open(path, 'w') as file_handle:
+            file_handle.write("servers:\n"
+                              "  nas:\n"
+                              "    url: https://nas.example.com\n"
+                              "    password: secret\n"
+                              "  office:\n"
+                              "    url: http://office:8300\n")
+        servers = inventory.load(client_config(), path)
+        self.assertEqual([server.name for server in servers],
+                         ["nas", "office"])
+        self.assertEqual(servers[0].data["server"]["port"], "443")
+        self.assertEqual(servers[0].password, "secret")
+        self.assertEqual(common.create_baseurl(servers[1].data),
+                         "http://office:8300")
+
+        with open(path, 'w') as file_handle:
+            file_handle.write("servers:\n  nas:\n    url: nas\n")
+        with self.assertRaises(SystemExit):
+            inventory.load(client_config(), path)
+
+
+class TestSettings(unittest.TestCase):
+    class MockServer:
+        def __init__(self, current):
+            self.current = current
+            self.patches = []
+
+        async def server_settings(self):
+            return self.current
+
+        async def update_server_settings(self, changes):
+            self.patches.append(changes)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_delta(self):
+        current = {"startup-delay": "0s", "disable-tray-icon-login": "True",
+                   "allowed-hostnames": ""}
+        desired = {"startup-delay": "5s", "disable-tray-icon-login": "true",
+                   "allowed-hostnames": ""}
+        self.assertEqual(settings.delta(current, desired),
+                         {"startup-delay": "5s"})
+        self.assertEqual(settings.setting_value(False), "false")
+
+    def test_apply_one_patch_per_server(self):
+        path = os.path.join(self.directory, "settings.yml")
+        with open(path, 'w') as file_handle:
+            file_handle.write("startup-delay: 5s\nallowed-hostnames: '*'\n")
+        servers = [inventory.Server("a", client_config()),
+                   inventory.Server("b", client_config())]
+        mocks = {
+            "a": self.MockServer({"startup-delay": "0s"}),
+            "b": self.MockServer({"startup-delay": "5s",
+                                  "allowed-hostnames": "*"})
+        }
+
+        def gather(servers, function):
+            async def run_all():
+                results = []
+                for server in servers:
+                    result = await function(server, mocks[server.name])
+                    results.append((result, None))
+                return results
+            return asyncio.run(run_all())
+
+        with patch("inventory.load", return_value=servers), \
+                patch("inventory.gather", gather), \
+                patch("sys.stdout", io.StringIO()):
+            settings.apply_file(client_config(), path)
+        self.assertEqual(mocks["a"].patches, [{"startup-delay": "5s",
+                                               "allowed-hostnames": "*"}])
+        self.assertEqual(mocks["b"].patches, [])
+
+    def test_internal_settings_refused(self):
+        path = os.path.join(self.directory, "settings.yml")
+        with open(path, 'w') as file_handle:
+            file_handle.write("server-passphrase: secret\n")
+        with self.assertRaises(ValueError):
+            settings.load_file(path)
+
+    def test_apply_exported_settings(self):
+        current = {"startup-delay": "5s", "--foo": "1",
+                   "server-passphrase": "secret"}
+        for output in ["yaml", "json"]:
+            with patch("duplicati_client.fetch_resource_list",
+                       return_value=current), \
+                    patch("sys.stdout", io.StringIO()):
+                duplicati_client.export_resource(
+                    client_config(), "serversettings", None, output,
+                    self.directory)
+            extension = ".json" if output == "json" else ".yml"
+            path = os.path.join(self.directory, "serversettings" + extension)
+            self.assertEqual(settings.load_file(path),
+                             {"startup-delay": "5s", "--foo": "1"})
+
+        server = self.MockServer({"startup-delay": "0s", "--foo": "1"})
+
+        def gather(servers, function):
+            async def run_all():
+                return [(await function(servers[0], server), None)]
+            return asyncio.run(run_all())
+
+        with patch("inventory.load",
+                   return_value=[inventory.Server("a", client_config())]), \
+                patch("inventory.gather", gather), \
+                patch("sys.stdout", io.StringIO()):
+            settings.apply_file(client_config(), path)
+        self.assertEqual(server.patches, [{"startup-delay": "5s"}])
+
+
+class TestExporter(unittest.TestCase):
+    class MockServer:
+        def __init__(self):
+            self.polls = 0
+
+        def logged_in(self):
+            return True
+
+        async def list_backups(self):
+            self.polls += 1
+            running = {"Backup": {"ID": "2", "Name": "Photos \"raw\""},
+                       "Progress": {"BackupID": "2",
+                                    "Phase": "Backup_ProcessingFiles",
+                                    "OverallProgress": 0.25}}
+            return [models.Backup(self.backup()), models.Backup(running)]
+
+        async def list_notifications(self):
+            return [models.Notification({"Type": "Error"}),
+                    models.Notification({"Type": "Error"}),
+                    models.Notification({"Type": "Information"})]
+
+        def backup(self):
+            return {"Backup": {"ID": "1", "Name": "Documents", "Metadata": {
+                "LastBackupStarted": "20240501T100000Z",
+                "LastBackupFinished": "20240501T100512Z",
+                "LastBackupDuration": "00:05:12.5000000",
+                "BackupListCount": "7",
+                "SourceFilesSize": "1024",
+                "TargetFilesSize": "2048"}}}
+
+    def render(self):
+        server = inventory.Server("nas", {})
+        duplicati_exporter = exporter.Exporter([server])
+        asyncio.run(duplicati_exporter.poll([self.MockServer()]))
+        return duplicati_exporter
+
+    def test_duration(self):
+        self.assertEqual(exporter.duration_seconds("00:05:12.5"), 312.5)
+        self.assertEqual(exporter.duration_seconds("1.02:00:00"), 93600)
+        self.assertIsNone(exporter.duration_seconds("0"))
+
+    def test_render(self):
+        text = self.render().page.content.decode("utf-8")
+        labels = 'server="nas",backup_id="1",backup="Documents"'
+        self.assertIn('duplicati_up{server="nas"} 1', text)
+        self.assertIn("duplicati_backup_last_started_timestamp_seconds{" +
+                      labels + "} 1714557600", text)
+        self.assertIn("duplicati_backup_last_duration_seconds{" + labels +
+                      "} 312.5", text)
+        self.assertIn("duplicati_backup_versions{" + labels + "} 7", text)
+        self.assertIn("duplicati_backup_running{" + labels + "} 0", text)
+        running = 'server="nas",backup_id="2",backup="Photos \\"raw\\""'
+        self.assertIn("duplicati_backup_phase{" + running +
+                      ',phase="Backup_ProcessingFiles"} 1', text)
+        self.assertIn("duplicati_backup_progress_ratio{" + running +
+                      "} 0.25", text)
+        self.assertIn('duplicati_notifications{server="nas",type="Error"} 2',
+                      text)
+        self.assertEqual(text.count("# TYPE duplicati_backup_versions"), 1)
+
+    def test_failed_server_is_down(self):
+        class FailingServer(self.MockServer):
+            async def list_backups(self):
+                raise client.DuplicatiError("Error connecting", 503)
+
+        # A 200 answer that isn't JSON, e.g. the login page of a proxy
+        class ProxiedServer(self.MockServer):
+            async def list_backups(self):
+                raise ValueError("Expecting value: line 1 column 1")
+
+        for failing in [FailingServer(), ProxiedServer()]:
+            server = inventory.Server("nas", {})
+            duplicati_exporter = exporter.Exporter([server])
+            with patch('common.log_output'):
+                asyncio.run(duplicati_exporter.poll([failing]))
+            text = duplicati_exporter.page.content.decode("utf-8")
+            self.assertIn('duplicati_up{server="nas"} 0', text)
+            self.assertNotIn("duplicati_backup_versions", text)
+            self.assertEqual(duplicati_exporter.polls, 1)
+
+    def test_scrapes_are_served_from_memory(self):
+        duplicati_exporter = self.render()
+        http_server = exporter.MetricsServer(("127.0.0.1", 0),
+                                             exporter.MetricsHandler)
+        http_server.exporter = duplicati_exporter
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:" + str(http_server.server_address[1])
+            for _ in range(3):
+                response = requests.get(url + "/metrics")
+                self.assertEqual(response.status_code, 200)
+                self.assertIn("duplicati_backup_versions", response.text)
+            self.assertEqual(requests.get(url + "/other").status_code, 404)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            thread.join()
+        self.assertEqual(duplicati_exporter.polls, 1)
+
+
+class TestTracing(unittest.TestCase):
+    class MockResponse:
+        status_code = 200
+        content = b'{"data": {}}'
+        headers = {}
+        history = []
+        elapsed = datetime.timedelta(seconds=0.001)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "trace.json")
+
+    def tearDown(self):
+        tracing.tracer = None
+        shutil.rmtree(self.directory)
+
+    def test_disabled_spans_are_free(self):
+        self.assertIs(tracing.span("filter"), tracing.NULL_SPAN)
+        response = tracing.request("get", "http://localhost/api/v1/backups",
+                                   False, lambda: self.MockResponse())
+        self.assertEqual(response.status_code, 200)
+
+    def test_trace_file_and_summary(self):
+        @tracing.traced("filter")
+        def work():
+            return tracing.request(
+                "get", "http://localhost:8200/api/v1/backup/12?token=secret",
+                False, lambda: self.MockResponse())
+
+        tracing.enable(self.path)
+        with tracing.span("duc get"):
+            work()
+        stderr = io.StringIO()
+        argv = ["duc", "--trace", "login", "--password", "hunter2",
+                "--basic-pass=letmein"]
+        with patch("sys.stderr", stderr), patch("sys.argv", argv):
+            tracing.finish()
+        self.assertIsNone(tracing.tracer)
+
+        with open(self.path) as file_handle:
+            document = json.load(file_handle)
+        events = document["traceEvents"]
+        self.assertEqual(document["otherData"]["argv"],
+                         "--trace login --password *** --basic-pass=***")
+        self.assertEqual([event["name"] for event in events],
+                         ["duc get", "filter", "GET /api/v1/backup/{id}"])
+        request = events[2]["args"]
+        self.assertEqual(request["path"], "/api/v1/backup/12")
+        self.assertEqual(request["status"], 200)
+        self.assertEqual(request["bytes"], 12)
+        self.assertEqual(request["retries"], 0)
+        for phase in tracing.HTTP_PHASES:
+            self.assertGreaterEqual(request[phase + "_ms"], 0)
+        self.assertNotIn("secret", json.dumps(events))
+
+        summary = stderr.getvalue()
+        self.assertIn("GET /api/v1/backup/{id}", summary)
+        self.assertIn("HTTP 1 requests", summary)
+        self.assertIn("Trace written to " + self.path, summary)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "profile")
+
+    def tearDown(self):
+        if profiling.profiler is not None:
+            profiling.profiler.stop()
+            profiling.profiler = None
+        shutil.rmtree(self.directory)
+
+    def finish(self):
+        stderr = io.StringIO()
+        with patch("sys.stderr", stderr):
+            paths = profiling.finish()
+        self.assertIsNone(profiling.profiler)
+        return paths, stderr.getvalue()
+
+    def test_sections_are_named_and_counted(self):
+        @profiling.section("double")
+        def double(value):
+            return value * 2
+
+        @profiling.section("numbers")
+        def numbers(count):
+            for number in range(count):
+                yield double(number)
+
+        self.assertEqual(double.__name__, "double")
+        self.assertEqual(double.__code__.co_name, "<section double>")
+        self.assertEqual(list(numbers(3)), [0, 2, 4])
+
+        profiling.enable("cpu", self.path)
+        self.assertEqual(list(numbers(3)), [0, 2, 4])
+        (report_path, stacks_path), summary = self.finish()
+
+        self.assertIn("double", summary)
+        with open(report_path) as file_handle:
+            report = file_handle.read()
+        self.assertRegex(report, r"numbers\s+1\s")
+        self.assertRegex(report, r"double\s+3\s")
+        with open(stacks_path) as file_handle:
+            stacks = file_handle.read()
+        self.assertIn("<section numbers>", stacks)
+        self.assertTrue(os.path.isfile(self.path + ".prof"))
+
+    def test_memory_profile(self):
+        @profiling.section("allocate")
+        def allocate():
+            return [str(number) for number in range(1000)]
+
+        profiling.enable("mem", self.path)
+        kept = allocate()
+        argv = ["duc", "--profile", "mem", "set", "password", "--password",
+                "hunter2"]
+        with patch("sys.argv", argv):
+            (report_path, stacks_path), summary = self.finish()
+        self.assertEqual(len(kept), 1000)
+        self.assertIn("KEPT", summary)
+        with open(report_path) as file_handle:
+            report = file_handle.read()
+        self.assertIn("set password --password ***", report)
+        self.assertNotIn("hunter2", report)
+        self.assertIn("Memory in use", report)
+        self.assertIn("test_duplicati_client.py", report)
+        with open(stacks_path) as file_handle:
+            line = file_handle.readline()
+        self.assertRegex(line, r" \d+\n$")
+
+
+class TestProbe(unittest.TestCase):
+    class MockServer:
+        def __init__(self, status_code=200):
+            self.status_code = status_code
+            self.paths = []
+
+        async def call(self, name, method, path, params=None):
+            self.paths.append(path)
+            if self.status_code is None:
+                raise client.DuplicatiError("Error connecting", 503)
+            return TestClient.MockResponse(self.status_code, {})
+
+    def test_histogram_precision(self):
+        for value in [0, 1, 255, 256, 257, 1000, 123456, 98765432]:
+            index = probe.bucket_index(value)
+            upper = probe.bucket_value(index)
+            self.assertGreaterEqual(upper, value)
+            self.assertLessEqual(upper - value, value / 128.0 + 1)
+            self.assertEqual(probe.bucket_index(upper), index)
+
+        histogram = probe.Histogram()
+        for millisecond in range(1, 101):
+            histogram.record(millisecond / 1000.0)
+        histogram.record_error()
+        self.assertAlmostEqual(histogram.percentile(50), 50000, delta=400)
+        self.assertAlmostEqual(histogram.percentile(99), 99000, delta=800)
+        self.assertEqual(histogram.percentile(100), 100000)
+        self.assertAlmostEqual(histogram.error_rate, 1 / 101.0)
+
+    def test_rolling_window_and_slo(self):
+        server = inventory.Server("nas", {})
+        latency_probe = probe.Probe([server], ["systeminfo"], interval=10,
+                                    window=20, slo_p99=100)
+        key = ("nas", "systeminfo")
+        latency_probe.current[key].record(0.5)
+        first = latency_probe.rotate()[0]
+        self.assertEqual(first["requests"], 1)
+        self.assertFalse(first["slo_ok"])
+
+        latency_probe.current[key].record(0.01)
+        self.assertEqual(latency_probe.rotate()[0]["requests"], 2)
+        latency_probe.current[key].record(0.01)
+        third = latency_probe.rotate()[0]
+        # The slow request left the window
+        self.assertEqual(third["requests"], 2)
+        self.assertTrue(third["slo_ok"])
+        self.assertLess(third["p99_ms"], 11)
+
+    def test_measure_records_latency_and_errors(self):
+        server = inventory.Server("nas", {})
+        latency_probe = probe.Probe([server], ["log", "backups"])
+
+        async def measure():
+            due = asyncio.get_running_loop().time()
+            await latency_probe.measure("nas", self.MockServer(), "log", due)
+            await latency_probe.measure("nas", self.MockServer(500),
+                                        "backups", due)
+            await latency_probe.measure("nas", self.MockServer(None),
+                                        "backups", due)
+
+        asyncio.run(measure())
+        records = dict((record["endpoint"], record)
+                       for record in latency_probe.rotate())
+        self.assertEqual(records["log"]["errors"], 0)
+        self.assertIsNotNone(records["log"]["p50_ms"])
+        self.assertEqual(records["backups"]["errors"], 2)
+        self.assertEqual(records["backups"]["error_rate"], 1.0)
+        self.assertIsNone(records["backups"]["p50_ms"])
+
+
+class TestTop(unittest.TestCase):
+    class MockServer:
+        def __init__(self, state, progress):
+            self.state = state
+            self.progress = progress
+            self.listed = 0
+
+        def logged_in(self):
+            return True
+
+        async def server_state(self):
+            return self.state
+
+        async def progress_state(self):
+            return self.progress
+
+        async def list_resource(self, resource):
+            self.listed += 1
+            return [{"Backup": {"ID": "1", "Name": "db"}},
+                    {"Backup": {"ID": "2", "Name": "web"}}]
+
+    @staticmethod
+    def progress(processed, phase="Backup_ProcessingFiles"):
+        return models.ProgressState({
+            "TaskID": 4, "BackupID": "1", "Phase": phase,
+            "OverallProgress": processed / 1000.0,
+            "ProcessedFileCount": 1, "TotalFileCount": 4,
+            "ProcessedFileSize": processed, "TotalFileSize": 1000,
+            "BackendSpeed": 2048
+        })
+
+    def test_eta_from_rate_between_polls(self):
+        first = top.sample(self.progress(100), None, 0.0)
+        self.assertIsNone(top.eta(self.progress(100), first))
+        second = top.sample(self.progress(200), first, 10.0)
+        self.assertEqual(second.size_rate, 10)
+        self.assertEqual(top.eta(self.progress(200), second), 80)
+        # Another task starts over
+        other = top.sample(models.ProgressState({"TaskID": 5}), second, 20.0)
+        self.assertIsNone(other.size_rate)
+        self.assertEqual(top.format_eta(80), "1m20s")
+        self.assertEqual(top.format_eta(3 * 3600 + 300), "3h05m")
+
+    def test_poller_rows(self):
+        state = {"ActiveTask": {"Item1": 4, "Item2": "1"},
+                 "SchedulerQueueIds": [{"Item1": 5, "Item2": "2"}],
+                 "LastDataUpdateID": 3}
+        server = self.MockServer(state, self.progress(100))
+        poller = top.Poller([inventory.Server("nas", {})],
+                            clock=iter([0.0, 10.0]).__next__)
+
+        asyncio.run(poller.poll([server]))
+        server.progress = self.progress(200)
+        asyncio.run(poller.poll([server]))
+        # The names are fetched again only when the data changed
+        self.assertEqual(server.listed, 1)
+        rows = poller.rows()
+        self.assertEqual(rows[0], ["nas", "db", "ProcessingFiles", "25.0%",
+                                   "20.0%", "2.0 KB/s", "1m20s"])
+        self.assertEqual(rows[1][1:3], ["web", "Queued"])
+
+    def test_screen_redraws_changed_cells(self):
+        stream = io.StringIO()
+        screen = top.Screen(stream)
+        now = datetime.datetime(2024, 1, 1, 12, 0, 0)
+        rows = [["nas", "db", "ProcessingFiles", "25.0%", "20.0%", "", ""]]
+        frame = top.layout(rows, 80, "status", now)
+        first = screen.draw(frame, (80, 24))
+        self.assertEqual(screen.draw(frame, (80, 24)), 0)
+
+        stream.seek(0)
+        stream.truncate()
+        rows[0][4] = "21.0%"
+        frame = top.layout(rows, 80, "status", now)
+        self.assertEqual(screen.draw(frame, (80, 24)), 1)
+        self.assertIn("21.0%", stream.getvalue())
+        self.assertNotIn("ProcessingFiles", stream.getvalue())
+
+        # Rows that changed their cells are cleared, a resize redraws
+        # everything
+        screen.draw(top.layout([], 80, "status", now), (80, 24))
+        self.assertIn(top.CLEAR_LINE, stream.getvalue())
+        frame = top.layout(rows, 80, "status", now)
+        self.assertEqual(screen.draw(frame, (100, 24)), first)
+
+
+class TestEvents(unittest.TestCase):
+    class MockServer:
+        def __init__(self):
+            self.state = {"LastDataUpdateID": 1,
+                          "LastNotificationUpdateID": 1}
+            self.progress = None
+            self.backups = [TestEvents.backup("1", "db")]
+            self.notifications = []
+            self.fetched = []
+
+        def logged_in(self):
+            return True
+
+        async def server_state(self):
+            return self.state
+
+        async def progress_state(self):
+            return self.progress
+
+        async def list_resource(self, resource):
+            self.fetched.append(resource)
+            return self.backups
+
+        async def list_notifications(self):
+            self.fetched.append("notifications")
+            return [models.Notification(item)
+                    for item in self.notifications]
+
+    @staticmethod
+    def backup(backup_id, name, **metadata):
+        return {"Backup": {"ID": backup_id, "Name": name,
+                           "Metadata": metadata}}
+
+    def test_watcher_events(self):
+        server = self.MockServer()
+        watcher = events.Watcher("nas")
+
+        def poll():
+            return [event["event"]
+                    for event in asyncio.run(watcher.poll(server))]
+
+        # The first poll only sets the baseline
+        server.progress = models.ProgressState(
+            {"TaskID": 3, "BackupID": "1", "Phase": "Backup_Begin"})
+        self.assertEqual(poll(), [])
+        server.progress = models.ProgressState(
+            {"TaskID": 3, "BackupID": "1", "Phase": "Backup_Finalize"})
+        self.assertEqual(poll(), ["phase-changed"])
+        self.assertEqual(server.fetched, ["backups", "notifications"])
+
+        server.progress = models.ProgressState(
+            {"TaskID": 4, "BackupID": "1", "Phase": "Backup_Begin"})
+        server.backups = [self.backup(
+            "1", "db", LastBackupFinished="20240501T100000Z")]
+        server.notifications = [{"ID": 7, "Type": "Warning",
+                                 "BackupID": "1"}]
+        server.state = {"LastDataUpdateID": 2,
+                        "LastNotificationUpdateID": 2}
+        self.assertEqual(poll(), ["completed", "started",
+                                  "notification-raised"])
+
+        server.progress = None
+        server.backups = [self.backup(
+            "1", "db", LastBackupFinished="20240501T100000Z",
+            LastErrorDate="20240501T110000Z", LastErrorMessage="Disk full")]
+        results = asyncio.run(watcher.poll(server))
+        self.assertEqual([event["event"] for event in results], ["failed"])
+        self.assertEqual(results[0]["backup"], "db")
+        self.assertEqual(results[0]["message"], "Disk full")
+        # Unchanged update counters skip the lists
+        self.assertEqual(server.fetched.count("notifications"), 2)
+
+    def test_webhook_batches_and_retries(self):
+        failed = TestClient.MockResponse(503, {})
+        refused = TestClient.MockResponse(400, {})
+        accepted = TestClient.MockResponse(200, {})
+
+        async def deliver(webhook):
+            webhook.waiting = asyncio.Event()
+            delivery = asyncio.ensure_future(webhook.deliver_loop())
+            for number in range(3):
+                webhook.add({"id": str(number)})
+            await asyncio.sleep(0)
+            while not webhook.idle():
+                await asyncio.sleep(0.01)
+            delivery.cancel()
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        webhook = events.Webhook("http://localhost/hook", None, executor)
+        with patch.object(events, "FLUSH_INTERVAL", 0), \
+                patch.object(events, "RETRY_DELAY", 0), \
+                patch('events.report'), \
+                patch('requests_wrapper.request',
+                      side_effect=[failed, accepted, refused]) as request:
+            asyncio.run(deliver(webhook))
+            self.assertEqual(request.call_count, 2)
+            payload = json.loads(request.call_args[1]["data"])
+            self.assertEqual(len(payload["Events"]), 3)
+            self.assertEqual(webhook.delivered, 3)
+            self.assertEqual(webhook.retries, 1)
+
+            # Refused batches are not retried
+            asyncio.run(deliver(webhook))
+            self.assertEqual(request.call_count, 3)
+            self.assertEqual(webhook.undelivered(), 3)
+        executor.shutdown()
+
+
+class TestAsyncClient(unittest.TestCase):
+    def test_get_backups(self):
+        responses = {}
+        for backup_id in ["1", "2", "3"]:
+            backup = {"Backup": {"ID": backup_id, "Name": "db" + backup_id}}
+            response = TestClient.MockResponse(200, {"data": backup})
+            responses["/api/v1/backup/" + backup_id] = response
+        http = TestClient.MockHttp(responses)
+
+        data = client_config()
+        server = async_client.AsyncDuplicatiClient(data, host_limit=2)
+        server.client.http = http
+
+        backups = asyncio.run(server.get_backups(["1", "2", "3"]))
+        self.assertEqual([backup.name for backup in backups],
+                         ["db1", "db2", "db3"])
+        self.assertEqual(server.semaphore._value, 2)
+
+    def test_cancelled_call_keeps_slot(self):
+        server = async_client.AsyncDuplicatiClient(client_config(),
+                                                   host_limit=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def progress_state():
+            started.set()
+            release.wait(5)
+
+        server.client.progress_state = progress_state
+
+        async def check():
+            task = asyncio.ensure_future(server.progress_state())
+            while not started.is_set():
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The request is still running in its thread
+            self.assertTrue(server.semaphore.locked())
+            release.set()
+            while server.semaphore.locked():
+                await asyncio.sleep(0.01)
+
+        asyncio.run(asyncio.wait_for(check(), 5))
+        server.close()
+
+    def test_servers_share_threads(self):
+        servers = [async_client.AsyncDuplicatiClient(client_config())
+                   for _ in range(3)]
+        executor = async_client.shared_executor()
+        self.assertTrue(all(server.executor is executor
+                            for server in servers))
+        servers[0].close()
+        # Closing a client leaves the shared threads to the others
+        servers[1].client.system_info = lambda: {"ServerVersion": "2"}
+        result = asyncio.run(servers[1].call("system_info"))
+        self.assertEqual(result, {"ServerVersion": "2"})
+        for server in servers[1:]:
+            server.close()
+
+    def test_login_once(self):
+        data = client_config()
+        data["token_expires"] = datetime.datetime(2000, 1, 1)
+        server = async_client.AsyncDuplicatiClient(data, password="secret")
+        logins = []
+
+        def login(password=None):
+            logins.append(password)
+            data["token_expires"] = datetime.datetime.now() + \
+                datetime.timedelta(0, 600)
+
+        server.client.login = login
+        server.client.progress_state = lambda: None
+
+        async def check():
+            calls = [server.progress_state() for _ in range(5)]
+            return await asyncio.gather(*calls)
+
+        self.assertEqual(asyncio.run(check()), [None] * 5)
+        self.assertEqual(len(logins), 1)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "journal.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_lines(self):
+        with open(self.path, 'r') as file_handle:
+            return file_handle.read().splitlines()
+
+    def test_replay(self):
+        with open(self.path, 'w') as file_handle:
+            file_handle.write(json.dumps({"ID": 1, "State": "received",
+                                          "Task": {"ID": 1}}) + "\n")
+            file_handle.write(json.dumps({"ID": 2, "State": "received"}) +
+                              "\n")
+            file_handle.write(json.dumps({"ID": 1, "State": "result",
+                                          "Status": "completed"}) + "\n")
+            file_handle.write(json.dumps({"ID": 2, "State": "delivered"}) +
+                              "\n")
+            # Torn write of the last record before a crash
+            file_handle.write('{"ID": 3, "Sta')
+
+        expected = [{"ID": 1, "State": "result", "Task": {"ID": 1},
+                     "Status": "completed"}]
+        self.assertEqual(journal.replay(self.path), expected)
+
+        # Opening the journal compacts it to the unfinished tasks
+        task_journal = journal.Journal(self.path)
+        self.assertEqual(task_journal.open(), expected)
+        task_journal.close()
+        self.assertEqual([json.loads(line) for line in self.read_lines()],
+                         expected)
+
+    def test_group_commit(self):
+        task_journal = journal.Journal(self.path, commit_delay=0.1)
+        task_journal.open()
+        futures = [task_journal.record(task_id, journal.RECEIVED)
+                   for task_id in range(100)]
+        for future in futures:
+            self.assertTrue(future.result(timeout=5))
+        task_journal.close()
+        # Records queued during the commit delay share a single fsync
+        self.assertEqual(task_journal.commits, 1)
+        self.assertEqual(len(self.read_lines()), 100)
+
+    def test_compaction(self):
+        task_journal = journal.Journal(self.path, commit_delay=0,
+                                       compact_threshold=10)
+        task_journal.open()
+        for task_id in range(6):
+            task_journal.record(task_id, journal.RECEIVED).result(timeout=5)
+        for task_id in range(5):
+            task_journal.record(task_id, journal.DELIVERED).result(timeout=5)
+        task_journal.close()
+        # Compacted after 10 records, followed by the last delivery
+        self.assertEqual([json.loads(line) for line in self.read_lines()],
+                         [{"ID": 4, "State": "received"},
+                          {"ID": 5, "State": "received"},
+                          {"ID": 4, "State": "delivered"}])
+        self.assertEqual(journal.replay(self.path),
+                         [{"ID": 5, "State": "received"}])
+
+
+class TestDaemon(unittest.TestCase):
+    def test_create_api_url(self):
+        self.assertEqual(daemon.create_api_url("tasks:8300"),
+                         "http://tasks:8300/api/")
+        self.assertEqual(daemon.create_api_url("https://tasks/x/api/"),
+                         "https://tasks/x/api/")
+
+    def test_validate_task(self):
+        valid = {"ID": 1, "Operation": "get",
+                 "Resources": [{"Type": "backup", "ID": 3}]}
+        self.assertIsNone(daemon.validate_task(valid))
+        listing = {"ID": 2, "Operation": "list",
+                   "Resources": [{"Type": "backups"}]}
+        self.assertIsNone(daemon.validate_task(listing))
+        self.assertIsNotNone(daemon.validate_task({"ID": 3}))
+        invalid = dict(valid, Operation="format")
+        self.assertIsNotNone(daemon.validate_task(invalid))
+        invalid = dict(valid, Resources=[{"Type": "backup", "ID": "x"}])
+        self.assertIsNotNone(daemon.validate_task(invalid))
+
+    def test_handle_retries_results(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "journal.jsonl")
+        worker = daemon.Daemon(client_config(), "localhost:8300",
+                               journal_path=path)
+        worker.journal.open()
+        posts = []
+
+        async def request(method, path, **kwargs):
+            result = json.loads(kwargs["data"])
+            posts.append(result["Status"])
+            # Fail the first attempt of every post
+            status_code = 200 if posts.count(result["Status"]) > 1 else 500
+            return TestClient.MockResponse(status_code)
+
+        async def run(backup_id):
+            return None
+
+        worker.request = request
+        worker.server.run = run
+
+        async def handle():
+            worker.setup()
+            await worker.handle({"ID": 1, "Operation": "run",
+                                 "Resources": [{"Type": "backup", "ID": 1}]})
+
+        with patch("daemon.RETRY_DELAY", 0):
+            asyncio.run(handle())
+        self.assertEqual(posts, ["accepted", "accepted",
+                                 "completed", "completed"])
+        self.assertEqual(worker.stats["completed"], 1)
+        worker.journal.close()
+        self.assertEqual(journal.replay(path), [])
+        shutil.rmtree(directory)
+
+    def test_batched_results(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "journal.jsonl")
+        worker = daemon.Daemon(client_config(), "localhost:8300",
+                               journal_path=path)
+        worker.journal.open()
+        requests_made = []
+
+        async def request(method, path, **kwargs):
+            requests_made.append((path, json.loads(kwargs["data"])))
+            return TestClient.MockResponse(200)
+
+        async def run(backup_id):
+            await asyncio.sleep(0.01)
+
+        worker.request = request
+        worker.server.run = run
+        worker.batching = daemon.supports_batches({"Tasks": [],
+                                                   "Batch": True})
+
+        async def handle():
+            worker.setup()
+            flusher = asyncio.ensure_future(worker.flush_loop())
+            tasks = [{"ID": task_id, "Operation": "run",
+                      "Resources": [{"Type": "backup", "ID": 1}]}
+                     for task_id in range(10)]
+            tasks.append({"ID": 10, "Operation": "format"})
+            await asyncio.gather(*[worker.handle(task) for task in tasks])
+            flusher.cancel()
+
+        asyncio.run(handle())
+        worker.journal.close()
+        shutil.rmtree(directory)
+
+        self.assertTrue(all(path == "tasks/results"
+                            for path, content in requests_made))
+        self.assertLess(len(requests_made), 11)
+        # Every task ends with exactly one final result, sent at least once
+        final = {}
+        for path, content in requests_made:
+            for result in content["Results"]:
+                if result["Status"] != "accepted":
+                    final.setdefault(result["ID"], result["Status"])
+        self.assertEqual(len(final), 11)
+        self.assertEqual(final[10], "refused")
+        self.assertEqual(worker.stats["completed"], 10)
+
+    def test_batches_fall_back(self):
+        worker = daemon.Daemon(client_config(), "localhost:8300",
+                               journal_path=os.devnull)
+        paths = []
+
+        async def request(method, path, **kwargs):
+            paths.append(path)
+            return TestClient.MockResponse(404 if path == "tasks/results"
+                                           else 200)
+
+        worker.request = request
+        worker.batching = True
+
+        async def post():
+            worker.setup()
+            flusher = asyncio.ensure_future(worker.flush_loop())
+            await asyncio.gather(worker.post_result(1, "completed"),
+                                 worker.post_result(2, "error"))
+            await worker.post_result(3, "completed")
+            flusher.cancel()
+
+        asyncio.run(post())
+        self.assertFalse(worker.batching)
+        self.assertEqual(paths, ["tasks/results", "tasks/1/result",
+                                 "tasks/2/result", "tasks/3/result"])
+
+
+class TestPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = policy.Policy({
+            "operations": {
+                "get": {},
+                "run": {"types": ["backup"], "ids": ["1-10", 20, "15-12"],
+                        "windows": ["Mon-Fri 08:00-18:00",
+                                    "Sun 22:00-02:00"]},
+                "abort": {"rate": "2/hour"},
+                "delete": False
+            }
+        })
+
+    def task(self, operation, resource_id=1, resource_type="backup"):
+        return {"ID": 1, "Operation": operation,
+                "Resources": [{"Type": resource_type, "ID": resource_id}]}
+
+    def test_operations_and_ids(self):
+        monday = datetime.datetime(2018, 6, 11, 9, 0)
+        self.assertIsNone(self.policy.check(self.task("get", 999)))
+        self.assertIsNotNone(self.policy.check(self.task("delete")))
+        self.assertIsNotNone(self.policy.check(self.task("repair")))
+        for resource_id in [1, 10, 12, 15, 20]:
+            self.assertIsNone(self.policy.check(self.task("run", resource_id),
+                                                monday))
+        for resource_id in [0, 11, 16, 21]:
+            self.assertIsNotNone(
+                self.policy.check(self.task("run", resource_id), monday))
+        self.assertIsNotNone(
+            self.policy.check(self.task("run", 1, "database"), monday))
+
+    def test_windows(self):
+        run = self.task("run")
+        self.assertIsNotNone(self.policy.check(
+            run, datetime.datetime(2018, 6, 11, 18, 0)))
+        self.assertIsNotNone(self.policy.check(
+            run, datetime.datetime(2018, 6, 16, 9, 0)))
+        # Past midnight of the window starting on Sunday
+        self.assertIsNone(self.policy.check(
+            run, datetime.datetime(2018, 6, 18, 1, 0)))
+        self.assertIsNotNone(self.policy.check(
+            run, datetime.datetime(2018, 6, 18, 2, 0)))
+
+    def test_rate(self):
+        abort = self.task("abort", 4, "task")
+        reasons = [self.policy.check(abort) for _ in range(3)]
+        self.assertEqual(reasons[:2], [None, None])
+        self.assertIsNotNone(reasons[2])
+
+    def test_invalid_policy(self):
+        for document in [None, {"operations": {"run": {"ids": ["x"]}}},
+                         {"operations": {"run": {"rate": "often"}}},
+                         {"operations": {"run": {"windows": ["9-5"]}}},
+                         {"operations": {"run": {"types": "backup"}}},
+                         {"operations": {"run": {"ids": 5}}},
+                         {"operations": {"run": {
+                             "windows": "Mon-Fri 08:00-18:00"}}}]:
+            with self.assertRaises(policy.PolicyError):
+                policy.Policy(document)
+
+    def test_default_policy_refuses_delete(self):
+        worker = daemon.Daemon(client_config(), "localhost:8300",
+                               journal_path=os.devnull)
+        self.assertIsNotNone(worker.policy.check(self.task("delete")))
+        self.assertIsNone(worker.policy.check(self.task("get")))
@@ -0,0 +1,407 @@
+# Module for the live progress view of duc top
+# One poller asks every server for its state and the progress of the running
+# task at the same time, every interval, and feeds one row per running or
+# queued backup. Phase, processed file and size percentages and backend speed
+# come from the progress state; the ETA is the remaining size, or remaining
+# overall progress, divided by the smoothed rate seen between polls.
+# The view takes over the terminal like top. Every frame is laid out in fixed
+# columns and compared with the last one, and only the cells that changed
+# are written, each after a cursor movement, in a single write per frame. If
+# stdout is not a terminal, or with --once, a plain table is printed instead.
+import asyncio
+import async_client
+import client
+import common
+import compatibility
+import datetime
+import helper
+import inventory
+import models
+import shutil
+import signal
+import sys
+
+# Seconds between polls
+INTERVAL = 2
+
+# Weight of the newest rate in the smoothed rate used for the ETA
+RATE_SMOOTHING = 0.3
+
+# Columns of the table with their width, the backup name gets the width
+# the others leave
+COLUMNS = [
+    ("SERVER", 10),
+    ("BACKUP", None),
+    ("PHASE", 17),
+    ("FILES", 6),
+    ("SIZE", 6),
+    ("SPEED", 11),
+    ("ETA", 8)
+]
+
+# Narrowest the backup name column gets
+MIN_NAME_WIDTH = 10
+
+# Spaces between columns
+GAP = 2
+
+# Terminal control sequences
+ALTERNATE_SCREEN = "\x1b[?1049h"
+MAIN_SCREEN = "\x1b[?1049l"
+HIDE_CURSOR = "\x1b[?25l"
+SHOW_CURSOR = "\x1b[?25h"
+CLEAR_SCREEN = "\x1b[2J"
+CLEAR_LINE = "\x1b[2K"
+
+
+# Sequence moving the cursor to a row and column, counting from 0
+def move(row, column):
+    return "\x1b[" + str(row + 1) + ";" + str(column + 1) + "H"
+
+
+# Text cut or padded to a width
+def fit(text, width):
+    text = str(text)
+    if width <= 0:
+        return ""
+    if len(text) > width:
+        return text[:max(width - 1, 0)] + "~"
+    return text.ljust(width)
+
+
+# Readable duration of a number of seconds
+def format_eta(seconds):
+    if seconds is None:
+        return ""
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours > 99:
+        return ">99h"
+    if hours > 0:
+        return str(hours) + "h" + str(minutes).zfill(2) + "m"
+    return str(minutes) + "m" + str(seconds).zfill(2) + "s"
+
+
+# Percentage with one decimal, empty if unknown
+def format_percentage(percentage):
+    if percentage is None:
+        return ""
+    return "{0:.1f}%".format(percentage)
+
+
+# Phase of a task without the operation prefix, e.g. ProcessingFiles
+def format_phase(phase):
+    if not phase:
+        return "Starting"
+    return phase.split("_", 1)[-1]
+
+
+# Progress of the task a server is running, as sampled by the poller
+class Sample(object):
+    __slots__ = ("task_id", "time", "processed", "overall", "size_rate",
+                 "overall_rate")
+
+    def __init__(self, task_id, time, processed, overall):
+        self.task_id = task_id
+        self.time = time
+        self.processed = processed
+        self.overall = overall
+        self.size_rate = None
+        self.overall_rate = None
+
+
+# Smooth a new rate into the last one
+def smooth(previous, rate):
+    if rate is None or rate <= 0:
+        return previous
+    if previous is None:
+        return rate
+    return previous + RATE_SMOOTHING * (rate - previous)
+
+
+# Sample a progress state, carrying the rates over from the last sample of
+# the same task
+def sample(progress, previous, now):
+    current = Sample(progress.task_id, now, progress.processed_file_size,
+                     float(progress.overall_progress))
+    if previous is None or previous.task_id != current.task_id:
+        return current
+    elapsed = now - previous.time
+    current.size_rate = previous.size_rate
+    current.overall_rate = previous.overall_rate
+    if elapsed > 0:
+        current.size_rate = smooth(
+            previous.size_rate,
+            (current.processed - previous.processed) / elapsed)
+        current.overall_rate = smooth(
+            previous.overall_rate,
+            (current.overall - previous.overall) / elapsed)
+    return current
+
+
+# Seconds until a task finishes, None while it can't be told
+def eta(progress, current):
+    if current is None or progress.still_counting:
+        return None
+    remaining = progress.total_file_size - progress.processed_file_size
+    if progress.processing_files and remaining > 0 and current.size_rate:
+        return remaining / current.size_rate
+    if current.overall_rate and current.overall < 1:
+        return (1 - current.overall) / current.overall_rate
+    return None
+
+
+# What the poller knows about a server
+class ServerView(object):
+    __slots__ = ("name", "update_id", "names", "state", "progress", "sample",
+                 "error")
+
+    def __init__(self, name):
+        self.name = name
+        self.update_id = None
+        self.names = {}
+        self.state = {}
+        self.progress = None
+        self.sample = None
+        self.error = None
+
+    # Rows of the running and queued backups, cells as text
+    def rows(self):
+        if self.error is not None:
+            return [[self.name, "", "Error: " + self.error, "", "", "", ""]]
+        rows = []
+        active = self.state.get("ActiveTask", None) or {}
+        running_id = active.get("Item2", None)
+        if running_id is not None:
+            rows.append(self.running_row(str(running_id)))
+        for item in self.state.get("SchedulerQueueIds", None) or []:
+            backup_id = str(item.get("Item2", ""))
+            rows.append([self.name, self.backup_name(backup_id), "Queued",
+                         "", "", "", ""])
+        if self.state.get("ProgramState", "Running") == "Paused":
+            for row in rows:
+                row[2] = "Paused, " + row[2]
+        return rows
+
+    def backup_name(self, backup_id):
+        return self.names.get(backup_id, "ID " + backup_id)
+
+    def running_row(self, backup_id):
+        row = [self.name, self.backup_name(backup_id), "Starting", "", "",
+               "", ""]
+        progress = self.progress
+        if progress is None or str(progress.backup_id) != backup_id:
+            return row
+        row[2] = format_phase(progress.phase)
+        row[3] = format_percentage(progress.file_percentage)
+        row[4] = format_percentage(progress.size_percentage)
+        if progress.backend_speed > 0:
+            row[5] = helper.format_bytes(progress.backend_speed) + "/s"
+        if progress.still_counting:
+            row[6] = "counting"
+        else:
+            row[6] = format_eta(eta(progress, self.sample))
+        return row
+
+
+# Polls all servers and keeps their views
+class Poller(object):
+    def __init__(self, servers, clock=None):
+        self.servers = servers
+        self.views = [ServerView(server.name) for server in servers]
+        self.clock = clock
+
+    # Poll one server, fetching the backup names only when they changed
+    async def poll_server(self, view, duplicati):
+        try:
+            if not duplicati.logged_in():
+                await duplicati.login()
+            state, progress = await asyncio.gather(
+                duplicati.server_state(), duplicati.progress_state())
+            update_id = state.get("LastDataUpdateID", None)
+            if update_id is None or update_id != view.update_id:
+                try:
+                    items = await duplicati.list_resource("backups")
+                except client.NotFoundError:
+                    items = []
+                view.names = {}
+                for item in items:
+                    backup = models.Backup(item)
+                    view.names[str(backup.id)] = backup.name
+                view.update_id = update_id
+        except client.DuplicatiError as error:
+            view.error = error.message
+            return
+        view.error = None
+        view.state = state
+        view.progress = progress
+        if progress is None:
+            view.sample = None
+        else:
+            now = asyncio.get_running_loop().time() if self.clock is None \
+                else self.clock()
+            view.sample = sample(progress, view.sample, now)
+
+    # Poll all servers at the same time
+    async def poll(self, clients):
+        await asyncio.gather(*[self.poll_server(view, duplicati)
+                               for view, duplicati in zip(self.views,
+                                                          clients)])
+
+    def rows(self):
+        return [row for view in self.views for row in view.rows()]
+
+
+# Width of every column on a terminal of a width
+def column_widths(width):
+    fixed = sum(column_width or 0 for name, column_width in COLUMNS)
+    rest = width - fixed - GAP * (len(COLUMNS) - 1)
+    return [column_width or max(rest, MIN_NAME_WIDTH)
+            for name, column_width in COLUMNS]
+
+
+# Lines of a frame, each a list of cells with their width
+def layout(rows, width, status, now=None):
+    queued = len([row for row in rows if row[2].endswith("Queued")])
+    failed = len([row for row in rows if row[2].startswith("Error")])
+    running = len(rows) - queued - failed
+    title = "duc top - " + str(running) + " running, " + str(queued)
+    now = now or datetime.datetime.now()
+    title += " queued - " + now.strftime("%H:%M:%S")
+    lines = [[(title, width)], [("", width)]]
+    widths = column_widths(width)
+    header = [name for name, column_width in COLUMNS]
+    for row in [header] + rows:
+        lines.append(list(zip(row, widths)))
+    if len(rows) == 0:
+        lines.append([("No backups running or queued", width)])
+    lines.append([("", width)])
+    lines.append([(status, width)])
+    return lines
+
+
+# Full screen view redrawing only the cells that changed
+class Screen(object):
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        # Text of every cell on the screen by row and column, and the widths
+        # of the cells of every row
+        self.cells = {}
+        self.shapes = []
+        self.size = None
+
+    def start(self):
+        compatibility.enable_terminal_sequences()
+        self.stream.write(ALTERNATE_SCREEN + HIDE_CURSOR)
+        self.stream.flush()
+
+    def stop(self):
+        self.stream.write(SHOW_CURSOR + MAIN_SCREEN)
+        self.stream.flush()
+
+    # Draw a frame, returning the number of cells written
+    def draw(self, lines, size=None):
+        size = size or shutil.get_terminal_size()
+        output = []
+        if size != self.size:
+            # Everything moves when the terminal is resized
+            output.append(CLEAR_SCREEN)
+            self.cells = {}
+            self.shapes = []
+            self.size = size
+        width, height = size
+        lines = lines[:height]
+        shapes = [[cell_width for text, cell_width in cells]
+                  for cells in lines]
+        # Rows that changed their cells, or are left over from a longer
+        # frame, are cleared before they are drawn again
+        for row, shape in enumerate(self.shapes):
+            if row >= len(shapes) or shapes[row] != shape:
+                output.append(move(row, 0) + CLEAR_LINE)
+                for index in range(len(shape)):
+                    self.cells.pop((row, index), None)
+        self.shapes = shapes
+        written = 0
+        for row, cells in enumerate(lines):
+            column = 0
+            for index, (text, cell_width) in enumerate(cells):
+                cell_width = max(min(cell_width, width - column), 0)
+                text = fit(text, cell_width)
+                if self.cells.get((row, index), None) != text:
+                    output.append(move(row, column) + text)
+                    self.cells[(row, index)] = text
+                    written += 1
+                column += cell_width + GAP
+        if len(output) > 0:
+            self.stream.write("".join(output))
+            self.stream.flush()
+        return written
+
+
+# Print the rows as a plain table
+def display_table(rows):
+    header = [name for name, width in COLUMNS]
+    table = [header] + rows
+    widths = [max(len(row[column]) for row in table)
+              for column in range(len(COLUMNS))]
+    for row in table:
+        cells = [cell.ljust(width) for cell, width in zip(row, widths)]
+        common.log_output("  ".join(cells).rstrip(), True)
+    if len(rows) == 0:
+        common.log_output("No backups running or queued", True)
+
+
+# Poll until interrupted, drawing every poll
+async def watch(poller, clients, screen, interval):
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        try:
+            loop.add_signal_handler(signal_number, stopping.set)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not supported on Windows, KeyboardInterrupt is used instead
+            pass
+    status = "Polling every " + str(interval) + "s, press control+C to quit"
+    while not stopping.is_set():
+        await poller.poll(clients)
+        size = shutil.get_terminal_size()
+        screen.draw(layout(poller.rows(), size[0], status), size)
+        try:
+            await asyncio.wait_for(stopping.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Show the running and queued backups of the servers in the inventory
+def run(data, inventory_path=None, interval=INTERVAL, once=False):
+    servers = inventory.use_stored_password(
+        data, inventory.load(data, inventory_path))
+    poller = Poller(servers)
+    once = once or not sys.stdout.isatty()
+
+    async def main():
+        clients = [async_client.AsyncDuplicatiClient(
+            server.data, server.password, inventory.HOST_LIMIT)
+            for server in servers]
+        try:
+            if once:
+                await poller.poll(clients)
+                return
+            screen = Screen()
+            screen.start()
+            try:
+                await watch(poller, clients, screen, max(interval, 0.1))
+            finally:
+                screen.stop()
+        finally:
+            for duplicati in clients:
+                duplicati.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        return data
+    if once:
+        display_table(poller.rows())
+    return data
@@ -0,0 +1,331 @@
+# Module for tracing where the time of a command goes
+# With --trace every phase of a command, such as logging in, verifying the
+# token, decoding JSON, filtering and dumping YAML, and every HTTP request is
+# recorded as a span. The spans are written in the Chrome trace event format,
+# which chrome://tracing, Perfetto and speedscope open, and summarized in a
+# table on stderr when the command ends.
+# HTTP spans carry the method, path, status, bytes, redirects and retries,
+# and split their time into the time requests takes to prepare the request,
+# DNS, connect, TLS, server and transfer time. The phases are timed by
+# wrapping socket.getaddrinfo, requests.Session.send and the urllib3
+# connection classes, which only happens once tracing is enabled. While
+# tracing is off a span costs a single check of a module variable.
+# usage:
+# with tracing.span("filter"):
+#     backup_list = backup_filter(backup_list)
+import functools
+import json
+import os
+import profiling
+import re
+import requests
+import socket
+import sys
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# The tracer of this process, None while tracing is off
+tracer = None
+
+# Numeric path segments are grouped in the summary, /backup/12 as /backup/{id}
+ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+# Phases of an HTTP request in the order they happen
+HTTP_PHASES = ["prepare", "dns", "connect", "tls", "server", "transfer"]
+
+
+# Records finished spans as trace events
+class Tracer(object):
+    def __init__(self, path):
+        self.path = path
+        self.origin = time.perf_counter()
+        self.wall_start = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+        # Connection phases of the request running on each thread
+        self.local = threading.local()
+
+    def record(self, name, category, start, end, args):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1000000, 1),
+            "dur": round((end - start) * 1000000, 1),
+            "pid": os.getpid(),
+            "tid": threading.current_thread().ident,
+            "args": args
+        }
+        with self.lock:
+            self.events.append(event)
+
+    # Add time to a connection phase of the current request
+    def add_time(self, phase, seconds):
+        timings = getattr(self.local, "timings", None)
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0) + seconds
+
+
+# A span that is recorded when it ends
+class Span(object):
+    __slots__ = ("name", "category", "args", "start")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    # Attach a value to the span, e.g. the status of a response
+    def set(self, key, value):
+        self.args[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        current = tracer
+        if current is not None:
+            current.record(self.name, self.category, self.start, end,
+                           self.args)
+        return False
+
+
+# Stand-in for spans while tracing is off
+class NullSpan(object):
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+# Start a span, a no-op while tracing is off
+def span(name, category="phase", **args):
+    if tracer is None:
+        return NULL_SPAN
+    return Span(name, category, args)
+
+
+# Decorator recording every call of a function as a span
+def traced(name, category="phase"):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+            with Span(name, category, {}):
+                return function(*args, **kwargs)
+        profiling.named(wrapper, "<traced " + function.__name__ + ">")
+        return wrapper
+    return decorator
+
+
+# Whether tracing is on
+def enabled():
+    return tracer is not None
+
+
+# Start tracing into a file
+def enable(path):
+    global tracer
+    tracer = Tracer(path)
+    install_hooks()
+    return tracer
+
+
+# Wrap a function so its time is added to a phase of the current request
+def timed(function, phase):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current = tracer
+            if current is not None:
+                current.add_time(phase, time.perf_counter() - start)
+    wrapper.traced = True
+    return wrapper
+
+
+# Time sending, name resolution, TCP connects and TLS handshakes
+# Sends include the other phases, connects their name resolution and
+# handshakes their connect, the differences are taken when the request span
+# ends
+def install_hooks():
+    if getattr(socket.getaddrinfo, "traced", False):
+        return
+    socket.getaddrinfo = timed(socket.getaddrinfo, "dns")
+    requests.Session.send = timed(requests.Session.send, "send")
+    try:
+        import urllib3.connection as connection
+    except ImportError:
+        return
+    connection.HTTPConnection._new_conn = timed(
+        connection.HTTPConnection._new_conn, "connect")
+    connection.HTTPSConnection.connect = timed(
+        connection.HTTPSConnection.connect, "tls")
+
+
+# Path of a URL with numeric segments replaced, for grouping requests
+def path_template(path):
+    return ID_SEGMENT.sub("/{id}", path)
+
+
+# Size of a response body without reading streamed bodies
+def response_bytes(response, stream):
+    if not stream and hasattr(response, "content"):
+        return len(response.content)
+    headers = getattr(response, "headers", None) or {}
+    length = headers.get("Content-Length", None)
+    return int(length) if length is not None and length.isdigit() else None
+
+
+# Split the time of a request into its phases, in seconds
+def http_phases(timings, response, total):
+    dns = timings.get("dns", 0)
+    # Connects contain their name resolution, handshakes their connect
+    connect = max(timings.get("connect", 0) - dns, 0)
+    tls = max(timings.get("tls", 0) - connect - dns, 0) \
+        if timings.get("tls", 0) > 0 else 0
+    # Until the response was sent requests prepares the request, e.g. looks
+    # up proxies and merges cookies
+    sent = min(timings.get("send", total), total)
+    prepare = total - sent
+    # The time until the headers arrived, the body is read after that
+    elapsed = getattr(response, "elapsed", None)
+    if elapsed is None:
+        headers_received = sent
+    else:
+        headers_received = min(elapsed.total_seconds(), sent)
+    server = max(headers_received - dns - connect - tls, 0)
+    return {
+        "prepare": prepare,
+        "dns": dns,
+        "connect": connect,
+        "tls": tls,
+        "server": server,
+        "transfer": max(sent - headers_received, 0)
+    }
+
+
+# Make a traced HTTP request, send makes the request and returns the response
+def request(method, url, stream, send):
+    current = tracer
+    if current is None:
+        return send()
+    path = urlparse(url).path or "/"
+    current.local.timings = {}
+    start = time.perf_counter()
+    try:
+        response = send()
+    finally:
+        end = time.perf_counter()
+        timings = current.local.timings
+        current.local.timings = None
+    args = {"method": method.upper(), "path": path,
+            "status": getattr(response, "status_code", None)}
+    size = response_bytes(response, stream)
+    if size is not None:
+        args["bytes"] = size
+    args["redirects"] = len(getattr(response, "history", None) or [])
+    retries = getattr(getattr(response, "raw", None), "retries", None)
+    args["retries"] = len(getattr(retries, "history", None) or [])
+    for phase, seconds in http_phases(timings, response, end - start).items():
+        args[phase + "_ms"] = round(seconds * 1000, 3)
+    name = method.upper() + " " + path_template(path)
+    current.record(name, "http", start, end, args)
+    return response
+
+
+# Durations of the spans grouped by name, longest total first
+def summarize(events):
+    groups = {}
+    for event in events:
+        group = groups.setdefault(event["name"], {
+            "name": event["name"], "category": event["cat"], "count": 0,
+            "total": 0.0, "max": 0.0})
+        duration = event["dur"] / 1000.0
+        group["count"] += 1
+        group["total"] += duration
+        group["max"] = max(group["max"], duration)
+    return sorted(groups.values(), key=lambda group: -group["total"])
+
+
+# Summary table of the spans, durations in milliseconds
+def summary_table(events, wall_ms):
+    rows = [["SPAN", "COUNT", "TOTAL ms", "MEAN ms", "MAX ms", "% WALL"]]
+    for group in summarize(events):
+        share = group["total"] / wall_ms * 100 if wall_ms > 0 else 0
+        rows.append([group["name"], str(group["count"]),
+                     "{0:.1f}".format(group["total"]),
+                     "{0:.1f}".format(group["total"] / group["count"]),
+                     "{0:.1f}".format(group["max"]),
+                     "{0:.0f}".format(share)])
+    widths = [max(len(row[column]) for row in rows)
+              for column in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        cells = [row[0].ljust(widths[0])]
+        cells += [cell.rjust(width) for cell, width in zip(row[1:],
+                                                           widths[1:])]
+        lines.append("  ".join(cells).rstrip())
+
+    requests = [event for event in events if event["cat"] == "http"]
+    if len(requests) > 0:
+        totals = [sum(event["args"].get(phase + "_ms", 0)
+                      for event in requests) for phase in HTTP_PHASES]
+        lines.append("")
+        lines.append("HTTP " + str(len(requests)) + " requests: " + ", ".join(
+            phase + " " + "{0:.1f}".format(total) + " ms"
+            for phase, total in zip(HTTP_PHASES, totals)))
+    return "\n".join(lines)
+
+
+# Stop tracing, write the trace file and print the summary
+def finish():
+    global tracer
+    current = tracer
+    if current is None:
+        return None
+    tracer = None
+    wall_ms = (time.perf_counter() - current.origin) * 1000
+    with current.lock:
+        events = sorted(current.events, key=lambda event: event["ts"])
+    document = {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {
+            "started": current.wall_start,
+            "argv": profiling.command_line()
+        }
+    }
+    directory = os.path.dirname(current.path)
+    try:
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(current.path, 'w') as file_handle:
+            json.dump(document, file_handle, default=str)
+        written = "Trace written to " + current.path
+    except (IOError, OSError) as exc:
+        written = "Failed to write trace " + current.path + ": " + str(exc)
+    sys.stderr.write(summary_table(events, wall_ms) + "\n" + written + "\n")
+    return document